@@ -0,0 +1,251 @@
+"""
+Воронка покупок: журнал событий и отчет по нему.
+
+Обработчики вызывают EventLog.record: событие добавляется в список в
+памяти без обращения к диску, а фоновый поток раз в flush_interval
+секунд дописывает накопленное в отдельную базу SQLite одной
+транзакцией. События только дописываются; каждое - четыре целых числа
+(время в мс, пользователь, тип события, товар).
+
+Отчет строится отдельно от бота: python analytics.py --days 7
+(конверсия по шагам воронки, просмотры и добавления в корзину по
+товарам, брошенные корзины).
+"""
+import argparse
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Шаги воронки по порядку
+FUNNEL = ("catalog", "view", "add_to_cart", "start_order", "name", "phone", "order")
+# Все типы событий и их коды в базе (коды не меняются, новые - только в конец)
+EVENTS = FUNNEL + ("cancel", "clear_cart")
+EVENT_CODES = {name: code for code, name in enumerate(EVENTS, 1)}
+
+FUNNEL_TITLES = {
+    "catalog": "Открыли каталог",
+    "view": "Смотрели товары",
+    "add_to_cart": "Добавили в корзину",
+    "start_order": "Начали оформление",
+    "name": "Ввели имя",
+    "phone": "Ввели телефон",
+    "order": "Оформили заказ",
+}
+
+
+def connect(path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS events ("
+        " ts INTEGER NOT NULL,"
+        " user_id INTEGER NOT NULL,"
+        " event INTEGER NOT NULL,"
+        " product_id INTEGER"
+        ")"
+    )
+    return conn
+
+
+class EventLog:
+    """
+    Журнал событий воронки с пакетной записью.
+
+    Если база недоступна дольше, чем накапливается max_pending событий,
+    лишние события отбрасываются: аналитика не должна расходовать память
+    бота без ограничений.
+    """
+
+    def __init__(self, path: str, flush_interval: float = 5.0, max_pending: int = 100000):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._conn = connect(path)
+        self._pending = []
+        self._pending_lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        # Статистика для мониторинга
+        self.recorded = 0
+        self.dropped = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._flush_loop, name="analytics", daemon=True)
+        self._thread.start()
+
+    def record(self, event: str, user_id: int, product_id: int = None) -> None:
+        """Запоминает событие (запись на диск - в фоне)"""
+        item = (int(time.time() * 1000), user_id, EVENT_CODES[event], product_id)
+        with self._pending_lock:
+            if len(self._pending) >= self.max_pending:
+                self.dropped += 1
+                return
+            self._pending.append(item)
+            self.recorded += 1
+
+    def flush(self) -> None:
+        with self._db_lock:
+            with self._pending_lock:
+                pending, self._pending = self._pending, []
+            if not pending:
+                return
+            try:
+                self._conn.execute("BEGIN")
+                self._conn.executemany(
+                    "INSERT INTO events (ts, user_id, event, product_id) VALUES (?, ?, ?, ?)", pending
+                )
+                self._conn.execute("COMMIT")
+            except sqlite3.Error as e:
+                self._conn.execute("ROLLBACK")
+                logger.error(f"Ошибка записи событий в {self.path}: {e}")
+                # Возвращаем события в начало очереди, если для них есть место
+                with self._pending_lock:
+                    room = max(0, self.max_pending - len(self._pending))
+                    self.dropped += max(0, len(pending) - room)
+                    self._pending[:0] = pending[-room:] if room else []
+
+    def _flush_loop(self) -> None:
+        """Фоновая запись событий"""
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def close(self) -> None:
+        self._stop.set()
+        self._thread.join()
+        self.flush()
+        with self._db_lock:
+            self._conn.close()
+
+
+def funnel(conn, since: int):
+    """[(шаг, пользователей)] за период с since (мс)"""
+    counts = dict(conn.execute(
+        "SELECT event, COUNT(DISTINCT user_id) FROM events WHERE ts >= ? GROUP BY event", (since,)
+    ).fetchall())
+    return [(step, counts.get(EVENT_CODES[step], 0)) for step in FUNNEL]
+
+
+def product_stats(conn, since: int):
+    """[(товар, просмотров, добавлений в корзину)] по убыванию просмотров"""
+    return conn.execute(
+        "SELECT product_id, SUM(event = ?) AS views, SUM(event = ?) AS adds FROM events"
+        " WHERE ts >= ? AND product_id IS NOT NULL GROUP BY product_id ORDER BY views DESC",
+        (EVENT_CODES["view"], EVENT_CODES["add_to_cart"], since)
+    ).fetchall()
+
+
+def abandoned_carts(conn, since: int, idle_before: int, limit: int = 20):
+    """
+    Брошенные корзины: после последнего добавления в корзину не было ни
+    заказа, ни очистки корзины, и с него прошло больше idle.
+
+    Возвращает [(пользователь, время последнего добавления, {товар: добавлений})].
+    """
+    add, order, clear = EVENT_CODES["add_to_cart"], EVENT_CODES["order"], EVENT_CODES["clear_cart"]
+    users = conn.execute(
+        "SELECT user_id, last_add, last_close FROM ("
+        "  SELECT user_id,"
+        "   MAX(CASE WHEN event = :add THEN ts END) AS last_add,"
+        "   COALESCE(MAX(CASE WHEN event != :add THEN ts END), 0) AS last_close"
+        "  FROM events WHERE ts >= :since AND event IN (:add, :order, :clear)"
+        "  GROUP BY user_id"
+        ") WHERE last_add > last_close AND last_add < :idle_before"
+        " ORDER BY last_add DESC LIMIT :limit",
+        {"add": add, "order": order, "clear": clear, "since": since,
+         "idle_before": idle_before, "limit": limit}
+    ).fetchall()
+    if not users:
+        return []
+
+    # Содержимое корзин - одним проходом по добавлениям выбранных пользователей
+    last_close = {user_id: close for user_id, _, close in users}
+    carts = {user_id: {} for user_id in last_close}
+    placeholders = ",".join("?" * len(users))
+    for user_id, product_id, ts in conn.execute(
+        f"SELECT user_id, product_id, ts FROM events"
+        f" WHERE event = ? AND ts >= ? AND user_id IN ({placeholders})",
+        (add, since, *last_close)
+    ):
+        if ts > last_close[user_id]:
+            carts[user_id][product_id] = carts[user_id].get(product_id, 0) + 1
+    return [(user_id, last_add, carts[user_id]) for user_id, last_add, _ in users]
+
+
+def product_names() -> dict:
+    """Названия товаров из текущего каталога"""
+    import settings
+    from catalog import get_catalog
+
+    catalog = get_catalog()
+    if settings.CATALOG_PATH:
+        from catalog_loader import load_catalog
+        catalog = load_catalog(settings.CATALOG_PATH)
+    return {product['id']: product['name'] for product in catalog.products}
+
+
+def report(path: str, days: float = 7, idle_hours: float = 24, limit: int = 20) -> str:
+    """Текст отчета по журналу событий"""
+    now = int(time.time() * 1000)
+    since = now - int(days * 86400 * 1000)
+    names = product_names()
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        steps = funnel(conn, since)
+        products = product_stats(conn, since)
+        carts = abandoned_carts(conn, since, now - int(idle_hours * 3600 * 1000), limit)
+    finally:
+        conn.close()
+
+    lines = [f"📊 Воронка за {days:g} дн. (уникальные пользователи)"]
+    first = steps[0][1] or 1
+    previous = None
+    for step, users in steps:
+        line = f"  {FUNNEL_TITLES[step]:<22}{users:>9}  {users / first:>7.1%} от начала"
+        if previous:
+            line += f", {users / previous:.1%} от предыдущего шага"
+        lines.append(line)
+        previous = users
+
+    lines.append("")
+    lines.append("🕯️ Товары: просмотры, в корзину, конверсия")
+    for product_id, views, adds in products:
+        conversion = f"{adds / views:.1%}" if views else "-"
+        lines.append(f"  {names.get(product_id, f'#{product_id}'):<32}{views:>9}{adds:>9}{conversion:>9}")
+
+    lines.append("")
+    lines.append(f"🛒 Брошенные корзины (без заказа больше {idle_hours:g} ч), последние {limit}:")
+    for user_id, last_add, cart in carts:
+        when = time.strftime("%d.%m %H:%M", time.localtime(last_add / 1000))
+        items = ", ".join(f"{names.get(product_id, f'#{product_id}')} x{count}"
+                          for product_id, count in cart.items())
+        lines.append(f"  {user_id} ({when}): {items}")
+    if not carts:
+        lines.append("  нет")
+    return "\n".join(lines)
+
+
+def main() -> None:
+    import settings
+
+    parser = argparse.ArgumentParser(description="Отчет по воронке покупок")
+    parser.add_argument("--db", default=settings.EVENTS_DB_PATH, help="база событий")
+    parser.add_argument("--days", type=float, default=7, help="за сколько последних дней")
+    parser.add_argument("--idle-hours", type=float, default=24,
+                        help="через сколько часов без заказа корзина считается брошенной")
+    parser.add_argument("--limit", type=int, default=20, help="сколько брошенных корзин показать")
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    print(report(args.db, args.days, args.idle_hours, args.limit))
+    print(f"\nОтчет построен за {time.perf_counter() - started:.2f} с")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,290 @@
+"""
+Нагрузочный тест обработчиков бота.
+
+Прогоняет через Application.process_update поток синтетических обновлений
+от тысяч пользователей (листание каталога, добавление в корзину, /cart,
+оформление заказа) против локального fake_bot_api.FakeBotAPI и печатает
+задержки обработчиков (p50/p95/p99), пропускную способность и память
+на пользователя.
+
+Пример: python benchmark.py --users 2000 --concurrency 200 --latency 0.02
+
+С --webhook-url обновления отправляются по HTTP уже запущенному боту или
+маршрутизатору cluster.py; обработку тогда видно по счетчикам fake Bot API
+(--api-url), к которому подключен бот.
+"""
+import argparse
+import asyncio
+import itertools
+import logging
+import os
+import pickle
+import random
+import tempfile
+import time
+from collections import defaultdict
+
+import settings
+
+
+def percentile(values, fraction: float) -> float:
+    """Перцентиль по отсортированному списку"""
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, int(round(fraction * (len(values) - 1))))
+    return values[index]
+
+
+class UpdateFactory:
+    """Генерирует JSON обновлений, похожих на настоящие"""
+
+    def __init__(self):
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+
+    @staticmethod
+    def _user(user_id: int) -> dict:
+        return {"id": user_id, "is_bot": False, "first_name": f"Покупатель {user_id}", "language_code": "ru"}
+
+    def message(self, user_id: int, text: str) -> dict:
+        message = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": self._user(user_id),
+            "text": text,
+        }
+        if text.startswith("/"):
+            command = text.split()[0]
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(command)}]
+        return {"update_id": next(self._update_ids), "message": message}
+
+    def callback(self, user_id: int, data: str, bot_message_id: int = 1) -> dict:
+        from fake_bot_api import BOT_USER
+        return {
+            "update_id": next(self._update_ids),
+            "callback_query": {
+                "id": str(next(self._update_ids)),
+                "from": self._user(user_id),
+                "chat_instance": str(user_id),
+                "data": data,
+                "message": {
+                    "message_id": bot_message_id,
+                    "date": int(time.time()),
+                    "chat": {"id": user_id, "type": "private"},
+                    "from": BOT_USER,
+                    "caption": "товар",
+                },
+            },
+        }
+
+
+def user_session(factory: UpdateFactory, user_id: int, products, pages: int, checkout: bool, grid: bool = False):
+    """Последовательность (тип, обновление) одного покупателя"""
+    if grid:
+        # Плитка: за одну страницу покупатель видит несколько товаров
+        yield "grid", factory.message(user_id, "/grid")
+    else:
+        yield "catalog", factory.message(user_id, "/catalog")
+    for page in range(1, pages + 1):
+        if grid:
+            yield "grid_page", factory.callback(user_id, f"grid_page:{page}")
+        else:
+            yield "page", factory.callback(user_id, random.choice(("next", "prev")))
+        if random.random() < 0.3:
+            product = random.choice(products)
+            yield "add_to_cart", factory.callback(user_id, f"add_to_cart:{product['id']}")
+    yield "cart", factory.message(user_id, "/cart")
+    if checkout:
+        product = random.choice(products)
+        yield "add_to_cart", factory.callback(user_id, f"add_to_cart:{product['id']}")
+        yield "start_order", factory.callback(user_id, "start_order")
+        yield "name", factory.message(user_id, "Ольга")
+        yield "phone", factory.message(user_id, "+7 999 123-45-67")
+
+
+async def run(args) -> None:
+    from fake_bot_api import FakeBotAPI
+
+    # Отдельная папка данных, чтобы не трогать настоящие корзины и кэш фото
+    data_dir = tempfile.mkdtemp(prefix="teplo-bench-")
+    settings.STORAGE_BACKEND = "memory"
+    settings.PHOTO_CACHE_PATH = os.path.join(data_dir, "photo_cache.json")
+    settings.ORDERS_DB_PATH = os.path.join(data_dir, "orders.sqlite3")
+    settings.EVENTS_DB_PATH = os.path.join(data_dir, "events.sqlite3")
+    settings.BUILD_IMAGES_ON_STARTUP = False
+    if args.chat_rate:
+        settings.API_PRIVATE_CHAT_RATE = args.chat_rate
+    if args.overall_rate:
+        settings.API_OVERALL_RATE = args.overall_rate
+
+    import bot
+    from catalog import get_catalog
+    from telegram import Update
+
+    # Логи каждого HTTP-запроса исказили бы замеры
+    logging.getLogger().setLevel(logging.WARNING)
+
+    api = None
+    if args.api_url:
+        # Fake Bot API в отдельном процессе (python fake_bot_api.py)
+        base_url = args.api_url
+    else:
+        api = FakeBotAPI(latency=args.latency, jitter=args.jitter,
+                         retry_after_rate=args.retry_after_rate, retry_after=args.retry_after)
+        base_url = await api.start()
+    application = bot.build_application(token="123456:BENCHMARK", base_url=base_url)
+    await application.initialize()
+
+    factory = UpdateFactory()
+    products = get_catalog().products
+    latencies = defaultdict(list)
+    errors = 0
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def simulate(user_id: int) -> None:
+        nonlocal errors
+        checkout = random.random() < args.checkout_ratio
+        async with semaphore:
+            for kind, data in user_session(factory, user_id, products, args.pages, checkout, args.grid):
+                update = Update.de_json(data, application.bot)
+                started = time.perf_counter()
+                try:
+                    await application.process_update(update)
+                except Exception:
+                    errors += 1
+                latencies[kind].append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(simulate(100000 + i) for i in range(args.users)))
+    elapsed = time.perf_counter() - started
+
+    if bot.navigation:
+        # Отложенные обновления карточек каталога
+        await bot.navigation.flush()
+    user_data_sizes = [len(pickle.dumps(data)) for data in application.user_data.values()]
+    await application.shutdown()
+    if api:
+        await api.stop()
+
+    total = sum(len(values) for values in latencies.values())
+    print(f"Пользователей: {args.users}, обновлений: {total}, ошибок: {errors}")
+    print(f"Время: {elapsed:.2f} с, обновлений в секунду: {total / elapsed:.0f}")
+    print_latencies(latencies)
+    if user_data_sizes:
+        print(f"user_data на пользователя: в среднем {sum(user_data_sizes) / len(user_data_sizes):.0f} байт, "
+              f"максимум {max(user_data_sizes)} байт")
+    if api:
+        print(f"Вызовы Bot API: {dict(api.counts)}")
+
+
+def print_latencies(latencies) -> None:
+    """Печатает таблицу задержек по типам обновлений"""
+    all_latencies = sorted(itertools.chain.from_iterable(latencies.values()))
+    print(f"{'обработчик':<14}{'кол-во':>8}{'p50, мс':>10}{'p95, мс':>10}{'p99, мс':>10}")
+    for kind, values in sorted(latencies.items()) + [("ВСЕ", all_latencies)]:
+        values = sorted(values)
+        print(
+            f"{kind:<14}{len(values):>8}"
+            f"{percentile(values, 0.50) * 1000:>10.1f}"
+            f"{percentile(values, 0.95) * 1000:>10.1f}"
+            f"{percentile(values, 0.99) * 1000:>10.1f}"
+        )
+
+
+async def api_counts(session, stats_url: str) -> dict:
+    async with session.get(stats_url) as response:
+        return await response.json()
+
+
+async def run_webhook_load(args) -> None:
+    """Отправляет обновления по HTTP на webhook (например, маршрутизатора cluster.py)"""
+    import aiohttp
+    from catalog import get_catalog
+    from webserver import SECRET_HEADER
+
+    factory = UpdateFactory()
+    products = get_catalog().products
+    latencies = defaultdict(list)
+    errors = 0
+    semaphore = asyncio.Semaphore(args.concurrency)
+    headers = {SECRET_HEADER: args.webhook_secret} if args.webhook_secret else {}
+    stats_url = f"{args.api_url.rsplit('/', 1)[0]}/stats" if args.api_url else None
+
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0)) as session:
+        before = await api_counts(session, stats_url) if stats_url else {}
+
+        async def simulate(user_id: int) -> None:
+            nonlocal errors
+            checkout = random.random() < args.checkout_ratio
+            async with semaphore:
+                for kind, data in user_session(factory, user_id, products, args.pages, checkout, args.grid):
+                    started = time.perf_counter()
+                    try:
+                        async with session.post(args.webhook_url, json=data, headers=headers) as response:
+                            if response.status != 200:
+                                errors += 1
+                    except aiohttp.ClientError:
+                        errors += 1
+                    latencies[kind].append(time.perf_counter() - started)
+                    # Обновления одного пользователя приходят не быстрее, чем бот на них отвечает
+                    await asyncio.sleep(args.think_time)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(simulate(100000 + i) for i in range(args.users)))
+        sent = time.perf_counter() - started
+
+        after = before
+        if stats_url:
+            # Ждем, пока бот доработает очередь: счетчики Bot API перестают расти
+            while True:
+                await asyncio.sleep(1)
+                current = await api_counts(session, stats_url)
+                if current == after:
+                    break
+                after = current
+        elapsed = time.perf_counter() - started - (1 if stats_url else 0)
+
+    total = sum(len(values) for values in latencies.values())
+    print(f"Пользователей: {args.users}, обновлений: {total}, ошибок: {errors}")
+    print(f"Отправлено за {sent:.2f} с, обработано за {elapsed:.2f} с, "
+          f"обновлений в секунду: {total / elapsed:.0f}")
+    print("Задержка ответа webhook:")
+    print_latencies(latencies)
+    if stats_url:
+        calls = {method: after.get(method, 0) - before.get(method, 0) for method in after}
+        print(f"Вызовы Bot API: {calls}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота на локальном fake Bot API")
+    parser.add_argument("--users", type=int, default=1000, help="число покупателей")
+    parser.add_argument("--concurrency", type=int, default=100, help="сколько покупателей активны одновременно")
+    parser.add_argument("--pages", type=int, default=5, help="сколько раз каждый листает каталог")
+    parser.add_argument("--grid", action="store_true",
+                        help="листать каталог плиткой (/grid), --pages - число страниц плитки")
+    parser.add_argument("--checkout-ratio", type=float, default=0.3, help="доля покупателей, оформляющих заказ")
+    parser.add_argument("--api-url", default=None,
+                        help="адрес уже запущенного fake Bot API, например http://127.0.0.1:8081/bot")
+    parser.add_argument("--latency", type=float, default=0.0, help="задержка ответа Bot API, с")
+    parser.add_argument("--jitter", type=float, default=0.0, help="случайная добавка к задержке, с")
+    parser.add_argument("--retry-after-rate", type=float, default=0.0, help="доля ответов 429 RetryAfter")
+    parser.add_argument("--retry-after", type=int, default=1, help="retry_after в ответах 429, с")
+    parser.add_argument("--chat-rate", type=float, default=None,
+                        help="лимит запросов в секунду на чат (по умолчанию из настроек)")
+    parser.add_argument("--overall-rate", type=float, default=None,
+                        help="общий лимит запросов в секунду (по умолчанию из настроек)")
+    parser.add_argument("--webhook-url", default=None,
+                        help="отправлять обновления на webhook, например http://127.0.0.1:8080/webhook")
+    parser.add_argument("--webhook-secret", default=None, help="секрет webhook (WEBHOOK_SECRET)")
+    parser.add_argument("--think-time", type=float, default=0.05,
+                        help="пауза между обновлениями одного пользователя в режиме --webhook-url, с")
+    parser.add_argument("--seed", type=int, default=1, help="зерно генератора случайных чисел")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    asyncio.run(run_webhook_load(args) if args.webhook_url else run(args))
+
+
+if __name__ == "__main__":
+    main()
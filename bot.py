@@ -1,32 +1,172 @@
+# Первым: отсчет времени запуска начинается до импорта библиотек
+import startup
+import asyncio
+import html
 import logging
-import os
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto
+import re
+import time
+import httpx
+from telegram import Update, InlineKeyboardMarkup, InputMediaPhoto
+from telegram.error import BadRequest
+from telegram.request import HTTPXRequest
 from telegram.ext import (
     Application, CommandHandler, MessageHandler, filters, 
-    ContextTypes, CallbackQueryHandler, ConversationHandler
+    ContextTypes, CallbackQueryHandler, ConversationHandler, InlineQueryHandler, TypeHandler
 )
 
 # Импортируем конфигурацию и товары
 from config import TOKEN, ADMIN_CHAT_ID
-from products import PRODUCTS
-
-# Настройка логирования
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
+from cart import Cart, get_cart
+from catalog import escape, get_catalog, set_catalog
+from analytics import EventLog
+from broadcast import Broadcasts, BroadcastWorker
+from catalog_loader import CatalogWatcher, load_catalog
+from concurrency import PerUserUpdateProcessor, update_stats
+from images import ImageStore
+from inline import InlineResults
+from inventory import Inventory, OutOfStock
+from media import MediaProvider
+from logs import setup_logging, dropped_count
+from keyboards import (
+    PREV_BUTTON, NEXT_BUTTON, ADD_TO_CART_BUTTON, CLEAR_CART_BUTTON, START_ORDER_BUTTON,
+    CART_INC_BUTTON, CART_DEC_BUTTON, CART_DEL_BUTTON, create_cart_keyboard,
+    SEARCH_ITEM_BUTTON, SEARCH_PAGE_BUTTON, create_search_keyboard, GRID_PAGE_BUTTON,
+    create_promo_keyboard
 )
-logger = logging.getLogger(__name__)
+from metrics import instrument_application, start_metrics_server
+from navigation import Debouncer
+from orders import OrderLedger
+from outbox import Outbox, OutboxWorker
+from persistence import SessionManager, StoragePersistence, USER_DATA
+from photo_cache import PhotoCache
+from ratelimit import TokenBucketRateLimiter
+from search import parse_query
+from storage import create_storage
+import metrics
+import settings
 
-# Константы для callback данных
-PREV_BUTTON = "prev"
-NEXT_BUTTON = "next"
-ADD_TO_CART_BUTTON = "add_to_cart"
-CLEAR_CART_BUTTON = "clear_cart"
-START_ORDER_BUTTON = "start_order"
+logger = logging.getLogger(__name__)
+startup.timer.mark("импорт модулей")
 
 # Состояния для ConversationHandler
 GET_NAME, GET_PHONE = range(2)
 
+# Кэши, базы и фоновые обработчики создает setup_services() при сборке
+# приложения. Импорт модуля ничего не открывает и не запускает: процессы
+# сборки фото (spawn) заново импортируют главный модуль, то есть этот файл
+photo_cache = None
+media = None
+image_store = None
+inline_results = None
+outbox = None
+inventory = None
+order_ledger = None
+outbox_worker = None
+broadcasts = None
+broadcast_worker = None
+events = None
+navigation = None
+
+# Ссылки на фоновые задачи, чтобы их не собрал сборщик мусора
+background_tasks = set()
+# Слежение за файлом каталога (если каталог задан в настройках)
+catalog_watcher = None
+# Запущенные вспомогательные HTTP-серверы (например, /metrics)
+web_runners = []
+
+def setup_services() -> None:
+    """Настраивает журнал и создает кэши, базы и фоновые обработчики (один раз)"""
+    global photo_cache, media, image_store, inline_results, outbox, inventory, order_ledger
+    global outbox_worker, broadcasts, broadcast_worker, events, navigation
+    if outbox is not None:
+        return
+
+    # Журнал пишется в отдельном потоке, личные данные скрываются
+    setup_logging(
+        level=settings.LOG_LEVEL,
+        log_format=settings.LOG_FORMAT,
+        levels=settings.LOG_LEVELS,
+        sample_rates=settings.LOG_SAMPLE_RATES,
+        redact_fields=settings.LOG_REDACT_FIELDS,
+        queue_size=settings.LOG_QUEUE_SIZE
+    )
+
+    # Кэш file_id уже загруженных фото товаров
+    photo_cache = PhotoCache(settings.PHOTO_CACHE_PATH)
+
+    # Чтение фото и проверка file_id в отдельном пуле потоков
+    media = MediaProvider(photo_cache, max_bytes=settings.MEDIA_CACHE_BYTES, workers=settings.MEDIA_IO_WORKERS)
+
+    # Уменьшенные варианты фото (строятся в фоне после запуска)
+    image_store = ImageStore(settings.IMAGE_CACHE_DIR, settings.IMAGE_FORMAT, settings.IMAGE_WORKERS)
+
+    # Ответы на inline-запросы (@бот запрос), фото - из кэша file_id
+    inline_results = InlineResults(
+        # Без обращения к диску: ответ на inline-запрос не ждет проверки файла
+        photo_file_id=lambda product: photo_cache.peek(photo_source(product)[0]),
+        photo_version=lambda: photo_cache.version,
+        page_size=settings.INLINE_PAGE_SIZE,
+        max_size=settings.INLINE_CACHE_SIZE
+    )
+
+    # Очередь уведомлений администратору и журнал заказов (одна база)
+    outbox = Outbox(settings.ORDERS_DB_PATH)
+    inventory = Inventory(
+        outbox,
+        reservation_ttl=settings.RESERVATION_TTL,
+        refresh_interval=settings.INVENTORY_REFRESH_INTERVAL
+    )
+    order_ledger = OrderLedger(outbox, inventory)
+    outbox_worker = OutboxWorker(
+        outbox,
+        max_attempts=settings.OUTBOX_MAX_ATTEMPTS,
+        on_delivered=order_ledger.mark_notified,
+        on_failed=order_ledger.mark_notify_failed
+    )
+
+    # Рассылки покупателям (та же база), отправляются в фоне с низким приоритетом
+    broadcasts = Broadcasts(outbox)
+    broadcast_worker = BroadcastWorker(
+        broadcasts,
+        send=lambda *args: send_broadcast(*args),
+        rate=settings.BROADCAST_RATE,
+        batch_size=settings.BROADCAST_BATCH_SIZE,
+        notify_chat_id=ADMIN_CHAT_ID,
+        on_finished=outbox_worker.notify
+    )
+
+    # События воронки покупок для отчета analytics.py
+    events = EventLog(settings.EVENTS_DB_PATH, settings.EVENTS_FLUSH_INTERVAL) if settings.EVENTS_DB_PATH else None
+
+    # Отложенное листание каталога (None - карточка обновляется после каждого нажатия)
+    navigation = Debouncer(settings.CATALOG_NAV_DEBOUNCE) if settings.CATALOG_NAV_DEBOUNCE else None
+    startup.timer.mark("кэши и базы")
+
+def photo_source(product, variant: str = "card"):
+    """Ключ в кэше file_id и путь к файлу фото товара в нужном варианте"""
+    return f"{product['id']}:{variant}", image_store.path(product, variant)
+
+async def load_photo(product, variant: str = "card"):
+    """Возвращает file_id из кэша или содержимое файла фото (None, если файла нет)"""
+    return await media.load(*photo_source(product, variant))
+
+async def remember_photo(product, message, photo, variant: str = "card") -> None:
+    """Запоминает file_id фото, которое вернул Telegram (если фото загружалось)"""
+    if isinstance(photo, str):
+        return
+    key, path = photo_source(product, variant)
+    await media.remember(key, path, message)
+
+async def forget_photo_on_error(product, photo, variant: str = "card") -> None:
+    """Сбрасывает file_id, если Telegram не принял фото из кэша"""
+    if isinstance(photo, str):
+        await media.forget(photo_source(product, variant)[0])
+
+def track(event: str, user_id: int, product_id: int = None) -> None:
+    """Записывает событие воронки (на диск - в фоне)"""
+    if events:
+        events.record(event, user_id, product_id)
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработчик команды /start"""
     user = update.effective_user
@@ -34,127 +174,216 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         f"🕯️ Добро пожаловать в наш магазин ароматических свечей, {user.first_name}!\n\n"
         f"Здесь вы найдете уникальные свечи ручной работы с натуральными ароматами.\n\n"
         f"📋 Для просмотра каталога товаров используйте команду /catalog\n"
+        f"🔎 Найти свечу по названию или аромату - /search\n"
         f"🛒 Просмотреть корзину - /cart\n"
         f"❓ Помощь - /help",
     )
 
 async def catalog(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработчик команды /catalog - показывает первый товар"""
-    if not PRODUCTS:
+    products = get_catalog()
+    if not len(products):
         await update.message.reply_text("Каталог товаров пуст.")
         return
     
     context.user_data['current_product_index'] = 0
-    product = PRODUCTS[0]
-    keyboard = create_product_keyboard(0)
-    caption = create_product_caption(product)
+    track("catalog", update.effective_user.id)
+    await send_product_card(update, context, products, products.at(0))
+
+async def send_product_card(update: Update, context: ContextTypes.DEFAULT_TYPE, products, product) -> None:
+    """Отправляет карточку товара с кнопками листания каталога"""
+    chat_id = update.effective_chat.id
+    keyboard = products.keyboard(product['id'])
+    caption = products.caption(product['id'])
+    track("view", update.effective_user.id, product['id'])
     
+    photo = None
     try:
-        if os.path.exists(product['photo']):
-            with open(product['photo'], 'rb') as photo_file:
-                await context.bot.send_photo(
-                    chat_id=update.effective_chat.id,
-                    photo=photo_file,
-                    caption=caption,
-                    reply_markup=keyboard,
-                    parse_mode='HTML'
-                )
+        photo = await load_photo(product)
+        if photo is not None:
+            message = await context.bot.send_photo(
+                chat_id=chat_id,
+                photo=photo,
+                caption=caption,
+                reply_markup=keyboard,
+                parse_mode='HTML'
+            )
+            await remember_photo(product, message, photo)
         else:
             logger.error(f"Файл не найден: {product['photo']}")
-            await update.message.reply_text(
-                f"{caption}\n\n⚠️ Фото временно недоступно",
+            await context.bot.send_message(
+                chat_id=chat_id,
+                text=f"{caption}\n\n⚠️ Фото временно недоступно",
                 parse_mode='HTML',
                 reply_markup=keyboard
             )
     except Exception as e:
         logger.error(f"Ошибка при отправке фото: {e}")
-        await update.message.reply_text(
-            f"{caption}\n\n⚠️ Произошла ошибка при загрузке фото",
+        await forget_photo_on_error(product, photo)
+        await context.bot.send_message(
+            chat_id=chat_id,
+            text=f"{caption}\n\n⚠️ Произошла ошибка при загрузке фото",
             parse_mode='HTML',
             reply_markup=keyboard
         )
 
-def create_product_keyboard(current_index: int) -> InlineKeyboardMarkup:
-    """Создает клавиатуру для товара"""
-    keyboard = [
-        [
-            InlineKeyboardButton("⬅️", callback_data=PREV_BUTTON),
-            InlineKeyboardButton("В корзину 🛒", callback_data=ADD_TO_CART_BUTTON),
-            InlineKeyboardButton("➡️", callback_data=NEXT_BUTTON),
-        ]
-    ]
-    return InlineKeyboardMarkup(keyboard)
+def grid_page_size() -> int:
+    """Размер страницы плитки (в альбоме Telegram от 2 до 10 фото)"""
+    return min(10, max(2, settings.GRID_PAGE_SIZE))
+
+async def grid(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Обработчик команды /grid - каталог плиткой, по несколько товаров за раз"""
+    products = get_catalog()
+    if not len(products):
+        await update.message.reply_text("Каталог товаров пуст.")
+        return
+    track("catalog", update.effective_user.id)
+    await send_grid_page(update, context, products, 0)
 
-def create_product_caption(product: dict) -> str:
-    """Создает описание товара"""
+async def send_grid_page(update: Update, context: ContextTypes.DEFAULT_TYPE, products, page: int) -> None:
+    """
+    Отправляет страницу плитки: альбом фото и сообщение с номерами.
+    
+    Альбом нельзя отредактировать одним запросом, поэтому при листании
+    предыдущая страница удаляется одним deleteMessages, а новая
+    отправляется двумя запросами вместо отдельного запроса на каждый товар.
+    """
+    chat_id = update.effective_chat.id
+    page, page_products, text, keyboard = products.grid_page(page, grid_page_size())
+    for product in page_products:
+        track("view", update.effective_user.id, product['id'])
+    
+    old_messages = context.user_data.pop('grid_messages', None)
+    if old_messages:
+        try:
+            await context.bot.delete_messages(chat_id, old_messages)
+        except Exception as e:
+            logger.warning(f"Не удалось удалить прошлую страницу плитки: {e}")
+    
+    sent = []
+    album = []
+    photos = []
+    # Фото страницы читаются параллельно; в плитке - миниатюры
+    loaded = await asyncio.gather(*(load_photo(product, "thumb") for product in page_products))
+    for number, (product, photo) in enumerate(zip(page_products, loaded), 1):
+        if photo is None:
+            logger.error(f"Файл не найден: {product['photo']}")
+            continue
+        album.append(InputMediaPhoto(media=photo, caption=f"{number}. {product['name']}"))
+        photos.append((product, photo))
+    
     try:
-        product_index = PRODUCTS.index(product)
-    except ValueError:
-        product_index = 0
+        if len(album) > 1:
+            messages = await context.bot.send_media_group(chat_id=chat_id, media=album)
+        elif album:
+            messages = [await context.bot.send_photo(
+                chat_id=chat_id, photo=album[0].media, caption=album[0].caption
+            )]
+        else:
+            messages = []
+        for (product, photo), message in zip(photos, messages):
+            await remember_photo(product, message, photo, "thumb")
+        sent.extend(message.message_id for message in messages)
+    except Exception as e:
+        logger.error(f"Ошибка при отправке страницы плитки: {e}")
+        for product, photo in photos:
+            await forget_photo_on_error(product, photo, "thumb")
     
-    return (
-        f"<b>{product['name']}</b>\n\n"
-        f"{product['description']}\n\n"
-        f"💰 <b>Цена:</b> {product['price']} руб.\n"
-        f"🆔 <b>Код товара:</b> {product['id']}\n"
-        f"📦 Товар {product_index + 1} из {len(PRODUCTS)}"
+    message = await context.bot.send_message(
+        chat_id=chat_id, text=text, parse_mode='HTML', reply_markup=keyboard
     )
+    sent.append(message.message_id)
+    context.user_data['grid_messages'] = sent
+
+async def show_catalog_product(query, index: int) -> None:
+    """Показывает в сообщении с каталогом товар с номером index"""
+    products = get_catalog()
+    product = products.at(index % len(products))
+    track("view", query.from_user.id, product['id'])
+    caption = products.caption(product['id'])
+    keyboard = products.keyboard(product['id'])
+    
+    photo = None
+    try:
+        photo = await load_photo(product)
+        if photo is not None:
+            message = await query.edit_message_media(
+                media=InputMediaPhoto(
+                    media=photo,
+                    caption=caption,
+                    parse_mode='HTML'
+                ),
+                reply_markup=keyboard
+            )
+            await remember_photo(product, message, photo)
+        else:
+            logger.error(f"Файл не найден: {product['photo']}")
+            await query.edit_message_caption(
+                caption=f"{caption}\n\n⚠️ Фото временно недоступно",
+                parse_mode='HTML',
+                reply_markup=keyboard
+            )
+    except Exception as e:
+        if isinstance(e, BadRequest) and "not modified" in str(e):
+            # Серия нажатий вернула к товару, который уже показан
+            return
+        logger.error(f"Ошибка при обновлении фото: {e}")
+        await forget_photo_on_error(product, photo)
+        await query.edit_message_caption(
+            caption=f"{caption}\n\n⚠️ Произошла ошибка при загрузке фото",
+            parse_mode='HTML',
+            reply_markup=keyboard
+        )
 
 async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработчик нажатий на inline кнопки (кроме start_order)"""
     query = update.callback_query
     user_data = context.user_data
+    products = get_catalog()
     current_index = user_data.get('current_product_index', 0)
     
     if query.data == PREV_BUTTON or query.data == NEXT_BUTTON:
+        # Отвечаем сразу, чтобы у кнопки не крутились часики
         await query.answer()
         
         if query.data == PREV_BUTTON:
-            new_index = (current_index - 1) % len(PRODUCTS)
+            new_index = (current_index - 1) % len(products)
         else:
-            new_index = (current_index + 1) % len(PRODUCTS)
+            new_index = (current_index + 1) % len(products)
             
         user_data['current_product_index'] = new_index
-        product = PRODUCTS[new_index]
-        caption = create_product_caption(product)
-        keyboard = create_product_keyboard(new_index)
-        
-        try:
-            if os.path.exists(product['photo']):
-                with open(product['photo'], 'rb') as photo_file:
-                    await query.edit_message_media(
-                        media=InputMediaPhoto(
-                            media=photo_file,
-                            caption=caption,
-                            parse_mode='HTML'
-                        ),
-                        reply_markup=keyboard
-                    )
-            else:
-                logger.error(f"Файл не найден: {product['photo']}")
-                await query.edit_message_caption(
-                    caption=f"{caption}\n\n⚠️ Фото временно недоступно",
-                    parse_mode='HTML',
-                    reply_markup=keyboard
-                )
-        except Exception as e:
-            logger.error(f"Ошибка при обновлении фото: {e}")
-            await query.edit_message_caption(
-                caption=f"{caption}\n\n⚠️ Произошла ошибка при загрузке фото",
-                parse_mode='HTML',
-                reply_markup=keyboard
-            )
+        if navigation is None:
+            await show_catalog_product(query, new_index)
+        else:
+            # Серия быстрых нажатий - одно обновление карточки в конце
+            navigation.schedule(query.inline_message_id or (query.message.chat_id, query.message.message_id),
+                                show_catalog_product, query, new_index)
         
-    elif query.data == ADD_TO_CART_BUTTON:
-        product = PRODUCTS[current_index]
-        cart = user_data.setdefault('cart', [])
-        cart.append(product['id'])
+    elif query.data.startswith(ADD_TO_CART_BUTTON):
+        # В старых сообщениях id товара в кнопке нет - берем текущий
+        _, _, product_id = query.data.partition(':')
+        product = products.get(int(product_id)) if product_id else products.at(current_index)
+        if product is None:
+            await query.answer("❌ Товар больше не продается")
+            return
+        cart = get_cart(user_data)
+        if cart.quantity(product['id']) >= Cart.MAX_QUANTITY:
+            await query.answer(f"В корзине уже максимум: {Cart.MAX_QUANTITY} шт.")
+            return
+        stock_message = check_stock(product['id'], cart.quantity(product['id']) + 1, query.from_user.id)
+        if stock_message:
+            await query.answer(stock_message)
+            return
+        cart.add(product['id'])
+        track("add_to_cart", query.from_user.id, product['id'])
         await query.answer(f"✅ {product['name']} добавлен в корзину!")
         
     elif query.data == CLEAR_CART_BUTTON:
-        await query.answer()
-        if 'cart' in user_data and user_data['cart']:
-            user_data['cart'] = []
+        cart = get_cart(user_data)
+        if cart:
+            await query.answer()
+            cart.clear()
+            track("clear_cart", query.from_user.id)
             await query.edit_message_text(
                 "🛒 Ваша корзина очищена!\n\n"
                 "Для добавления товаров используйте /catalog",
@@ -162,52 +391,169 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
             )
         else:
             await query.answer("Корзина уже пуста!")
+    
+    elif query.data.startswith((CART_INC_BUTTON, CART_DEC_BUTTON, CART_DEL_BUTTON)):
+        action, _, product_id = query.data.partition(':')
+        product_id = int(product_id)
+        cart = get_cart(user_data)
+        
+        if action == CART_INC_BUTTON:
+            if cart.quantity(product_id) >= Cart.MAX_QUANTITY:
+                await query.answer(f"В корзине уже максимум: {Cart.MAX_QUANTITY} шт.")
+                return
+            stock_message = check_stock(product_id, cart.quantity(product_id) + 1, query.from_user.id)
+            if stock_message:
+                await query.answer(stock_message)
+                return
+            cart.add(product_id)
+            track("add_to_cart", query.from_user.id, product_id)
+        elif action == CART_DEC_BUTTON:
+            cart.decrement(product_id)
+        else:
+            cart.remove(product_id)
+        await query.answer()
+        
+        cart_message, keyboard = create_cart_message(cart)
+        await query.edit_message_text(cart_message, parse_mode='HTML', reply_markup=keyboard)
+    
+    elif query.data.startswith(GRID_PAGE_BUTTON):
+        await query.answer()
+        await send_grid_page(update, context, products, int(query.data.partition(':')[2]))
+    
+    elif query.data.startswith(SEARCH_PAGE_BUTTON):
+        search_query = user_data.get('search_query')
+        if search_query is None:
+            await query.answer("Поиск устарел, повторите /search")
+            return
+        await query.answer()
+        page = int(query.data.partition(':')[2])
+        if page == user_data.get('search_page'):
+            # Нажата кнопка с номером текущей страницы
+            return
+        user_data['search_page'] = page
+        text, keyboard = create_search_message(products, search_query, page)
+        await query.edit_message_text(text, parse_mode='HTML', reply_markup=keyboard)
+    
+    elif query.data.startswith(SEARCH_ITEM_BUTTON):
+        product = products.get(int(query.data.partition(':')[2]))
+        if product is None:
+            await query.answer("❌ Товар больше не продается")
+            return
+        await query.answer()
+        # Дальше каталог листается от найденного товара
+        user_data['current_product_index'] = products.position(product['id'])
+        await send_product_card(update, context, products, product)
 
-async def cart_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Обработчик команды /cart - показывает содержимое корзины"""
-    user_data = context.user_data
-    cart = user_data.get('cart', [])
+def create_search_message(products, search_query: str, page: int = 0):
+    """Создает текст и клавиатуру страницы результатов поиска"""
+    found = products.search(*parse_query(search_query))
+    if not found:
+        return (
+            f"🔎 По запросу «{html.escape(search_query)}» ничего не найдено.\n\n"
+            "Попробуйте другое слово или уберите фильтры."
+        ), None
     
-    if not cart:
+    page_size = settings.SEARCH_PAGE_SIZE
+    pages = (len(found) + page_size - 1) // page_size
+    page = page % pages
+    page_products = found[page * page_size:(page + 1) * page_size]
+    text = f"🔎 По запросу «{html.escape(search_query)}» найдено товаров: {len(found)}"
+    if pages > 1:
+        text += f"\nСтраница {page + 1} из {pages}"
+    return text, create_search_keyboard(page_products, page, pages)
+
+async def inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Обработчик inline-запросов: товары, подходящие под запрос"""
+    query = update.inline_query
+    results, next_offset = inline_results.get(get_catalog(), query.query, query.offset)
+    await query.answer(
+        results,
+        cache_time=settings.INLINE_CACHE_TIME,
+        is_personal=False,
+        next_offset=next_offset
+    )
+
+async def search_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Обработчик команды /search <запрос> - поиск по названию и описанию"""
+    products = get_catalog()
+    if not context.args:
+        categories = " ".join(f"#{name}" for name in products.search_index.categories)
         await update.message.reply_text(
-            "🛒 Ваша корзина пуста!\n\n"
-            "Для добавления товаров используйте /catalog"
+            "🔎 <b>Поиск товаров</b>\n\n"
+            "Напишите, что ищете, например: <code>/search ваниль</code>\n\n"
+            "Фильтры можно добавить к запросу:\n"
+            "• категория: <code>#свежие</code>\n"
+            "• цена: <code>от 1000</code>, <code>до 1500</code> или <code>1000-1500</code>\n\n"
+            f"Категории: {html.escape(categories) or 'нет'}",
+            parse_mode='HTML'
         )
         return
     
-    product_counts = {}
-    total_price = 0
-    items_list = []
+    search_query = " ".join(context.args)
+    context.user_data['search_query'] = search_query
+    context.user_data['search_page'] = 0
+    text, keyboard = create_search_message(products, search_query)
+    await update.message.reply_text(text, parse_mode='HTML', reply_markup=keyboard)
+
+def check_stock(product_id: int, quantity: int, user_id: int):
+    """
+    Текст для покупателя, если товара не хватает (по кэшу остатков), иначе None.
     
-    for product_id in cart:
-        product_counts[product_id] = product_counts.get(product_id, 0) + 1
+    Резерв самого покупателя (если он начал оформление и вернулся в корзину)
+    считается доступным ему. Окончательная проверка - при резерве в начале
+    оформления заказа.
+    """
+    available = inventory.available(product_id, user_id)
+    if available is None or quantity <= available:
+        return None
+    if available == 0:
+        return "😔 Этот товар закончился"
+    return f"😔 В наличии только {available} шт."
+
+def format_shortages(products, shortages: dict) -> str:
+    """Список товаров, которых не хватает для заказа"""
+    lines = []
+    for product_id, available in shortages.items():
+        product = products.get(product_id)
+        name = product['name'] if product else f"Товар {product_id}"
+        if available:
+            lines.append(f"• {name}: в наличии только {available} шт.")
+        else:
+            lines.append(f"• {name}: закончился")
+    return "\n".join(lines)
+
+def create_cart_message(cart: Cart):
+    """Создает текст и клавиатуру корзины"""
+    if not cart:
+        return (
+            "🛒 Ваша корзина пуста!\n\n"
+            "Для добавления товаров используйте /catalog"
+        ), None
     
-    for product_id, count in product_counts.items():
-        product = next((p for p in PRODUCTS if p['id'] == product_id), None)
-        if product:
-            product_total = product['price'] * count
-            total_price += product_total
-            items_list.append(f"• {product['name']} x{count} - {product_total} руб.")
+    lines, total_price = cart.summarize(get_catalog())
+    items_list = [
+        f"{number}. {escape(product['name'])} x{quantity} - {line_total} руб."
+        for number, (product, quantity, line_total) in enumerate(lines, 1)
+    ]
     
     cart_message = (
         f"🛒 <b>Ваша корзина</b>\n\n"
         f"<b>Товары:</b>\n"
         f"{chr(10).join(items_list)}\n\n"
         f"<b>Общая стоимость:</b> {total_price} руб.\n\n"
-        f"Товаров в корзине: {len(cart)}"
+        f"Товаров в корзине: {cart.count}"
     )
-    
-    keyboard = [
-        [
-            InlineKeyboardButton("🗑️ Очистить корзину", callback_data=CLEAR_CART_BUTTON),
-            InlineKeyboardButton("Оформить заказ 📝", callback_data=START_ORDER_BUTTON),
-        ]
-    ]
+    return cart_message, create_cart_keyboard(lines)
+
+async def cart_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Обработчик команды /cart - показывает содержимое корзины"""
+    cart = get_cart(context.user_data)
+    cart_message, keyboard = create_cart_message(cart)
     
     await update.message.reply_text(
         cart_message,
         parse_mode='HTML',
-        reply_markup=InlineKeyboardMarkup(keyboard)
+        reply_markup=keyboard
     )
 
 # === ConversationHandler (оформление заказа) ===
@@ -218,25 +564,29 @@ async def start_order_dialog(update: Update, context: ContextTypes.DEFAULT_TYPE)
     await query.answer()
     
     user_data = context.user_data
-    cart = user_data.get('cart', [])
+    cart = get_cart(user_data)
     
     if not cart:
         await query.edit_message_text("🛒 Ваша корзина пуста!")
         return ConversationHandler.END
     
-    product_counts = {}
-    total_price = 0
-    items_summary = ""
+    products = get_catalog()
+    lines, total_price = cart.summarize(products)
     
-    for product_id in cart:
-        product_counts[product_id] = product_counts.get(product_id, 0) + 1
+    # Резервируем товары на время оформления
+    shortages = await asyncio.to_thread(inventory.reserve, update.effective_user.id, lines)
+    if shortages:
+        await query.edit_message_text(
+            "😔 <b>Не хватает товаров</b>\n\n"
+            f"{html.escape(format_shortages(products, shortages))}\n\n"
+            "Измените количество в корзине (/cart) и попробуйте снова.",
+            parse_mode='HTML'
+        )
+        return ConversationHandler.END
     
-    for product_id, count in product_counts.items():
-        product = next((p for p in PRODUCTS if p['id'] == product_id), None)
-        if product:
-            product_total = product['price'] * count
-            total_price += product_total
-            items_summary += f"• {product['name']} x{count}\n"
+    items_summary = "".join(
+        f"• {escape(product['name'])} x{quantity}\n" for product, quantity, _ in lines
+    )
     
     await query.edit_message_text(
         f"📝 <b>Оформление заказа</b>\n\n"
@@ -248,6 +598,7 @@ async def start_order_dialog(update: Update, context: ContextTypes.DEFAULT_TYPE)
     
     # Очищаем флаг ожидания телефона из старой системы (если есть)
     user_data.pop('awaiting_phone', None)
+    track("start_order", query.from_user.id)
     
     return GET_NAME
 
@@ -263,6 +614,7 @@ async def get_name(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     
     # Сохраняем имя
     context.user_data['customer_name'] = name
+    track("name", update.effective_user.id)
     
     await update.message.reply_text(
         f"Отлично, {name}! Теперь введите ваш номер телефона для связи:\n\n"
@@ -289,6 +641,7 @@ async def get_phone(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     
     # Сохраняем телефон
     context.user_data['customer_phone'] = phone
+    track("phone", update.effective_user.id)
     
     # Завершаем диалог и обрабатываем заказ
     await process_final_order(update, context)
@@ -297,96 +650,111 @@ async def get_phone(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 
 async def process_final_order(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
-    Собирает полный заказ и отправляет уведомление администратору
+    Записывает заказ в журнал и ставит уведомление администратору в очередь
     """
     user_data = context.user_data
     
     # Получаем данные из корзины и ConversationHandler
-    cart = user_data.get('cart', [])
+    cart = get_cart(user_data)
     customer_name = user_data.get('customer_name', 'Не указано')
     customer_phone = user_data.get('customer_phone', 'Не указано')
     
     # Подсчитываем товары в заказе
-    product_counts = {}
-    total_price = 0
-    order_items = []
-    
-    # Считаем количество каждого товара
-    for product_id in cart:
-        product_counts[product_id] = product_counts.get(product_id, 0) + 1
+    products = get_catalog()
+    lines, total_price = cart.summarize(products)
     
     # Формируем список товаров для сообщения
-    for product_id, count in product_counts.items():
-        product = next((p for p in PRODUCTS if p['id'] == product_id), None)
-        if product:
-            product_total = product['price'] * count
-            total_price += product_total
-            order_items.append(f"- {product['name']} ({count} шт.)")
-    
-    # Формируем красивое сообщение для администратора (Ольги)
-    admin_message = (
-        f"🔔 НОВЫЙ ЗАКАЗ! 🔔\n\n"
-        f"👤 Клиент: {customer_name}\n"
-        f"📞 Телефон: {customer_phone}\n\n"
-        f"---\n\n"
-        f"🛒 Состав заказа:\n"
-        f"{chr(10).join(order_items)}\n\n"
-        f"---\n\n"
-        f"💰 Итого: {total_price} руб."
-    )
-    
-    # Отправляем сообщение администратору
-    if ADMIN_CHAT_ID:
-        try:
-            await context.bot.send_message(
-                chat_id=ADMIN_CHAT_ID,
-                text=admin_message
-            )
-            logger.info(f"✅ Заказ отправлен администратору. Клиент: {customer_name}, сумма: {total_price} руб.")
-            
-            # Отправляем подтверждение пользователю
-            await update.message.reply_text(
-                "✅ Спасибо за ваш заказ! Мы скоро с вами свяжемся.\n\n"
-                "🕯️ Желаем приятного использования наших свечей!"
-            )
-            
-            # Очищаем корзину пользователя
-            user_data['cart'] = []
-            
-            # Очищаем временные данные
-            if 'customer_name' in user_data:
-                del user_data['customer_name']
-            if 'customer_phone' in user_data:
-                del user_data['customer_phone']
-            
-        except Exception as e:
-            logger.error(f"❌ Ошибка при отправке заказа администратору: {e}")
-            
-            # Уведомляем пользователя об ошибке
-            await update.message.reply_text(
-                "❌ Произошла ошибка при обработке вашего заказа. "
-                "Пожалуйста, попробуйте позже или свяжитесь с нами напрямую."
-            )
-    else:
+    order_items = [f"- {product['name']} ({quantity} шт.)" for product, quantity, _ in lines]
+    
+    def format_admin_message(order_id: int) -> str:
+        # Формируем красивое сообщение для администратора (Ольги)
+        return (
+            f"🔔 НОВЫЙ ЗАКАЗ №{order_id}! 🔔\n\n"
+            f"👤 Клиент: {customer_name}\n"
+            f"📞 Телефон: {customer_phone}\n\n"
+            f"---\n\n"
+            f"🛒 Состав заказа:\n"
+            f"{chr(10).join(order_items)}\n\n"
+            f"---\n\n"
+            f"💰 Итого: {total_price} руб."
+        )
+    
+    def format_digest_line(order_id: int) -> str:
+        # Короткая запись для сводки нескольких заказов
+        items = ", ".join(f"{product['name']} × {quantity}" for product, quantity, _ in lines)
+        return (
+            f"№{order_id} · {customer_name} · {customer_phone}\n"
+            f"{items}\n"
+            f"💰 {total_price} руб."
+        )
+    
+    # Крупные заказы уходят администратору сразу, остальные - в сводке
+    urgent = settings.ADMIN_URGENT_ORDER_TOTAL is not None and total_price >= settings.ADMIN_URGENT_ORDER_TOTAL
+    digest_delay = settings.ADMIN_DIGEST_WINDOW if settings.ADMIN_DIGEST_WINDOW and not urgent else None
+    
+    if not ADMIN_CHAT_ID:
         logger.warning("ADMIN_CHAT_ID не указан в config.py")
-        
-        # Все равно уведомляем пользователя
+    
+    # Заказ и уведомление администратору записываются одной транзакцией;
+    # само уведомление доставляется в фоне с повторами
+    try:
+        order_id = await asyncio.to_thread(
+            order_ledger.record,
+            update.effective_user.id,
+            customer_name,
+            customer_phone,
+            lines,
+            total_price,
+            notify_chat_id=ADMIN_CHAT_ID,
+            format_notification=format_digest_line if digest_delay else format_admin_message,
+            digest_delay=digest_delay
+        )
+    except OutOfStock as e:
+        # Резерв истек, и товар успели купить другие
+        logger.info(f"Заказ пользователя {update.effective_user.id} не принят: не хватает товаров")
         await update.message.reply_text(
-            "✅ Ваш заказ принят! Мы скоро с вами свяжемся.\n\n"
-            "🕯️ Желаем приятного использования наших свечей!"
+            "😔 Пока вы оформляли заказ, часть товаров закончилась:\n\n"
+            f"{format_shortages(products, e.shortages)}\n\n"
+            "Измените количество в корзине (/cart) и оформите заказ снова."
         )
+        return
+    except Exception as e:
+        logger.error(f"❌ Ошибка при сохранении заказа: {e}")
         
-        # Очищаем корзину пользователя
-        user_data['cart'] = []
-        
-        # Очищаем временные данные
-        if 'customer_name' in user_data:
-            del user_data['customer_name']
-        if 'customer_phone' in user_data:
-            del user_data['customer_phone']
+        # Уведомляем пользователя об ошибке
+        await update.message.reply_text(
+            "❌ Произошла ошибка при обработке вашего заказа. "
+            "Пожалуйста, попробуйте позже или свяжитесь с нами напрямую."
+        )
+        return
+    
+    if ADMIN_CHAT_ID and not digest_delay:
+        outbox_worker.notify()
+    track("order", update.effective_user.id)
+    logger.info(
+        f"✅ Заказ №{order_id} принят, сумма: {total_price} руб.",
+        extra={"event": "order", "order_id": order_id, "user_id": update.effective_user.id,
+               "customer_name": customer_name, "customer_phone": customer_phone, "total": total_price}
+    )
+    
+    # Очищаем корзину пользователя
+    cart.clear()
+    
+    # Очищаем временные данные
+    if 'customer_name' in user_data:
+        del user_data['customer_name']
+    if 'customer_phone' in user_data:
+        del user_data['customer_phone']
+    
+    # Отправляем подтверждение пользователю
+    await update.message.reply_text(
+        f"✅ Спасибо за ваш заказ №{order_id}! Мы скоро с вами свяжемся.\n\n"
+        "🕯️ Желаем приятного использования наших свечей!"
+    )
 
 async def cancel_order(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Отмена оформления заказа"""
+    track("cancel", update.effective_user.id)
     await update.message.reply_text(
         "❌ Оформление заказа отменено.\n\n"
         "Вы можете вернуться к оформлению через команду /cart",
@@ -402,6 +770,9 @@ async def cancel_order(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
     # Очищаем флаг ожидания из старой системы
     context.user_data.pop('awaiting_phone', None)
     
+    # Возвращаем зарезервированные товары
+    await asyncio.to_thread(inventory.release, update.effective_user.id)
+    
     return ConversationHandler.END
 
 async def handle_invalid_input(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -419,6 +790,8 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         "🛍️ <b>Доступные команды:</b>\n\n"
         "/start - Начало работы с ботом\n"
         "/catalog - Показать каталог товаров\n"
+        "/grid - Каталог плиткой, по несколько свечей сразу\n"
+        "/search - Поиск товаров по названию и описанию\n"
         "/cart - Просмотреть корзину\n"
         "/help - Эта справка\n\n"
         "💡 <b>Как оформить заказ:</b>\n"
@@ -431,6 +804,182 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     )
     await update.message.reply_text(help_text, parse_mode='HTML')
 
+def load_admin_stats():
+    """Данные для /admin (выполняется в отдельном потоке)"""
+    return (
+        order_ledger.sales(),
+        order_ledger.top_products(),
+        outbox.pending_count(),
+        outbox.pending_digest_count(ADMIN_CHAT_ID),
+        outbox.failed_count(),
+        outbox.failed(),
+    )
+
+async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Статистика заказов для администратора"""
+    sales, top_products, pending, pending_digest, failed_count, failed = await asyncio.to_thread(load_admin_stats)
+    
+    def period(title: str, row) -> str:
+        orders, items, revenue = row
+        return f"{title}: заказов {orders}, товаров {items}, выручка {revenue} руб."
+    
+    orders, _, revenue = sales['total']
+    lines = [
+        "📊 <b>Статистика магазина</b>\n",
+        period("Сегодня", sales['today']),
+        period("За 7 дней", sales['week']),
+        period("Всего", sales['total']),
+    ]
+    if orders:
+        lines.append(f"Средний чек: {revenue // orders} руб.")
+    if top_products:
+        lines.append("\n🏆 <b>Популярные товары:</b>")
+        for number, (_, name, quantity, product_revenue) in enumerate(top_products, 1):
+            lines.append(f"{number}. {html.escape(name)} - {quantity} шт. ({product_revenue} руб.)")
+    lines.append(f"\n📨 Неотправленных уведомлений: {pending} (ждут сводки: {pending_digest})")
+    if failed_count:
+        lines.append(f"⚠️ <b>Не удалось доставить: {failed_count}</b>, последние:")
+        for message_id, chat_id, order_id, error in failed:
+            about = f"заказ №{order_id}" if order_id else f"сообщение №{message_id}"
+            lines.append(f"• {about}, чат {chat_id}: {html.escape(error or '')}")
+    await update.message.reply_text("\n".join(lines), parse_mode='HTML')
+
+# Ограничения Telegram на длину текста сообщения и подписи к фото
+MAX_BROADCAST_TEXT = 4096
+MAX_BROADCAST_CAPTION = 1024
+
+def parse_broadcast(text: str):
+    """
+    Разбирает текст команды /broadcast [buyers] [item N] текст.
+    
+    Возвращает (аудитория, id товара или None, текст рассылки). Переносы
+    строк в тексте сохраняются.
+    """
+    audience, product_id = "all", None
+    parts = text.split(None, 1)
+    rest = parts[1] if len(parts) > 1 else ""
+    while True:
+        match = re.match(r"(\S+)\s*(.*)", rest, re.S)
+        if not match:
+            break
+        word, tail = match.groups()
+        if word == "buyers":
+            audience = "buyers"
+        elif word == "item":
+            match = re.match(r"(\d+)\s*(.*)", tail, re.S)
+            if not match:
+                break
+            product_id, tail = int(match.group(1)), match.group(2)
+        else:
+            break
+        rest = tail
+    return audience, product_id, rest.strip()
+
+def format_broadcasts(rows) -> str:
+    """Список последних рассылок с прогрессом"""
+    titles = {"active": "идет", "done": "завершена", "cancelled": "отменена"}
+    lines = ["📣 <b>Рассылки</b>\n"]
+    for broadcast_id, created_at, audience, status, total, delivered, failed in rows:
+        lines.append(
+            f"№{broadcast_id} ({time.strftime('%d.%m %H:%M', time.localtime(created_at))}, "
+            f"{'покупатели' if audience == 'buyers' else 'все'}): {titles.get(status, status)}, "
+            f"доставлено {delivered} из {total}, не доставлено {failed}"
+        )
+    if not rows:
+        lines.append("Рассылок еще не было")
+    return "\n".join(lines)
+
+async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Рассылка покупателям (только администратор)"""
+    if context.args and context.args[0] == "status":
+        rows = await asyncio.to_thread(broadcasts.recent)
+        await update.message.reply_text(format_broadcasts(rows), parse_mode='HTML')
+        return
+    if context.args and context.args[0] == "cancel":
+        if len(context.args) < 2 or not context.args[1].isdigit():
+            await update.message.reply_text("Укажите номер рассылки: /broadcast cancel 3")
+            return
+        cancelled = await asyncio.to_thread(broadcasts.cancel, int(context.args[1]))
+        await update.message.reply_text(
+            f"⏹️ Рассылка №{context.args[1]} остановлена" if cancelled
+            else f"Рассылка №{context.args[1]} не найдена или уже завершена"
+        )
+        return
+    
+    audience, product_id, text = parse_broadcast(update.message.text)
+    if not text:
+        await update.message.reply_text(
+            "📣 <b>Рассылка</b>\n\n"
+            "/broadcast текст - всем, кто пользовался ботом\n"
+            "/broadcast buyers текст - только тем, кто оформлял заказ\n"
+            "/broadcast item 5 текст - с карточкой товара №5\n"
+            "/broadcast status - ход рассылок\n"
+            "/broadcast cancel 3 - остановить рассылку №3",
+            parse_mode='HTML'
+        )
+        return
+    if product_id is not None and get_catalog().get(product_id) is None:
+        await update.message.reply_text(f"❌ Товар с ID {product_id} не найден.")
+        return
+    limit = MAX_BROADCAST_CAPTION - 100 if product_id is not None else MAX_BROADCAST_TEXT
+    if len(text) > limit:
+        await update.message.reply_text(f"❌ Текст слишком длинный: {len(text)} символов, можно до {limit}.")
+        return
+    
+    session_user_ids = []
+    if audience == "all":
+        # Сессии из хранилища и те, что еще не сохранены
+        stored = await asyncio.to_thread(context.application.persistence.storage.keys, USER_DATA)
+        session_user_ids = {int(key) for key in stored} | set(context.application.user_data)
+    
+    def create():
+        user_ids = broadcasts.audience(audience, session_user_ids)
+        return broadcasts.create(text, audience, user_ids, product_id), len(user_ids)
+    
+    broadcast_id, total = await asyncio.to_thread(create)
+    broadcast_worker.notify()
+    await update.message.reply_text(
+        f"📣 Рассылка №{broadcast_id} поставлена в очередь, получателей: {total}.\n"
+        f"Ход рассылки - /broadcast status"
+    )
+
+async def send_broadcast(bot, chat_id: int, text: str, product_id: int = None) -> None:
+    """Отправляет сообщение рассылки: текст или карточку товара с текстом"""
+    # Ответы покупателям важнее рассылки (см. TokenBucketRateLimiter)
+    low_priority = {"low_priority": True}
+    product = get_catalog().get(product_id) if product_id is not None else None
+    if product is None:
+        await bot.send_message(chat_id=chat_id, text=text, rate_limit_args=low_priority)
+        return
+    
+    caption = f"{html.escape(text)}\n\n<b>{escape(product['name'])}</b> - {product['price']} руб."
+    keyboard = create_promo_keyboard(product['id'])
+    photo = await load_photo(product)
+    if photo is None:
+        await bot.send_message(
+            chat_id=chat_id, text=caption, parse_mode='HTML', reply_markup=keyboard,
+            rate_limit_args=low_priority
+        )
+        return
+    # Фото загружается один раз, дальше - по file_id
+    send_photo = lambda photo: bot.send_photo(
+        chat_id=chat_id, photo=photo, caption=caption, parse_mode='HTML', reply_markup=keyboard,
+        rate_limit_args=low_priority
+    )
+    try:
+        message = await send_photo(photo)
+    except BadRequest:
+        if not isinstance(photo, str):
+            raise
+        # Устаревший file_id: сбрасываем его и один раз загружаем файл заново,
+        # чтобы получатель не считался недоставленным из-за кэша
+        await forget_photo_on_error(product, photo)
+        photo = await load_photo(product)
+        if photo is None:
+            raise
+        message = await send_photo(photo)
+    await remember_photo(product, message, photo)
+
 async def show_item(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработчик команды /item <номер> - показывает подробную информацию о товаре"""
     if not context.args:
@@ -442,20 +991,24 @@ async def show_item(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     
     try:
         item_id = int(context.args[0])
-        product = next((p for p in PRODUCTS if p['id'] == item_id), None)
+        products = get_catalog()
+        product = products.get(item_id)
         
         if product:
-            caption = create_product_caption(product)
+            caption = products.caption(item_id)
+            track("view", update.effective_user.id, product['id'])
             
+            photo = None
             try:
-                if os.path.exists(product['photo']):
-                    with open(product['photo'], 'rb') as photo_file:
-                        await context.bot.send_photo(
-                            chat_id=update.effective_chat.id,
-                            photo=photo_file,
-                            caption=caption,
-                            parse_mode='HTML'
-                        )
+                photo = await load_photo(product)
+                if photo is not None:
+                    message = await context.bot.send_photo(
+                        chat_id=update.effective_chat.id,
+                        photo=photo,
+                        caption=caption,
+                        parse_mode='HTML'
+                    )
+                    await remember_photo(product, message, photo)
                 else:
                     await update.message.reply_text(
                         f"{caption}\n\n⚠️ Фото временно недоступно",
@@ -463,6 +1016,7 @@ async def show_item(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
                     )
             except Exception as e:
                 logger.error(f"Ошибка при отправке фото товара: {e}")
+                await forget_photo_on_error(product, photo)
                 await update.message.reply_text(
                     f"{caption}\n\n⚠️ Произошла ошибка при загрузке фото",
                     parse_mode='HTML'
@@ -476,7 +1030,10 @@ async def show_item(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработчик обычных сообщений - НЕ для оформления заказа"""
     # Просто логируем сообщение, но не обрабатываем как заказ
-    logger.info(f"Пользователь {update.effective_user.id} отправил: {update.message.text}")
+    logger.info(
+        f"Пользователь {update.effective_user.id} отправил сообщение вне диалога",
+        extra={"event": "message", "user_id": update.effective_user.id, "text": update.message.text}
+    )
     
     # Можно отправить подсказку
     await update.message.reply_text(
@@ -485,7 +1042,14 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработчик ошибок"""
-    logger.error(f"Ошибка при обработке обновления {update}: {context.error}")
+    # Само обновление не пишется в журнал: в нем текст сообщений и телефоны
+    update_id = update.update_id if isinstance(update, Update) else None
+    user = update.effective_user if isinstance(update, Update) else None
+    logger.error(
+        f"Ошибка при обработке обновления {update_id}: {context.error}",
+        exc_info=context.error,
+        extra={"update_id": update_id, "user_id": user.id if user else None}
+    )
     
     if update and update.effective_message:
         try:
@@ -495,10 +1059,221 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         except:
             pass
 
-def main() -> None:
-    """Запуск бота"""
+def start_background(coroutine) -> None:
+    """Запускает задачу в фоне, держа на нее ссылку до завершения"""
+    task = asyncio.create_task(coroutine)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+async def build_images() -> None:
+    """Готовит варианты фото в фоне; до окончания отправляются исходники"""
+    try:
+        built = await asyncio.to_thread(image_store.build, get_catalog().products)
+        logger.info(f"🖼️ Варианты фото готовы, новых: {built}")
+    except Exception as e:
+        logger.error(f"Ошибка при подготовке вариантов фото: {e}")
+
+async def on_catalog_reload(new_catalog) -> None:
+    """Переносит остатки и готовит фото новых товаров после обновления каталога"""
+    await asyncio.to_thread(inventory.sync, new_catalog.products)
+    if settings.BUILD_IMAGES_ON_STARTUP:
+        start_background(build_images())
+
+async def warm_up_catalog() -> None:
+    """Строит поисковый индекс, пока бот уже отвечает на обновления"""
+    try:
+        await asyncio.to_thread(get_catalog().warm_up)
+    except Exception as e:
+        logger.error(f"Ошибка при построении поискового индекса: {e}")
+
+async def post_init(application: Application) -> None:
+    """Запускает фоновые задачи после инициализации бота"""
+    global catalog_watcher
+    startup.timer.mark("инициализация (getMe, хранилище)")
+    outbox_worker.start(application.bot)
+    broadcast_worker.start(application.bot)
+    await asyncio.to_thread(inventory.sync, get_catalog().products)
+    inventory.start()
+    if application.persistence.sessions:
+        application.persistence.sessions.start(application)
+    if settings.CATALOG_PATH:
+        catalog_watcher = CatalogWatcher(
+            settings.CATALOG_PATH,
+            interval=settings.CATALOG_RELOAD_INTERVAL,
+            on_reload=on_catalog_reload
+        )
+        catalog_watcher.start()
+    # Индексы и фото готовятся в фоне, первые обновления их не ждут
+    start_background(warm_up_catalog())
+    if settings.BUILD_IMAGES_ON_STARTUP:
+        start_background(build_images())
+    if settings.BOT_MODE != "webhook" and settings.METRICS_PORT:
+        # В режиме webhook /metrics отдает сервер webhook
+        web_runners.append(await start_metrics_server(settings.METRICS_HOST, settings.METRICS_PORT))
+    startup.timer.mark("фоновые задачи")
+
+async def post_stop(application: Application) -> None:
+    """Останавливает фоновые задачи"""
+    if navigation:
+        await navigation.flush()
+    await outbox_worker.stop()
+    await broadcast_worker.stop()
+    await inventory.stop()
+    if application.persistence.sessions:
+        await application.persistence.sessions.stop()
+    if catalog_watcher:
+        await catalog_watcher.stop()
+    while web_runners:
+        await web_runners.pop().cleanup()
+
+def register_metrics(application: Application) -> None:
+    """Регистрирует метрики, которые вычисляются при запросе /metrics"""
+    metrics.register_callback(
+        "bot_updates", "Очередь и обработка обновлений",
+        lambda: {(name,): value for name, value in update_stats(application).items()},
+        labels=["state"]
+    )
+    metrics.register_callback(
+        "bot_photo_cache_requests_total", "Обращения к кэшу file_id фото",
+        lambda: {("hit",): photo_cache.hits, ("miss",): photo_cache.misses},
+        metric_type="counter", labels=["result"]
+    )
+    metrics.register_callback(
+        "bot_media_cache_requests_total", "Обращения к кэшу прочитанных файлов фото",
+        lambda: {("hit",): media.hits, ("miss",): media.misses},
+        metric_type="counter", labels=["result"]
+    )
+    metrics.register_callback(
+        "bot_media_cache_bytes", "Размер кэша прочитанных файлов фото, байт",
+        lambda: {(): media.size}
+    )
+    metrics.register_callback(
+        "bot_media_cache_evictions_total", "Файлы фото, вытесненные из кэша",
+        lambda: {(): media.evictions},
+        metric_type="counter"
+    )
+    if navigation:
+        metrics.register_callback(
+            "bot_catalog_navigation_total", "Нажатия ⬅️/➡️: всего и пропущенные обновления карточки",
+            lambda: {("scheduled",): navigation.scheduled, ("coalesced",): navigation.coalesced},
+            metric_type="counter", labels=["result"]
+        )
+    metrics.register_callback(
+        "bot_inline_cache_requests_total", "Обращения к кэшу inline-результатов",
+        lambda: {("hit",): inline_results.hits, ("miss",): inline_results.misses},
+        metric_type="counter", labels=["result"]
+    )
+    sessions = application.persistence.sessions
+    if sessions:
+        metrics.register_callback(
+            "bot_sessions_resident", "Сессии (user_data, chat_data) в памяти",
+            lambda: {(kind,): count for kind, (count, _) in sessions.stats(application).items()},
+            labels=["kind"]
+        )
+        metrics.register_callback(
+            "bot_sessions_resident_bytes", "Размер сессий в памяти (pickle) при последней выгрузке, байт",
+            lambda: {(kind,): size for kind, (_, size) in sessions.stats(application).items()},
+            labels=["kind"]
+        )
+        metrics.register_callback(
+            "bot_sessions_evicted_total", "Выгружено простаивающих сессий",
+            lambda: {(): sessions.evicted},
+            metric_type="counter"
+        )
+    metrics.register_callback(
+        "bot_startup_seconds", "Длительность этапов запуска бота",
+        lambda: {(phase,): duration for phase, duration, _ in startup.timer.phases},
+        labels=["phase"]
+    )
+    if events:
+        metrics.register_callback(
+            "bot_analytics_events_total", "События воронки: записанные и отброшенные",
+            lambda: {("recorded",): events.recorded, ("dropped",): events.dropped},
+            metric_type="counter", labels=["result"]
+        )
+    metrics.register_callback(
+        "bot_log_dropped_total", "Записи журнала, отброшенные из-за переполненной очереди",
+        lambda: {(): dropped_count()},
+        metric_type="counter"
+    )
+    metrics.register_callback(
+        "bot_outbox_pending", "Недоставленные сообщения в очереди",
+        lambda: {(): outbox.counts[0]}
+    )
+    metrics.register_callback(
+        "bot_outbox_failed", "Сообщения, которые не удалось доставить",
+        lambda: {(): outbox.counts[1]}
+    )
+
+async def post_shutdown(application: Application) -> None:
+    """Закрывает хранилища после остановки бота"""
+    await asyncio.to_thread(application.persistence.storage.close)
+    await asyncio.to_thread(outbox.close)
+    if events:
+        await asyncio.to_thread(events.close)
+    media.close()
+
+def build_application(token: str = TOKEN, base_url: str = None) -> Application:
+    """
+    Создает приложение со всеми обработчиками.
+    
+    base_url позволяет направить запросы на другой сервер Bot API
+    (например, на fake_bot_api.FakeBotAPI в нагрузочных тестах).
+    """
+    setup_services()
+
+    # Каталог из внешнего файла; дальше его подменяет CatalogWatcher
+    if settings.CATALOG_PATH:
+        set_catalog(load_catalog(settings.CATALOG_PATH, get_catalog()))
+    
+    # Хранилище корзин и состояний диалога переживает перезапуск бота
+    storage = create_storage(
+        settings.STORAGE_BACKEND,
+        settings.STORAGE_PATH,
+        flush_interval=settings.STORAGE_FLUSH_INTERVAL
+    )
+    # Простаивающие сессии выгружаются из памяти и подгружаются по запросу
+    sessions = None
+    if settings.SESSION_IDLE_TTL:
+        sessions = SessionManager(
+            storage,
+            idle_ttl=settings.SESSION_IDLE_TTL,
+            sweep_interval=settings.SESSION_SWEEP_INTERVAL
+        )
+    persistence = StoragePersistence(
+        storage,
+        update_interval=settings.PERSISTENCE_UPDATE_INTERVAL,
+        sessions=sessions
+    )
+    
+    # Один SSL-контекст на оба HTTP-клиента: чтение сертификатов - заметная
+    # часть запуска, а по умолчанию каждый клиент делает это сам
+    ssl_context = httpx.create_ssl_context()
+    
     # Создаем приложение
-    application = Application.builder().token(TOKEN).build()
+    builder = (
+        Application.builder()
+        .token(token)
+        .request(HTTPXRequest(connection_pool_size=256, httpx_kwargs={"verify": ssl_context}))
+        .get_updates_request(HTTPXRequest(connection_pool_size=1, httpx_kwargs={"verify": ssl_context}))
+        .persistence(persistence)
+        .rate_limiter(TokenBucketRateLimiter(
+            overall_rate=settings.API_OVERALL_RATE,
+            private_chat_rate=settings.API_PRIVATE_CHAT_RATE,
+            group_chat_rate=settings.API_GROUP_CHAT_RATE,
+            max_retries=settings.API_MAX_RETRIES,
+            low_priority_reserve=settings.API_LOW_PRIORITY_RESERVE
+        ))
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+    )
+    if base_url:
+        builder = builder.base_url(base_url)
+    if settings.CONCURRENT_UPDATES > 1:
+        # Разные пользователи обслуживаются параллельно, один пользователь - по порядку
+        builder = builder.concurrent_updates(PerUserUpdateProcessor(settings.CONCURRENT_UPDATES))
+    application = builder.build()
     
     # Создаем ConversationHandler для оформления заказа
     order_conversation = ConversationHandler(
@@ -514,20 +1289,33 @@ def main() -> None:
         fallbacks=[
             CommandHandler("cancel", cancel_order),
         ],
+        name="order_conversation",
+        persistent=True,
     )
     
     # Регистрируем обработчики команд
     application.add_handler(order_conversation)  # ВАЖНО: Сначала ConversationHandler!
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("catalog", catalog))
+    application.add_handler(CommandHandler("grid", grid))
     application.add_handler(CommandHandler("cart", cart_command))
     application.add_handler(CommandHandler("help", help_command))
     application.add_handler(CommandHandler("item", show_item))
+    application.add_handler(CommandHandler("search", search_command))
+    application.add_handler(InlineQueryHandler(inline_query))
+    if ADMIN_CHAT_ID:
+        # Статистика доступна только в чате администратора
+        admin_filter = filters.Chat(int(ADMIN_CHAT_ID)) | filters.User(int(ADMIN_CHAT_ID))
+        application.add_handler(CommandHandler("admin", admin_command, filters=admin_filter))
+        application.add_handler(CommandHandler("broadcast", broadcast_command, filters=admin_filter))
     
     # Регистрируем обработчик остальных inline кнопок
     application.add_handler(CallbackQueryHandler(
         handle_callback_query, 
-        pattern=f"^({PREV_BUTTON}|{NEXT_BUTTON}|{ADD_TO_CART_BUTTON}|{CLEAR_CART_BUTTON})$"
+        pattern=(
+            f"^({PREV_BUTTON}|{NEXT_BUTTON}|{ADD_TO_CART_BUTTON}(:\\d+)?|{CLEAR_CART_BUTTON}"
+            f"|({CART_INC_BUTTON}|{CART_DEC_BUTTON}|{CART_DEL_BUTTON}|{SEARCH_ITEM_BUTTON}|{SEARCH_PAGE_BUTTON}|{GRID_PAGE_BUTTON}):\\d+)$"
+        )
     ))
     
     # Регистрируем обработчик обычных сообщений (после всех остальных!)
@@ -536,9 +1324,23 @@ def main() -> None:
     # Обработчик ошибок
     application.add_error_handler(error_handler)
     
+    # Замеры времени и ошибок для всех обработчиков
+    instrument_application(application)
+    register_metrics(application)
+    
+    # Последняя группа: отчет о запуске после первого обработанного обновления
+    application.add_handler(TypeHandler(Update, startup.timer.on_update), group=100)
+    startup.timer.mark("сборка Application")
+    
+    return application
+
+def main() -> None:
+    """Запуск бота"""
+    application = build_application(base_url=settings.BOT_API_URL)
+    
     # Запускаем бота
     print("🕯️ Бот-магазин свечей запущен...")
-    print(f"📦 В каталоге {len(PRODUCTS)} товаров")
+    print(f"📦 В каталоге {len(get_catalog())} товаров")
     print("📞 ConversationHandler для оформления заказа активирован")
     
     if ADMIN_CHAT_ID:
@@ -548,8 +1350,20 @@ def main() -> None:
     
     print("\n✅ Бот готов к работе! Теперь телефон запрашивается только один раз.")
     
-    # ИСПРАВЛЕНО: убрано Update.ALL_UPDATES
-    application.run_polling()
+    if settings.BOT_MODE == "webhook":
+        from webserver import run_webhook
+        startup.timer.mark("сервер webhook (импорт aiohttp)")
+        asyncio.run(run_webhook(
+            application,
+            host=settings.WEBHOOK_HOST,
+            port=settings.WEBHOOK_PORT,
+            path=settings.WEBHOOK_PATH,
+            url=settings.WEBHOOK_URL if settings.WEBHOOK_REGISTER else None,
+            secret_token=settings.WEBHOOK_SECRET
+        ))
+    else:
+        # ИСПРАВЛЕНО: убрано Update.ALL_UPDATES
+        application.run_polling()
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
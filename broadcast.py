@@ -0,0 +1,355 @@
+"""
+Рассылки покупателям: сообщение или карточка товара для многих пользователей.
+
+Рассылка и список получателей записываются в базу заказов одной
+транзакцией; дальше BroadcastWorker отправляет сообщения в фоне с
+ограниченной скоростью и после каждого получателя отмечает результат.
+Поэтому после перезапуска бота рассылка продолжается с того же места,
+а получатели, которым она уже ушла, не получают ее снова.
+"""
+import asyncio
+import logging
+import time
+import uuid
+
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+
+from outbox import Outbox
+from ratelimit import retry_after_seconds
+
+logger = logging.getLogger(__name__)
+
+# Статусы рассылки
+STATUS_ACTIVE = "active"
+STATUS_DONE = "done"
+STATUS_CANCELLED = "cancelled"
+
+# Статусы получателя
+PENDING, DELIVERED, FAILED = 0, 1, 2
+
+
+class Broadcasts:
+    """
+    Рассылки и их получатели в SQLite (в той же базе, что и очередь сообщений).
+
+    Рассылку отправляет один процесс: claim() закрепляет ее за owner на
+    lease секунд, и другие копии бота с той же базой ее не берут. Продлить
+    или снять закрепление может только тот, за кем оно записано.
+    """
+
+    def __init__(self, outbox: Outbox):
+        self.outbox = outbox
+        with outbox.transaction() as conn:
+            conn.executescript(
+                "CREATE TABLE IF NOT EXISTS broadcasts ("
+                " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+                " created_at REAL NOT NULL,"
+                " text TEXT NOT NULL,"
+                " product_id INTEGER,"
+                " audience TEXT NOT NULL,"
+                " status TEXT NOT NULL,"
+                " total INTEGER NOT NULL,"
+                " delivered INTEGER NOT NULL DEFAULT 0,"
+                " failed INTEGER NOT NULL DEFAULT 0,"
+                " finished_at REAL,"
+                " leased_until REAL,"
+                " leased_by TEXT"
+                ");"
+                "CREATE TABLE IF NOT EXISTS broadcast_recipients ("
+                " broadcast_id INTEGER NOT NULL REFERENCES broadcasts (id),"
+                " user_id INTEGER NOT NULL,"
+                " status INTEGER NOT NULL DEFAULT 0,"
+                " error TEXT,"
+                " PRIMARY KEY (broadcast_id, user_id)"
+                ") WITHOUT ROWID;"
+            )
+            # Базы, созданные раньше, не имеют новых колонок
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(broadcasts)")]
+            if 'leased_by' not in columns:
+                conn.execute("ALTER TABLE broadcasts ADD COLUMN leased_by TEXT")
+
+    def audience(self, name: str, session_user_ids=()) -> list:
+        """
+        Получатели: "buyers" - все, кто оформлял заказ, "all" - еще и
+        пользователи с сохраненными сессиями (session_user_ids)
+        """
+        with self.outbox.transaction() as conn:
+            buyers = {row[0] for row in conn.execute(
+                "SELECT DISTINCT user_id FROM orders WHERE user_id IS NOT NULL"
+            )}
+        if name == "buyers":
+            return sorted(buyers)
+        # Личный чат пользователя совпадает с его id
+        return sorted(buyers | {user_id for user_id in session_user_ids if user_id > 0})
+
+    def create(self, text: str, audience: str, user_ids, product_id: int = None) -> int:
+        """Записывает рассылку и ее получателей, возвращает id"""
+        user_ids = list(user_ids)
+        with self.outbox.transaction() as conn:
+            broadcast_id = conn.execute(
+                "INSERT INTO broadcasts (created_at, text, product_id, audience, status, total)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (time.time(), text, product_id, audience, STATUS_ACTIVE, len(user_ids))
+            ).lastrowid
+            conn.executemany(
+                "INSERT INTO broadcast_recipients (broadcast_id, user_id) VALUES (?, ?)",
+                [(broadcast_id, user_id) for user_id in user_ids]
+            )
+        return broadcast_id
+
+    def claim(self, lease: float = 60, owner: str = None):
+        """
+        Берет активную рассылку, не закрепленную за другим процессом:
+        (id, text, product_id) или None
+        """
+        now = time.time()
+        with self.outbox.transaction(immediate=True) as conn:
+            row = conn.execute(
+                "SELECT id, text, product_id FROM broadcasts WHERE status = ?"
+                " AND (leased_until IS NULL OR leased_until < ?) ORDER BY id LIMIT 1",
+                (STATUS_ACTIVE, now)
+            ).fetchone()
+            if row:
+                conn.execute(
+                "UPDATE broadcasts SET leased_until = ?, leased_by = ? WHERE id = ?",
+                (now + lease, owner, row[0])
+            )
+        return row
+
+    def renew(self, broadcast_id: int, owner: str, lease: float = 60) -> bool:
+        """
+        Продлевает закрепление; False, если рассылку отменили или после
+        истечения lease ее взял другой процесс
+        """
+        with self.outbox.transaction() as conn:
+            cursor = conn.execute(
+                "UPDATE broadcasts SET leased_until = ?"
+                " WHERE id = ? AND status = ? AND leased_by = ? AND leased_until IS NOT NULL",
+                (time.time() + lease, broadcast_id, STATUS_ACTIVE, owner)
+            )
+        return cursor.rowcount > 0
+
+    def release(self, broadcast_id: int, owner: str) -> None:
+        """Снимает закрепление, чтобы рассылку можно было сразу взять снова"""
+        with self.outbox.transaction() as conn:
+            conn.execute(
+                "UPDATE broadcasts SET leased_until = NULL WHERE id = ? AND leased_by = ?",
+                (broadcast_id, owner)
+            )
+
+    def pending(self, broadcast_id: int, limit: int = 50) -> list:
+        """Следующие получатели, которым рассылка еще не отправлена"""
+        with self.outbox.transaction() as conn:
+            return [row[0] for row in conn.execute(
+                "SELECT user_id FROM broadcast_recipients WHERE broadcast_id = ? AND status = ?"
+                " ORDER BY user_id LIMIT ?",
+                (broadcast_id, PENDING, limit)
+            )]
+
+    def mark(self, broadcast_id: int, user_id: int, delivered: bool, error: str = None) -> None:
+        """Отмечает результат отправки одному получателю"""
+        with self.outbox.transaction() as conn:
+            cursor = conn.execute(
+                "UPDATE broadcast_recipients SET status = ?, error = ?"
+                " WHERE broadcast_id = ? AND user_id = ? AND status = ?",
+                (DELIVERED if delivered else FAILED, error, broadcast_id, user_id, PENDING)
+            )
+            if cursor.rowcount:
+                column = "delivered" if delivered else "failed"
+                conn.execute(f"UPDATE broadcasts SET {column} = {column} + 1 WHERE id = ?", (broadcast_id,))
+
+    def finish(self, broadcast_id: int, notify_chat_id: int = None) -> None:
+        """Завершает рассылку и ставит отчет администратору в очередь"""
+        with self.outbox.transaction(immediate=True) as conn:
+            cursor = conn.execute(
+                "UPDATE broadcasts SET status = ?, finished_at = ?, leased_until = NULL"
+                " WHERE id = ? AND status = ?",
+                (STATUS_DONE, time.time(), broadcast_id, STATUS_ACTIVE)
+            )
+            if cursor.rowcount and notify_chat_id:
+                total, delivered, failed = conn.execute(
+                    "SELECT total, delivered, failed FROM broadcasts WHERE id = ?", (broadcast_id,)
+                ).fetchone()
+                Outbox.enqueue_in(
+                    conn, notify_chat_id,
+                    f"📣 Рассылка №{broadcast_id} завершена: доставлено {delivered} из {total}, "
+                    f"не доставлено {failed}"
+                )
+
+    def cancel(self, broadcast_id: int) -> bool:
+        """Останавливает рассылку; неотправленные сообщения не уйдут"""
+        with self.outbox.transaction() as conn:
+            cursor = conn.execute(
+                "UPDATE broadcasts SET status = ?, finished_at = ?, leased_until = NULL"
+                " WHERE id = ? AND status = ?",
+                (STATUS_CANCELLED, time.time(), broadcast_id, STATUS_ACTIVE)
+            )
+        return cursor.rowcount > 0
+
+    def recent(self, limit: int = 5) -> list:
+        """Последние рассылки: [(id, created_at, audience, status, total, delivered, failed)]"""
+        with self.outbox.transaction() as conn:
+            return conn.execute(
+                "SELECT id, created_at, audience, status, total, delivered, failed FROM broadcasts"
+                " ORDER BY id DESC LIMIT ?",
+                (limit,)
+            ).fetchall()
+
+
+class BroadcastWorker:
+    """
+    Фоновая отправка рассылок не быстрее rate сообщений в секунду.
+
+    send(bot, chat_id, text, product_id) отправляет одно сообщение; запросы
+    рассылки идут с низким приоритетом (см. TokenBucketRateLimiter), поэтому
+    ответы покупателям их не ждут. Получатель, который заблокировал бота
+    или удалил чат, отмечается как недоставленный; при сетевых ошибках
+    отправка повторяется позже.
+
+    Одно сообщение может ждать долго (резерв для ответов покупателям,
+    паузы RetryAfter), поэтому закрепление рассылки продлевается в
+    отдельной задаче каждые lease / 3 секунд, пока идет отправка. Если
+    продлить не удалось (рассылку отменили или ее взял другой процесс),
+    следующее сообщение уже не отправляется.
+    """
+
+    def __init__(self, broadcasts: Broadcasts, send, rate: float = 10, batch_size: int = 50,
+                 poll_interval: float = 30, lease: float = 60, notify_chat_id: int = None,
+                 on_finished=None, stop_timeout: float = 10):
+        self.broadcasts = broadcasts
+        self.send = send
+        self.interval = 1 / rate
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.lease = lease
+        # Метка процесса в закреплении рассылки
+        self.owner = uuid.uuid4().hex
+        self.notify_chat_id = notify_chat_id
+        # Вызывается после завершения рассылки (например, чтобы сразу отправить отчет)
+        self.on_finished = on_finished
+        self.stop_timeout = stop_timeout
+        self._bot = None
+        self._task = None
+        self._stopping = False
+        self._wakeup = asyncio.Event()
+        # До какого момента (time.monotonic) рассылка точно закреплена за нами
+        self._leased_until = 0.0
+
+    def start(self, bot) -> None:
+        """Запускает отправку"""
+        self._bot = bot
+        self._stopping = False
+        self._task = asyncio.create_task(self._run(), name="broadcast-worker")
+
+    async def stop(self) -> None:
+        """
+        Останавливает отправку (продолжится после запуска).
+
+        Текущее сообщение дописывается и отмечается, чтобы после запуска
+        получатель не получил его второй раз; если оно не успевает за
+        stop_timeout секунд, отправка прерывается.
+        """
+        if self._task:
+            self._stopping = True
+            self._wakeup.set()
+            try:
+                await asyncio.wait_for(self._task, timeout=self.stop_timeout)
+            except asyncio.TimeoutError:
+                logger.warning("Рассылка прервана при остановке, одно сообщение может уйти повторно")
+            self._task = None
+
+    def notify(self) -> None:
+        """Сообщает, что появилась новая рассылка"""
+        self._wakeup.set()
+
+    async def _run(self) -> None:
+        while not self._stopping:
+            self._wakeup.clear()
+            try:
+                claimed = await asyncio.to_thread(self.broadcasts.claim, self.lease, self.owner)
+                if claimed:
+                    await self._deliver(*claimed)
+                    continue
+            except Exception as e:
+                # Например, база занята другим процессом: пробуем снова после паузы
+                logger.error(f"Ошибка при отправке рассылок: {e}")
+
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _keep_lease(self, broadcast_id: int) -> None:
+        """Продлевает закрепление рассылки, пока она отправляется"""
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            started = time.monotonic()
+            try:
+                held = await asyncio.to_thread(self.broadcasts.renew, broadcast_id, self.owner, self.lease)
+            except Exception as e:
+                logger.error(f"Не удалось продлить закрепление рассылки №{broadcast_id}: {e}")
+                continue
+            if not held:
+                self._leased_until = 0.0
+                return
+            self._leased_until = started + self.lease
+
+    def _holds_lease(self, broadcast_id: int) -> bool:
+        if time.monotonic() < self._leased_until:
+            return True
+        logger.info(f"📣 Рассылка №{broadcast_id} отменена или ее отправляет другой процесс")
+        return False
+
+    async def _deliver(self, broadcast_id: int, text: str, product_id: int = None) -> None:
+        """Отправляет рассылку, пока не кончатся получатели"""
+        self._leased_until = time.monotonic() + self.lease
+        heartbeat = asyncio.create_task(self._keep_lease(broadcast_id))
+        try:
+            await self._deliver_batches(broadcast_id, text, product_id)
+        finally:
+            heartbeat.cancel()
+
+    async def _pause(self, broadcast_id: int, seconds: float) -> None:
+        """Отпускает рассылку до следующего прохода"""
+        await asyncio.to_thread(self.broadcasts.release, broadcast_id, self.owner)
+        await asyncio.sleep(seconds)
+
+    async def _deliver_batches(self, broadcast_id: int, text: str, product_id: int = None) -> None:
+        while True:
+            user_ids = await asyncio.to_thread(self.broadcasts.pending, broadcast_id, self.batch_size)
+            if not user_ids:
+                if not self._holds_lease(broadcast_id):
+                    return
+                await asyncio.to_thread(self.broadcasts.finish, broadcast_id, self.notify_chat_id)
+                logger.info(f"📣 Рассылка №{broadcast_id} завершена")
+                if self.on_finished:
+                    self.on_finished()
+                return
+
+            for user_id in user_ids:
+                if self._stopping:
+                    await asyncio.to_thread(self.broadcasts.release, broadcast_id, self.owner)
+                    return
+                if not self._holds_lease(broadcast_id):
+                    return
+                started = time.monotonic()
+                try:
+                    await self.send(self._bot, user_id, text, product_id)
+                except (Forbidden, BadRequest) as e:
+                    # Бот заблокирован или чат не найден - повтор не поможет
+                    await asyncio.to_thread(self.broadcasts.mark, broadcast_id, user_id, False, str(e))
+                except RetryAfter as e:
+                    # Ограничитель уже повторял запрос
+                    logger.warning(f"Рассылка №{broadcast_id} приостановлена: flood control")
+                    await self._pause(broadcast_id, retry_after_seconds(e))
+                    return
+                except NetworkError as e:
+                    logger.warning(f"Рассылка №{broadcast_id} приостановлена: {e}")
+                    await self._pause(broadcast_id, self.poll_interval)
+                    return
+                except Exception as e:
+                    logger.error(f"Ошибка рассылки №{broadcast_id} пользователю {user_id}: {e}")
+                    await asyncio.to_thread(self.broadcasts.mark, broadcast_id, user_id, False, str(e))
+                else:
+                    await asyncio.to_thread(self.broadcasts.mark, broadcast_id, user_id, True)
+                await asyncio.sleep(max(0.0, self.interval - (time.monotonic() - started)))
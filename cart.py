@@ -0,0 +1,114 @@
+class Cart:
+    """
+    Корзина покупателя: id товара -> количество.
+
+    Вместе с позициями хранится общее число товаров, которое обновляется
+    при каждом изменении, поэтому размер корзины не зависит от того,
+    сколько раз покупатель нажал "В корзину".
+    """
+
+    __slots__ = ('_items', '_count')
+
+    # Максимальное количество одного товара в корзине
+    MAX_QUANTITY = 99
+
+    def __init__(self, items=None):
+        self._items = {}
+        self._count = 0
+        for product_id, quantity in (items or {}).items():
+            self.add(product_id, quantity)
+
+    @classmethod
+    def from_list(cls, product_ids) -> 'Cart':
+        """Создает корзину из старого формата - списка id"""
+        cart = cls()
+        for product_id in product_ids:
+            cart.add(product_id)
+        return cart
+
+    def add(self, product_id: int, quantity: int = 1) -> int:
+        """Добавляет товар, возвращает новое количество"""
+        current = self._items.get(product_id, 0)
+        new_quantity = min(current + quantity, self.MAX_QUANTITY)
+        if new_quantity <= 0:
+            self.remove(product_id)
+            return 0
+        self._items[product_id] = new_quantity
+        self._count += new_quantity - current
+        return new_quantity
+
+    def decrement(self, product_id: int) -> int:
+        """Уменьшает количество на 1, возвращает новое количество"""
+        return self.add(product_id, -1)
+
+    def remove(self, product_id: int) -> None:
+        """Удаляет позицию целиком"""
+        self._count -= self._items.pop(product_id, 0)
+
+    def clear(self) -> None:
+        """Очищает корзину"""
+        self._items.clear()
+        self._count = 0
+
+    def quantity(self, product_id: int) -> int:
+        """Количество товара в корзине"""
+        return self._items.get(product_id, 0)
+
+    @property
+    def count(self) -> int:
+        """Общее число товаров в корзине"""
+        return self._count
+
+    def items(self):
+        """Пары (id товара, количество)"""
+        return self._items.items()
+
+    def summarize(self, catalog):
+        """
+        Возвращает (позиции, итог) по текущему каталогу.
+
+        Позиция - кортеж (товар, количество, стоимость). Товары, которых
+        больше нет в каталоге, пропускаются.
+        """
+        lines = []
+        total_price = 0
+        for product_id, quantity in self._items.items():
+            product = catalog.get(product_id)
+            if product:
+                line_total = product['price'] * quantity
+                total_price += line_total
+                lines.append((product, quantity, line_total))
+        return lines, total_price
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def __bool__(self) -> bool:
+        return bool(self._items)
+
+    def __reduce__(self):
+        # Компактная форма для хранилища: (id1, кол-во1, id2, кол-во2, ...)
+        state = []
+        for product_id, quantity in self._items.items():
+            state.append(product_id)
+            state.append(quantity)
+        return _restore_cart, (tuple(state),)
+
+    def __repr__(self) -> str:
+        return f"Cart({self._items!r})"
+
+
+def _restore_cart(state) -> Cart:
+    """Восстанавливает корзину из компактной формы"""
+    return Cart(dict(zip(state[::2], state[1::2])))
+
+
+def get_cart(user_data) -> Cart:
+    """Возвращает корзину пользователя, создавая ее при необходимости"""
+    cart = user_data.get('cart')
+    if isinstance(cart, Cart):
+        return cart
+    # Корзины, сохраненные до появления Cart, были списком id
+    cart = Cart.from_list(cart or [])
+    user_data['cart'] = cart
+    return cart
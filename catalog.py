@@ -0,0 +1,194 @@
+import html
+import threading
+from collections import OrderedDict
+from types import MappingProxyType
+
+from keyboards import create_grid_keyboard, create_product_keyboard
+from products import PRODUCTS
+from search import SearchIndex
+
+
+def escape(text: str) -> str:
+    """Текст из каталога для сообщений с parse_mode='HTML'"""
+    return html.escape(text, quote=False)
+
+
+def render_caption(product, position: int, total: int) -> str:
+    """Создает описание товара"""
+    return (
+        f"<b>{escape(product['name'])}</b>\n\n"
+        f"{escape(product['description'])}\n\n"
+        f"💰 <b>Цена:</b> {product['price']} руб.\n"
+        f"🆔 <b>Код товара:</b> {product['id']}\n"
+        f"📦 Товар {position + 1} из {total}"
+    )
+
+
+def render_grid_text(products, page: int, pages: int) -> str:
+    """Создает список товаров страницы-плитки"""
+    lines = [f"🕯️ <b>Каталог</b>, страница {page + 1} из {pages}\n"]
+    for number, product in enumerate(products, 1):
+        lines.append(f"{number}. <b>{escape(product['name'])}</b> - {product['price']} руб.")
+    lines.append("\nНажмите 🛒 с номером, чтобы добавить свечу в корзину")
+    return "\n".join(lines)
+
+
+class Catalog:
+    """
+    Неизменяемый снимок каталога.
+
+    Индексы и подписи строятся один раз при создании, клавиатуры - при
+    первом показе товара, поэтому поиск товара и отрисовка карточки не
+    зависят от размера каталога. Поисковый индекс строится при первом
+    поиске или заранее в фоне (warm_up) и берется из индекса предыдущего
+    снимка: пересчитываются только изменившиеся товары.
+    """
+
+    # Сколько результатов поиска держать в памяти снимка
+    SEARCH_CACHE_SIZE = 256
+
+    def __init__(self, products, previous: "Catalog" = None):
+        self.products = tuple(MappingProxyType(dict(p)) for p in products)
+        total = len(self.products)
+
+        by_id = {}
+        positions = {}
+        captions = {}
+        for position, product in enumerate(self.products):
+            product_id = product['id']
+            if product_id in by_id:
+                raise ValueError(f"Повторяющийся id товара: {product_id}")
+            by_id[product_id] = product
+            positions[product_id] = position
+            captions[product_id] = render_caption(product, position, total)
+
+        self.by_id = MappingProxyType(by_id)
+        self.positions = MappingProxyType(positions)
+        self.captions = MappingProxyType(captions)
+        # Клавиатуры создаются при первом обращении и дальше переиспользуются
+        self._keyboards = {}
+        # Поисковый индекс (см. search_index) и снимок, из индекса которого
+        # он строится; ссылка на предыдущий снимок сбрасывается после сборки
+        self._search_index = None
+        self._previous = previous
+        self._index_lock = threading.Lock()
+        # Последние результаты поиска: листание страниц не ищет заново
+        self._search_results = OrderedDict()
+        # Готовые страницы плитки: (размер страницы, номер) -> данные страницы
+        self._grid_pages = {}
+
+    @property
+    def search_index(self) -> SearchIndex:
+        """Поисковый индекс; строится при первом обращении"""
+        index = self._search_index
+        if index is None:
+            with self._index_lock:
+                if self._search_index is None:
+                    previous = self._previous._search_index if self._previous is not None else None
+                    if previous is not None:
+                        self._search_index = previous.updated(self.products)
+                    else:
+                        self._search_index = SearchIndex(self.products)
+                    self._previous = None
+                index = self._search_index
+        return index
+
+    def warm_up(self) -> "Catalog":
+        """Строит поисковый индекс заранее (вызывается в отдельном потоке)"""
+        self.search_index
+        return self
+
+    def __len__(self) -> int:
+        return len(self.products)
+
+    def at(self, index: int):
+        """Товар по позиции в каталоге (с прокруткой по кругу)"""
+        return self.products[index % len(self.products)]
+
+    def get(self, product_id):
+        """Товар по id или None"""
+        return self.by_id.get(product_id)
+
+    def position(self, product_id) -> int:
+        """Позиция товара в каталоге (0, если товара нет)"""
+        return self.positions.get(product_id, 0)
+
+    def caption(self, product_id) -> str:
+        """Готовая HTML-подпись товара"""
+        return self.captions[product_id]
+
+    def search(self, text: str = "", category: str = None, min_price: int = None, max_price: int = None):
+        """Товары, подходящие под запрос и фильтры, в порядке каталога"""
+        key = (text, category, min_price, max_price)
+        found = self._search_results.get(key)
+        if found is not None:
+            self._search_results.move_to_end(key)
+            return found
+        found = self._search(text, category, min_price, max_price)
+        self._search_results[key] = found
+        if len(self._search_results) > self.SEARCH_CACHE_SIZE:
+            self._search_results.popitem(last=False)
+        return found
+
+    def _search(self, text, category, min_price, max_price):
+        ids = self.search_index.match(text, category)
+        if ids is None:
+            found = self.products
+        else:
+            found = [self.by_id[product_id] for product_id in sorted(ids, key=self.positions.__getitem__)]
+        if min_price is not None or max_price is not None:
+            low = min_price if min_price is not None else 0
+            high = max_price if max_price is not None else float('inf')
+            found = [product for product in found if low <= product['price'] <= high]
+        return tuple(found)
+
+    def grid_pages(self, page_size: int) -> int:
+        """Число страниц плитки"""
+        return max(1, (len(self.products) + page_size - 1) // page_size)
+
+    def grid_page(self, page: int, page_size: int):
+        """
+        Страница плитки: (номер, товары, текст, клавиатура).
+
+        Номер берется по кругу, страница собирается один раз на снимок.
+        """
+        pages = self.grid_pages(page_size)
+        page %= pages
+        key = (page_size, page)
+        payload = self._grid_pages.get(key)
+        if payload is None:
+            products = self.products[page * page_size:(page + 1) * page_size]
+            payload = self._grid_pages[key] = (
+                page,
+                products,
+                render_grid_text(products, page, pages),
+                create_grid_keyboard(products, page, pages),
+            )
+        return payload
+
+    def keyboard(self, product_id):
+        """Готовая клавиатура товара"""
+        keyboard = self._keyboards.get(product_id)
+        if keyboard is None:
+            if product_id not in self.by_id:
+                raise KeyError(product_id)
+            keyboard = self._keyboards[product_id] = create_product_keyboard(product_id)
+        return keyboard
+
+
+_catalog = Catalog(PRODUCTS)
+
+def get_catalog() -> Catalog:
+    """
+    Текущий снимок каталога.
+
+    Обработчик должен брать снимок один раз и работать с ним до конца:
+    при перезагрузке каталога старый снимок не меняется.
+    """
+    return _catalog
+
+
+def set_catalog(catalog: Catalog) -> None:
+    """Атомарно подменяет текущий снимок каталога"""
+    global _catalog
+    _catalog = catalog
@@ -0,0 +1,222 @@
+import asyncio
+import csv
+import json
+import logging
+import os
+import sqlite3
+import time
+
+from catalog import Catalog, get_catalog, set_catalog
+
+logger = logging.getLogger(__name__)
+
+# Обязательные поля товара и их типы
+REQUIRED_FIELDS = {
+    'id': int,
+    'name': str,
+    'description': str,
+    'price': int,
+    'photo': str,
+}
+
+
+class CatalogError(ValueError):
+    """Файл каталога не прочитан или содержит ошибки"""
+
+
+def _read_json(path: str):
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    # Допускается и просто список, и {"products": [...]}
+    if isinstance(data, dict):
+        data = data.get('products')
+    if not isinstance(data, list):
+        raise CatalogError("В JSON ожидается список товаров или объект с ключом products")
+    return data
+
+
+def _read_csv(path: str):
+    with open(path, 'r', encoding='utf-8-sig', newline='') as f:
+        return list(csv.DictReader(f))
+
+
+def _read_sqlite(path: str):
+    # Только чтение: каталог редактируют другие программы
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        conn.row_factory = sqlite3.Row
+        rows = conn.execute("SELECT * FROM products ORDER BY rowid").fetchall()
+    finally:
+        conn.close()
+    return [dict(row) for row in rows]
+
+
+READERS = {
+    '.json': _read_json,
+    '.csv': _read_csv,
+    '.sqlite': _read_sqlite,
+    '.sqlite3': _read_sqlite,
+    '.db': _read_sqlite,
+}
+
+
+def _to_int(value, number: int, field: str) -> int:
+    """Приводит поле к неотрицательному целому"""
+    # В CSV все значения - строки, в JSON число может прийти как 1200.0
+    if isinstance(value, bool):
+        raise CatalogError(f"Товар №{number}: поле {field} должно быть целым числом")
+    try:
+        converted = int(value)
+    except (TypeError, ValueError):
+        raise CatalogError(f"Товар №{number}: поле {field} должно быть целым числом") from None
+    if converted != value and not isinstance(value, str):
+        raise CatalogError(f"Товар №{number}: поле {field} должно быть целым числом")
+    if converted < 0:
+        raise CatalogError(f"Товар №{number}: поле {field} не может быть отрицательным")
+    return converted
+
+
+def _validate(raw, number: int, base_dir: str) -> dict:
+    """Проверяет и приводит к нужным типам один товар"""
+    if not isinstance(raw, dict):
+        raise CatalogError(f"Товар №{number}: ожидается объект, получено {type(raw).__name__}")
+
+    product = dict(raw)
+    for field, field_type in REQUIRED_FIELDS.items():
+        value = product.get(field)
+        if value is None or value == "":
+            raise CatalogError(f"Товар №{number}: не заполнено поле {field}")
+        if field_type is int:
+            value = _to_int(value, number, field)
+        elif not isinstance(value, str):
+            raise CatalogError(f"Товар №{number}: поле {field} должно быть строкой")
+        else:
+            value = value.strip()
+        product[field] = value
+
+    # Остаток необязателен (нет поля или пустая колонка CSV - без ограничений)
+    stock = product.get('stock')
+    if stock is None or stock == "":
+        product.pop('stock', None)
+    else:
+        product['stock'] = _to_int(stock, number, 'stock')
+
+    # Категория необязательна (пустая колонка CSV - без категории)
+    category = product.get('category')
+    if category is None or category == "":
+        product.pop('category', None)
+    elif not isinstance(category, str):
+        raise CatalogError(f"Товар №{number}: поле category должно быть строкой")
+    else:
+        product['category'] = category.strip()
+
+    # Относительные пути к фото считаются от папки с файлом каталога
+    if not os.path.isabs(product['photo']):
+        product['photo'] = os.path.normpath(os.path.join(base_dir, product['photo']))
+    return product
+
+
+def load_products(path: str):
+    """Читает и проверяет товары из файла JSON, CSV или SQLite"""
+    extension = os.path.splitext(path)[1].lower()
+    reader = READERS.get(extension)
+    if reader is None:
+        raise CatalogError(f"Неизвестный формат каталога: {path}")
+
+    try:
+        rows = reader(path)
+    except CatalogError:
+        raise
+    except (OSError, ValueError, csv.Error, sqlite3.Error) as e:
+        raise CatalogError(f"Не удалось прочитать каталог {path}: {e}") from e
+
+    base_dir = os.path.dirname(os.path.abspath(path))
+    products = [_validate(raw, number, base_dir) for number, raw in enumerate(rows, 1)]
+    if not products:
+        raise CatalogError(f"Каталог {path} пуст")
+    return products
+
+
+def load_catalog(path: str, previous: Catalog = None) -> Catalog:
+    """Строит снимок каталога из файла (previous - для пересчета только изменений)"""
+    products = load_products(path)
+    try:
+        return Catalog(products, previous)
+    except ValueError as e:
+        raise CatalogError(f"Каталог {path}: {e}") from e
+
+
+def file_signature(path: str):
+    """Размер и время изменения файла (и журнала WAL у SQLite)"""
+    signature = []
+    for candidate in (path, f"{path}-wal"):
+        try:
+            stat = os.stat(candidate)
+        except FileNotFoundError:
+            signature.append(None)
+            continue
+        signature.append((stat.st_size, stat.st_mtime_ns))
+    return tuple(signature)
+
+
+class CatalogWatcher:
+    """
+    Следит за файлом каталога и подменяет снимок без перезапуска.
+
+    Раз в interval секунд сравнивает размер и время изменения файла.
+    Новый снимок читается и строится в отдельном потоке, а затем
+    подменяется одной операцией - обработчики, которые уже взяли старый
+    снимок, дорабатывают с ним. Если файл содержит ошибки, остается
+    прежний каталог.
+    """
+
+    def __init__(self, path: str, interval: float = 2.0, on_reload=None):
+        self.path = path
+        self.interval = interval
+        # on_reload(catalog) вызывается после успешной подмены
+        self.on_reload = on_reload
+        self._signature = file_signature(path)
+        self._task = None
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            signature = await asyncio.to_thread(file_signature, self.path)
+            if signature != self._signature:
+                self._signature = signature
+                await self.reload()
+
+    async def reload(self) -> bool:
+        """Перечитывает файл; возвращает True, если каталог подменен"""
+        started = time.perf_counter()
+        previous = get_catalog()
+        try:
+            catalog = await asyncio.to_thread(load_catalog, self.path, previous)
+        except CatalogError as e:
+            logger.error(f"Каталог не обновлен, остается прежний: {e}")
+            return False
+        # Поисковый индекс готовится до подмены, чтобы первый поиск не ждал
+        await asyncio.to_thread(catalog.warm_up)
+
+        set_catalog(catalog)
+        elapsed = (time.perf_counter() - started) * 1000
+        logger.info(f"📦 Каталог обновлен: {len(previous)} -> {len(catalog)} товаров за {elapsed:.0f} мс")
+        if self.on_reload:
+            try:
+                await self.on_reload(catalog)
+            except Exception as e:
+                logger.error(f"Ошибка после обновления каталога: {e}")
+        return True
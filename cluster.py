@@ -0,0 +1,377 @@
+"""
+Горизонтальное масштабирование: несколько процессов бота за одним webhook.
+
+Маршрутизатор принимает обновления от Telegram и по согласованному хэшу
+id пользователя передает их одному из рабочих процессов, поэтому корзина
+и диалог оформления заказа пользователя живут в одном процессе. Рабочие
+процессы - это обычный бот в режиме webhook с общими хранилищем сессий и
+базой заказов; если процесс недоступен, его пользователи временно
+обслуживаются следующим по кольцу, который подгружает их сессии из
+хранилища. При каждом изменении кольца (процесс выпал или вернулся)
+маршрутизатор ненадолго останавливает пересылку и просит процессы
+перечитать сессии и состояния диалогов (webserver.RELOAD_PATH), чтобы
+ни один процесс не продолжил работу со старой копией корзины.
+
+Локально: python cluster.py --workers 4.
+Рабочие процессы в отдельных контейнерах: python bot.py с BOT_MODE = "webhook"
+и WEBHOOK_REGISTER = False, а маршрутизатору передаются их адреса
+(CLUSTER_WORKER_URLS или --worker-urls).
+"""
+import argparse
+import asyncio
+import bisect
+import hashlib
+import hmac
+import json
+import logging
+import multiprocessing
+import secrets
+import signal
+import time
+
+import aiohttp
+from aiohttp import web
+
+import settings
+from logs import setup_logging
+from webserver import RELOAD_PATH, SECRET_HEADER
+
+logger = logging.getLogger(__name__)
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    """Согласованное хэширование: при выпадении узла переезжают только его ключи"""
+
+    def __init__(self, nodes, replicas: int = 100):
+        self.nodes = list(nodes)
+        points = sorted(
+            (_hash(f"{node}#{replica}"), node)
+            for node in self.nodes for replica in range(replicas)
+        )
+        self._hashes = [point for point, _ in points]
+        self._owners = [node for _, node in points]
+
+    def nodes_for(self, key):
+        """Узлы в порядке обхода кольца от ключа: первый - владелец, дальше - запасные"""
+        start = bisect.bisect(self._hashes, _hash(str(key)))
+        seen = []
+        for i in range(len(self._owners)):
+            node = self._owners[(start + i) % len(self._owners)]
+            if node not in seen:
+                seen.append(node)
+                if len(seen) == len(self.nodes):
+                    break
+        return seen
+
+
+def routing_key(data: dict):
+    """id пользователя из JSON обновления (или чата, если пользователя нет)"""
+    for value in data.values():
+        if not isinstance(value, dict):
+            continue
+        for field in ("from", "user", "chat"):
+            owner = value.get(field)
+            if isinstance(owner, dict) and "id" in owner:
+                return owner["id"]
+    return data.get("update_id", 0)
+
+
+class Router:
+    """
+    Принимает обновления от Telegram и пересылает их рабочим процессам.
+
+    Рабочий процесс, который не ответил или ответил 5xx, считается
+    недоступным: его обновления уходят следующему по кольцу, пока
+    проверка /healthz не покажет, что он снова работает.
+
+    Изменения, которые выпавший процесс не успел сохранить в хранилище
+    (PERSISTENCE_UPDATE_INTERVAL), теряются.
+    """
+
+    def __init__(self, worker_urls, worker_secret: str = None, secret_token: str = None,
+                 health_interval: float = 2.0, timeout: float = 10.0):
+        self.worker_urls = list(worker_urls)
+        self.worker_secret = worker_secret
+        self.secret_token = secret_token
+        self.health_interval = health_interval
+        self.timeout = timeout
+        self.ring = HashRing(range(len(self.worker_urls)))
+        self.down = set()
+        # Сколько обновлений передано каждому процессу
+        self.forwarded = [0] * len(self.worker_urls)
+        self._session = None
+        self._health_task = None
+        # Сброшено, пока процессы перечитывают сессии после изменения кольца
+        self._stable = asyncio.Event()
+        self._stable.set()
+        self._rebalance_lock = asyncio.Lock()
+
+    def _url(self, index: int, path: str) -> str:
+        base = self.worker_urls[index].split("://", 1)
+        host = base[1].split("/", 1)[0]
+        return f"{base[0]}://{host}{path}"
+
+    def _headers(self) -> dict:
+        headers = {"Content-Type": "application/json"}
+        if self.worker_secret:
+            headers[SECRET_HEADER] = self.worker_secret
+        return headers
+
+    async def _forward(self, index: int, body: bytes):
+        async with self._session.post(self.worker_urls[index], data=body, headers=self._headers()) as response:
+            return response.status
+
+    async def _reload(self, index: int, save: bool) -> bool:
+        """Просит процесс перечитать сессии из хранилища"""
+        body = json.dumps({"save": save}).encode()
+        try:
+            async with self._session.post(self._url(index, RELOAD_PATH), data=body,
+                                          headers=self._headers()) as response:
+                if response.status == 200:
+                    return True
+                logger.warning(f"Процесс {index} не перечитал сессии: ответ {response.status}")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.warning(f"Процесс {index} не перечитал сессии: {e!r}")
+        return False
+
+    async def _rebalance(self, returning: int = None) -> bool:
+        """
+        Перераспределяет пользователей после изменения кольца.
+
+        Пока процессы сохраняют и перечитывают сессии, обновления не
+        пересылаются. Вернувшийся процесс returning отбрасывает данные
+        в памяти, не сохраняя: пока он был недоступен, его пользователей
+        обслуживал другой процесс. Возвращает, включен ли returning в кольцо.
+        """
+        async with self._rebalance_lock:
+            self._stable.clear()
+            try:
+                others = [
+                    index for index in range(len(self.worker_urls))
+                    if index not in self.down and index != returning
+                ]
+                await asyncio.gather(*(self._reload(index, save=True) for index in others))
+                if returning is None:
+                    return True
+                if not await self._reload(returning, save=False):
+                    return False
+                self.down.discard(returning)
+                return True
+            finally:
+                self._stable.set()
+
+    async def _mark_down(self, index: int) -> None:
+        """Исключает процесс из кольца"""
+        if index in self.down:
+            return
+        self.down.add(index)
+        await self._rebalance()
+
+    async def handle_update(self, request: web.Request) -> web.Response:
+        if self.secret_token is not None:
+            received = request.headers.get(SECRET_HEADER, "")
+            if not hmac.compare_digest(received, self.secret_token):
+                logger.warning(f"Запрос к webhook с неверным секретом от {request.remote}")
+                return web.Response(status=403)
+
+        body = await request.read()
+        try:
+            key = routing_key(json.loads(body))
+        except (ValueError, AttributeError) as e:
+            logger.error(f"Некорректное обновление в webhook: {e}")
+            return web.Response(status=400)
+
+        for index in self.ring.nodes_for(key):
+            await self._stable.wait()
+            if index in self.down:
+                continue
+            try:
+                status = await self._forward(index, body)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.warning(f"Процесс {index} недоступен: {e!r}")
+                await self._mark_down(index)
+                continue
+            if status >= 500:
+                logger.warning(f"Процесс {index} ответил {status}")
+                await self._mark_down(index)
+                continue
+            self.forwarded[index] += 1
+            return web.Response(status=status)
+
+        # Все процессы недоступны: Telegram повторит доставку позже
+        return web.Response(status=503)
+
+    async def healthz(self, request: web.Request) -> web.Response:
+        workers = [
+            {"url": url, "up": index not in self.down, "forwarded": self.forwarded[index]}
+            for index, url in enumerate(self.worker_urls)
+        ]
+        status = 200 if len(self.down) < len(self.worker_urls) else 503
+        return web.json_response({"workers": workers}, status=status)
+
+    def create_app(self, path: str) -> web.Application:
+        web_app = web.Application()
+        web_app.router.add_post(path, self.handle_update)
+        web_app.router.add_get("/healthz", self.healthz)
+        web_app.on_startup.append(self._on_startup)
+        web_app.on_cleanup.append(self._on_cleanup)
+        return web_app
+
+    async def _on_startup(self, web_app) -> None:
+        self._session = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+            connector=aiohttp.TCPConnector(limit=0)
+        )
+        self._health_task = asyncio.create_task(self._health_loop())
+
+    async def _on_cleanup(self, web_app) -> None:
+        self._health_task.cancel()
+        try:
+            await self._health_task
+        except asyncio.CancelledError:
+            pass
+        await self._session.close()
+
+    async def _check(self, index: int) -> bool:
+        try:
+            async with self._session.get(self._url(index, "/healthz")) as response:
+                return response.status == 200
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            return False
+
+    async def _health_loop(self) -> None:
+        while True:
+            results = await asyncio.gather(*(self._check(i) for i in range(len(self.worker_urls))))
+            for index, healthy in enumerate(results):
+                if healthy and index in self.down:
+                    if await self._rebalance(returning=index):
+                        logger.info(f"Процесс {index} снова доступен")
+                elif not healthy and index not in self.down:
+                    logger.warning(f"Процесс {index} не прошел проверку /healthz")
+                    await self._mark_down(index)
+            await asyncio.sleep(self.health_interval)
+
+
+def run_worker(index: int, port: int, worker_secret: str) -> None:
+    """Рабочий процесс: бот в режиме webhook на локальном порту"""
+    from webserver import run_webhook
+
+    settings.BOT_MODE = "webhook"
+    # Варианты фото собирает только первый процесс, чтобы не делать это N раз
+    settings.BUILD_IMAGES_ON_STARTUP = settings.BUILD_IMAGES_ON_STARTUP and index == 0
+
+    import bot
+    application = bot.build_application(base_url=settings.BOT_API_URL)
+    logger.info(f"Рабочий процесс {index} запущен на порту {port}")
+    asyncio.run(run_webhook(
+        application,
+        host=settings.CLUSTER_HOST,
+        port=port,
+        path=settings.WEBHOOK_PATH,
+        secret_token=worker_secret
+    ))
+
+
+async def register_webhook(url: str, secret_token: str = None) -> None:
+    """Регистрирует адрес маршрутизатора в Telegram"""
+    from telegram import Bot, Update
+    from config import TOKEN
+
+    kwargs = {"base_url": settings.BOT_API_URL} if settings.BOT_API_URL else {}
+    async with Bot(TOKEN, **kwargs) as telegram_bot:
+        await telegram_bot.set_webhook(url=url, secret_token=secret_token, allowed_updates=Update.ALL_TYPES)
+    logger.info(f"Webhook зарегистрирован: {url}")
+
+
+async def run_cluster(workers: int = None, worker_urls=None) -> None:
+    """
+    Запускает маршрутизатор и (если не переданы worker_urls) workers
+    рабочих процессов, перезапуская упавшие.
+    """
+    processes = {}
+    context = multiprocessing.get_context("spawn")
+    worker_secret = settings.CLUSTER_SECRET
+
+    if not worker_urls:
+        worker_secret = worker_secret or secrets.token_urlsafe(32)
+        ports = [settings.CLUSTER_WORKER_PORT + i for i in range(workers)]
+        worker_urls = [f"http://{settings.CLUSTER_HOST}:{port}{settings.WEBHOOK_PATH}" for port in ports]
+
+        def spawn(index: int):
+            process = context.Process(
+                target=run_worker, args=(index, ports[index], worker_secret), name=f"bot-worker-{index}"
+            )
+            process.start()
+            processes[index] = process
+
+        for index in range(workers):
+            spawn(index)
+
+    router = Router(
+        worker_urls,
+        worker_secret=worker_secret,
+        secret_token=settings.WEBHOOK_SECRET,
+        health_interval=settings.CLUSTER_HEALTH_INTERVAL
+    )
+    runner = web.AppRunner(router.create_app(settings.WEBHOOK_PATH), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, settings.WEBHOOK_HOST, settings.WEBHOOK_PORT).start()
+    logger.info(f"Маршрутизатор слушает {settings.WEBHOOK_HOST}:{settings.WEBHOOK_PORT}{settings.WEBHOOK_PATH}, "
+                f"процессов: {len(worker_urls)}")
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:
+            pass
+
+    try:
+        if settings.WEBHOOK_URL and settings.WEBHOOK_REGISTER:
+            await register_webhook(settings.WEBHOOK_URL, settings.WEBHOOK_SECRET)
+        while not stop_event.is_set():
+            try:
+                await asyncio.wait_for(stop_event.wait(), timeout=1)
+            except asyncio.TimeoutError:
+                pass
+            for index, process in list(processes.items()):
+                if not process.is_alive() and not stop_event.is_set():
+                    logger.error(f"Рабочий процесс {index} завершился (код {process.exitcode}), перезапуск")
+                    spawn(index)
+    finally:
+        await runner.cleanup()
+        for process in processes.values():
+            process.terminate()
+        deadline = time.monotonic() + 15
+        for process in processes.values():
+            await asyncio.to_thread(process.join, max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                process.kill()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Бот в нескольких процессах за одним webhook")
+    parser.add_argument("--workers", type=int, default=settings.CLUSTER_WORKERS, help="число рабочих процессов")
+    parser.add_argument("--worker-urls", default=None,
+                        help="адреса уже запущенных рабочих процессов через запятую (процессы не создаются)")
+    args = parser.parse_args()
+
+    setup_logging(
+        level=settings.LOG_LEVEL,
+        log_format=settings.LOG_FORMAT,
+        levels=settings.LOG_LEVELS,
+        sample_rates=settings.LOG_SAMPLE_RATES,
+        redact_fields=settings.LOG_REDACT_FIELDS,
+        queue_size=settings.LOG_QUEUE_SIZE
+    )
+    worker_urls = args.worker_urls.split(",") if args.worker_urls else settings.CLUSTER_WORKER_URLS
+    asyncio.run(run_cluster(args.workers, worker_urls))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+import asyncio
+import logging
+from collections import deque
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+logger = logging.getLogger(__name__)
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """
+    Параллельная обработка обновлений с сохранением порядка для каждого пользователя.
+
+    Обновления разных пользователей обрабатываются одновременно (не больше
+    max_concurrent_updates), а обновления одного пользователя - строго
+    по очереди. Если у пользователя уже есть обновление в работе, новое
+    встает в его личную очередь и не занимает общий слот, поэтому частые
+    нажатия одного покупателя не задерживают остальных.
+    """
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        # ключ пользователя -> очередь ожидающих корутин
+        self._queues = {}
+        self._in_flight = 0
+        self._waiting = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    @staticmethod
+    def _ordering_key(update):
+        """Ключ, внутри которого обновления выполняются по порядку"""
+        if not isinstance(update, Update):
+            return None
+        if update.effective_user:
+            return ('user', update.effective_user.id)
+        if update.effective_chat:
+            return ('chat', update.effective_chat.id)
+        return None
+
+    async def do_process_update(self, update, coroutine) -> None:
+        key = self._ordering_key(update)
+        if key is None:
+            await self._run(coroutine)
+            return
+
+        pending = self._queues.get(key)
+        if pending is not None:
+            # Обновление этого пользователя уже выполняется - встаем за ним
+            pending.append(coroutine)
+            self._waiting += 1
+            return
+
+        pending = self._queues[key] = deque()
+        self._idle.clear()
+        try:
+            await self._run(coroutine)
+            while pending:
+                coroutine = pending.popleft()
+                self._waiting -= 1
+                await self._run(coroutine)
+        finally:
+            del self._queues[key]
+            if not self._queues:
+                self._idle.set()
+
+    async def _run(self, coroutine) -> None:
+        self._in_flight += 1
+        try:
+            await coroutine
+        except Exception as e:
+            # Ошибка одного обновления не должна терять очередь пользователя
+            logger.error(f"Ошибка при обработке обновления: {e}")
+        finally:
+            self._in_flight -= 1
+
+    def stats(self) -> dict:
+        """Текущая загрузка: в работе, в очередях пользователей, активных пользователей"""
+        return {
+            'max_concurrent_updates': self.max_concurrent_updates,
+            'in_flight': self._in_flight,
+            'waiting': self._waiting,
+            'active_users': len(self._queues),
+        }
+
+    async def initialize(self) -> None:
+        pass
+
+    async def wait_idle(self) -> None:
+        """Ждет, пока не останется обновлений в работе и в очередях пользователей"""
+        await self._idle.wait()
+
+    async def shutdown(self) -> None:
+        # Дожидаемся обновлений, которые уже стоят в очередях пользователей
+        await self.wait_idle()
+
+
+def update_stats(application) -> dict:
+    """Глубина очереди обновлений и загрузка обработчика для мониторинга"""
+    stats = {'update_queue': application.update_queue.qsize()}
+    processor = application.update_processor
+    if isinstance(processor, PerUserUpdateProcessor):
+        stats.update(processor.stats())
+    else:
+        stats['max_concurrent_updates'] = processor.max_concurrent_updates
+        stats['in_flight'] = processor.current_concurrent_updates
+    return stats
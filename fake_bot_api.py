@@ -0,0 +1,159 @@
+import asyncio
+import itertools
+import json
+import random
+import time
+from collections import Counter
+
+from aiohttp import web
+
+# Пользователь-бот, которого возвращает getMe
+BOT_USER = {
+    "id": 1000000,
+    "is_bot": True,
+    "first_name": "Тепло",
+    "username": "teplo_test_bot",
+    "can_join_groups": True,
+    "can_read_all_group_messages": False,
+    "supports_inline_queries": True,
+}
+
+
+class FakeBotAPI:
+    """
+    Локальная имитация Bot API для нагрузочных тестов.
+
+    Отвечает на основные методы, которые вызывает бот, записывает каждый
+    вызов и умеет добавлять задержку и ошибки RetryAfter (HTTP 429).
+    Бот подключается к ней через base_url вида http://host:port/bot.
+    """
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0,
+                 retry_after_rate: float = 0.0, retry_after: int = 1):
+        self.latency = latency
+        self.jitter = jitter
+        self.retry_after_rate = retry_after_rate
+        self.retry_after = retry_after
+        # (метод, время ответа) для каждого вызова
+        self.calls = []
+        self.counts = Counter()
+        self._message_ids = itertools.count(1)
+        self._file_ids = itertools.count(1)
+        self._runner = None
+
+    def create_app(self) -> web.Application:
+        app = web.Application(client_max_size=50 * 1024 * 1024)
+        app.router.add_post("/bot{token}/{method}", self._handle)
+        app.router.add_get("/bot{token}/{method}", self._handle)
+        app.router.add_get("/stats", self._stats)
+        return app
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        """Запускает сервер, возвращает base_url для Application"""
+        self._runner = web.AppRunner(self.create_app())
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = self._runner.addresses[0][1]
+        return f"http://{host}:{port}/bot"
+
+    async def stop(self) -> None:
+        if self._runner:
+            await self._runner.cleanup()
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        started = time.perf_counter()
+        method = request.match_info["method"]
+        params = await self._read_params(request)
+
+        delay = self.latency + random.uniform(0, self.jitter)
+        if delay:
+            await asyncio.sleep(delay)
+
+        self.counts[method] += 1
+        if self.retry_after_rate and random.random() < self.retry_after_rate:
+            self.counts["429"] += 1
+            return web.json_response({
+                "ok": False,
+                "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after},
+            }, status=429)
+
+        result = self._result(method, params)
+        self.calls.append((method, time.perf_counter() - started))
+        return web.json_response({"ok": True, "result": result})
+
+    async def _stats(self, request: web.Request) -> web.Response:
+        """Число вызовов по методам (для проверки бота в другом процессе)"""
+        return web.json_response(dict(self.counts))
+
+    @staticmethod
+    async def _read_params(request: web.Request) -> dict:
+        if request.content_type == "application/json":
+            return await request.json()
+        params = {}
+        for key, value in (await request.post()).items():
+            if isinstance(value, str):
+                try:
+                    value = json.loads(value)
+                except ValueError:
+                    pass
+            params[key] = value
+        return params
+
+    def _message(self, params: dict, **extra) -> dict:
+        chat_id = params.get("chat_id", 1)
+        message = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private" if int(chat_id) > 0 else "group"},
+            "from": BOT_USER,
+        }
+        if "text" in params:
+            message["text"] = params["text"]
+        if "caption" in params:
+            message["caption"] = params["caption"]
+        message.update(extra)
+        return message
+
+    def _photo(self) -> list:
+        number = next(self._file_ids)
+        return [
+            {"file_id": f"fake-photo-{number}-s", "file_unique_id": f"u{number}s", "width": 90, "height": 90},
+            {"file_id": f"fake-photo-{number}", "file_unique_id": f"u{number}", "width": 1280, "height": 1280},
+        ]
+
+    def _result(self, method: str, params: dict):
+        method = method.lower()
+        if method == "getme":
+            return BOT_USER
+        if method == "getupdates":
+            return []
+        if method in ("sendphoto", "editmessagemedia"):
+            return self._message(params, photo=self._photo())
+        if method == "sendmediagroup":
+            media = params.get("media") or []
+            return [self._message(params, photo=self._photo()) for _ in media]
+        if method in ("sendmessage", "editmessagetext", "editmessagecaption", "editmessagereplymarkup"):
+            return self._message(params)
+        return True
+
+
+if __name__ == "__main__":
+    # Отдельный процесс: python fake_bot_api.py --port 8081 --latency 0.02
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Локальная имитация Bot API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--retry-after-rate", type=float, default=0.0)
+    parser.add_argument("--retry-after", type=int, default=1)
+    args = parser.parse_args()
+
+    api = FakeBotAPI(latency=args.latency, jitter=args.jitter,
+                     retry_after_rate=args.retry_after_rate, retry_after=args.retry_after)
+    print(f"Fake Bot API: http://{args.host}:{args.port}/bot")
+    web.run_app(api.create_app(), host=args.host, port=args.port, print=None, access_log=None)
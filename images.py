@@ -0,0 +1,134 @@
+import hashlib
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from photo_cache import file_hash
+
+logger = logging.getLogger(__name__)
+
+# Варианты фото: имя -> (максимальная сторона в пикселях, качество)
+# card - карточка товара в каталоге, thumb - миниатюра для сетки и списков
+VARIANTS = {
+    "card": (1280, 82),
+    "thumb": (320, 75),
+}
+
+# Расширения файлов для поддерживаемых форматов
+EXTENSIONS = {
+    "JPEG": "jpg",
+    "WEBP": "webp",
+}
+
+
+def variant_name(source_hash: str, variant: str, image_format: str) -> str:
+    """
+    Имя файла варианта.
+
+    Имя зависит от содержимого исходника и параметров варианта, поэтому
+    измененное фото или новые настройки дают новый файл, а старый просто
+    перестает использоваться.
+    """
+    max_side, quality = VARIANTS[variant]
+    spec = hashlib.sha256(f"{variant}:{max_side}:{quality}:{image_format}".encode()).hexdigest()
+    return f"{source_hash[:16]}-{variant}-{spec[:8]}.{EXTENSIONS[image_format]}"
+
+
+def render_variant(source_path: str, target_path: str, variant: str, image_format: str) -> str:
+    """Создает вариант фото (выполняется в отдельном процессе)"""
+    # Pillow нужен только процессам сборки, бот его не импортирует
+    from PIL import Image, ImageOps
+
+    max_side, quality = VARIANTS[variant]
+    with Image.open(source_path) as image:
+        image = ImageOps.exif_transpose(image)
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        image.thumbnail((max_side, max_side), Image.LANCZOS)
+
+        tmp_path = f"{target_path}.tmp"
+        if image_format == "JPEG":
+            image.save(tmp_path, "JPEG", quality=quality, optimize=True, progressive=True)
+        else:
+            image.save(tmp_path, image_format, quality=quality, method=6)
+    os.replace(tmp_path, target_path)
+    return target_path
+
+
+class ImageStore:
+    """
+    Готовые уменьшенные варианты фото товаров.
+
+    Пока вариант не построен, path() возвращает исходное фото, поэтому
+    бот может работать, не дожидаясь окончания сборки.
+    """
+
+    def __init__(self, cache_dir: str, image_format: str = "JPEG", workers: int = None):
+        if image_format not in EXTENSIONS:
+            raise ValueError(f"Неподдерживаемый формат фото: {image_format}")
+        self.cache_dir = cache_dir
+        self.image_format = image_format
+        self.workers = workers
+        # (исходный файл, вариант) -> готовый файл
+        self._paths = {}
+
+    def path(self, product, variant: str) -> str:
+        """Путь к фото товара в нужном варианте"""
+        return self._paths.get((product['photo'], variant), product['photo'])
+
+    def build(self, products) -> int:
+        """Строит недостающие варианты для всех товаров, возвращает число новых файлов"""
+        os.makedirs(self.cache_dir, exist_ok=True)
+        ready = {}
+        jobs = []
+        for source_path in {product['photo'] for product in products}:
+            if not os.path.exists(source_path):
+                continue
+            source_hash = file_hash(source_path)
+            for variant in VARIANTS:
+                target_path = os.path.join(
+                    self.cache_dir, variant_name(source_hash, variant, self.image_format)
+                )
+                if os.path.exists(target_path):
+                    ready[(source_path, variant)] = target_path
+                else:
+                    jobs.append((source_path, target_path, variant))
+
+        if jobs:
+            # Сборка запускается из потока работающего бота: fork скопировал бы
+            # в процессы блокировки, занятые его фоновыми потоками. При spawn
+            # процесс заново импортирует главный модуль, поэтому bot.py при
+            # импорте ничего не создает (см. setup_services)
+            context = multiprocessing.get_context("spawn")
+            with ProcessPoolExecutor(max_workers=self.workers, mp_context=context) as pool:
+                futures = {
+                    pool.submit(render_variant, source_path, target_path, variant, self.image_format):
+                        (source_path, variant)
+                    for source_path, target_path, variant in jobs
+                }
+                for future, key in futures.items():
+                    try:
+                        ready[key] = future.result()
+                    except Exception as e:
+                        logger.error(f"Не удалось подготовить фото {key[0]} ({key[1]}): {e}")
+
+        # Если исходник и так меньше варианта, отправляем исходник
+        for (source_path, variant), target_path in list(ready.items()):
+            if os.path.getsize(target_path) >= os.path.getsize(source_path):
+                ready[(source_path, variant)] = source_path
+
+        # Подменяем карту целиком, чтобы обработчики не видели ее наполовину собранной
+        self._paths = ready
+        return len(jobs)
+
+
+if __name__ == "__main__":
+    # Офлайн-сборка вариантов: python images.py
+    logging.basicConfig(level=logging.INFO)
+    import settings
+    from products import PRODUCTS
+
+    store = ImageStore(settings.IMAGE_CACHE_DIR, settings.IMAGE_FORMAT, settings.IMAGE_WORKERS)
+    built = store.build(PRODUCTS)
+    print(f"🖼️ Подготовлено новых вариантов фото: {built}")
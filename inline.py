@@ -0,0 +1,80 @@
+from collections import OrderedDict
+
+from telegram import InlineQueryResultArticle, InlineQueryResultCachedPhoto, InputTextMessageContent
+
+from search import normalize, parse_query
+
+
+def normalize_query(text: str) -> str:
+    """Запрос без лишних пробелов, в нижнем регистре"""
+    return " ".join(normalize(text).split())
+
+
+class InlineResults:
+    """
+    Результаты inline-режима (@бот запрос) с кэшем LRU.
+
+    Ключ кэша - нормализованный запрос и смещение страницы, поэтому
+    популярные запросы отдаются без поиска и сборки результатов. Запись
+    устаревает при подмене снимка каталога и при появлении новых file_id
+    фото (photo_version): товар, который был текстовым результатом, после
+    первой загрузки фото показывается с фото.
+    """
+
+    def __init__(self, photo_file_id, photo_version, page_size: int = 20, max_size: int = 1024):
+        # photo_file_id(product) -> file_id или None
+        self.photo_file_id = photo_file_id
+        # photo_version() -> число, которое меняется при изменении кэша фото
+        self.photo_version = photo_version
+        self.page_size = page_size
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, catalog, query: str, offset: str = ""):
+        """Возвращает (результаты, next_offset) для ответа на InlineQuery"""
+        key = (normalize_query(query), offset)
+        version = self.photo_version()
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] is catalog and entry[1] == version:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[2], entry[3]
+
+        self.misses += 1
+        results, next_offset = self._build(catalog, key[0], offset)
+        self._entries[key] = (catalog, version, results, next_offset)
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+        return results, next_offset
+
+    def _build(self, catalog, query: str, offset: str):
+        start = int(offset) if offset.isdigit() else 0
+        found = catalog.search(*parse_query(query))
+        page = found[start:start + self.page_size]
+        next_offset = str(start + self.page_size) if start + self.page_size < len(found) else ""
+        return [self._result(catalog, product) for product in page], next_offset
+
+    def _result(self, catalog, product):
+        product_id = product['id']
+        caption = catalog.caption(product_id)
+        description = f"{product['price']} руб."
+        file_id = self.photo_file_id(product)
+        if file_id:
+            return InlineQueryResultCachedPhoto(
+                id=str(product_id),
+                photo_file_id=file_id,
+                title=product['name'],
+                description=description,
+                caption=caption,
+                parse_mode='HTML',
+            )
+        # Фото еще ни разу не загружалось - file_id нет, отправляем текст
+        return InlineQueryResultArticle(
+            id=str(product_id),
+            title=product['name'],
+            description=description,
+            input_message_content=InputTextMessageContent(caption, parse_mode='HTML'),
+        )
@@ -0,0 +1,203 @@
+import asyncio
+import logging
+import time
+from types import MappingProxyType
+
+from outbox import Outbox
+
+logger = logging.getLogger(__name__)
+
+
+class OutOfStock(Exception):
+    """Товара не хватает; shortages - {id товара: сколько можно купить}"""
+
+    def __init__(self, shortages: dict):
+        super().__init__(f"Не хватает товаров: {shortages}")
+        self.shortages = shortages
+
+
+class Inventory:
+    """
+    Остатки товаров и резервы на время оформления заказа.
+
+    Таблицы лежат в базе заказов, поэтому списание остатков идет в одной
+    транзакции с записью заказа. Резерв и списание выполняются под
+    блокировкой записи SQLite (BEGIN IMMEDIATE), поэтому остаток не
+    уходит в минус и при нескольких копиях бота с общей базой.
+
+    Товары без поля stock в каталоге не ограничены. Каталог задает
+    остаток, а дальше его меняют только продажи: при изменении stock
+    в каталоге остаток сдвигается на разницу (поставка или списание).
+
+    Для показа каталога остатки берутся из кэша available(), который
+    обновляется после своих изменений и раз в refresh_interval секунд
+    (чтобы увидеть продажи других копий бота).
+    """
+
+    def __init__(self, outbox: Outbox, reservation_ttl: float = 900, refresh_interval: float = 10):
+        self.outbox = outbox
+        self.reservation_ttl = reservation_ttl
+        self.refresh_interval = refresh_interval
+        # id товара -> сколько свободно (остаток минус все резервы)
+        self._available = MappingProxyType({})
+        # (пользователь, id товара) -> его действующий резерв
+        self._reserved = MappingProxyType({})
+        self._task = None
+        with outbox.transaction() as conn:
+            conn.executescript(
+                "CREATE TABLE IF NOT EXISTS stock ("
+                " product_id INTEGER PRIMARY KEY,"
+                " on_hand INTEGER NOT NULL,"
+                " catalog_stock INTEGER NOT NULL"
+                ");"
+                "CREATE TABLE IF NOT EXISTS reservations ("
+                " user_id INTEGER NOT NULL,"
+                " product_id INTEGER NOT NULL,"
+                " quantity INTEGER NOT NULL,"
+                " expires_at REAL NOT NULL,"
+                " PRIMARY KEY (user_id, product_id)"
+                ");"
+                "CREATE INDEX IF NOT EXISTS reservations_product ON reservations (product_id, expires_at);"
+            )
+
+    def sync(self, products) -> None:
+        """Переносит остатки из каталога (поле stock) в базу"""
+        limited = [(product['id'], product['stock']) for product in products if product.get('stock') is not None]
+        unlimited = [(product['id'],) for product in products if product.get('stock') is None]
+        with self.outbox.transaction(immediate=True) as conn:
+            conn.executemany(
+                "INSERT INTO stock (product_id, on_hand, catalog_stock) VALUES (?1, ?2, ?2)"
+                " ON CONFLICT (product_id) DO UPDATE SET"
+                " on_hand = MAX(0, on_hand + excluded.catalog_stock - catalog_stock),"
+                " catalog_stock = excluded.catalog_stock",
+                limited
+            )
+            conn.executemany("DELETE FROM stock WHERE product_id = ?", unlimited)
+        self.refresh()
+
+    @staticmethod
+    def _free(conn, product_ids, now: float) -> dict:
+        """Остаток минус действующие резервы для товаров с ограничением"""
+        placeholders = ",".join("?" * len(product_ids))
+        rows = conn.execute(
+            "SELECT s.product_id, s.on_hand - COALESCE(SUM(r.quantity), 0)"
+            " FROM stock s LEFT JOIN reservations r"
+            " ON r.product_id = s.product_id AND r.expires_at > ?"
+            f" WHERE s.product_id IN ({placeholders}) GROUP BY s.product_id",
+            (now, *product_ids)
+        ).fetchall()
+        return dict(rows)
+
+    @staticmethod
+    def _shortages(lines, free: dict) -> dict:
+        shortages = {}
+        for product, quantity, _ in lines:
+            available = free.get(product['id'])
+            if available is not None and quantity > available:
+                shortages[product['id']] = max(0, available)
+        return shortages
+
+    def reserve(self, user_id: int, lines) -> dict:
+        """
+        Резервирует товары корзины (lines из Cart.summarize()).
+
+        Прежний резерв пользователя заменяется. Возвращает {} при успехе
+        или {id товара: сколько можно купить}, если чего-то не хватает -
+        тогда ничего не резервируется.
+        """
+        now = time.time()
+        with self.outbox.transaction(immediate=True) as conn:
+            conn.execute("DELETE FROM reservations WHERE user_id = ? OR expires_at <= ?", (user_id, now))
+            free = self._free(conn, [product['id'] for product, _, _ in lines], now)
+            shortages = self._shortages(lines, free)
+            if not shortages:
+                conn.executemany(
+                    "INSERT INTO reservations (user_id, product_id, quantity, expires_at) VALUES (?, ?, ?, ?)",
+                    [
+                        (user_id, product['id'], quantity, now + self.reservation_ttl)
+                        for product, quantity, _ in lines if product['id'] in free
+                    ]
+                )
+        self.refresh()
+        return shortages
+
+    def release(self, user_id: int) -> None:
+        """Снимает резерв пользователя (отмена оформления)"""
+        with self.outbox.transaction() as conn:
+            deleted = conn.execute("DELETE FROM reservations WHERE user_id = ?", (user_id,)).rowcount
+        if deleted:
+            self.refresh()
+
+    def commit_in(self, conn, user_id: int, lines) -> None:
+        """
+        Списывает товары заказа внутри открытой транзакции (BEGIN IMMEDIATE).
+
+        Резерв пользователя снимается и заменяется списанием. Если резерв
+        истек, товары списываются из свободного остатка; если их уже нет,
+        выбрасывает OutOfStock, и транзакция заказа откатывается.
+        """
+        now = time.time()
+        conn.execute("DELETE FROM reservations WHERE user_id = ?", (user_id,))
+        free = self._free(conn, [product['id'] for product, _, _ in lines], now)
+        shortages = self._shortages(lines, free)
+        if shortages:
+            raise OutOfStock(shortages)
+        conn.executemany(
+            "UPDATE stock SET on_hand = on_hand - ? WHERE product_id = ?",
+            [(quantity, product['id']) for product, quantity, _ in lines if product['id'] in free]
+        )
+
+    def refresh(self) -> None:
+        """Перечитывает кэш остатков и резервов"""
+        now = time.time()
+        with self.outbox.transaction() as conn:
+            rows = conn.execute(
+                "SELECT s.product_id, MAX(0, s.on_hand - COALESCE(SUM(r.quantity), 0))"
+                " FROM stock s LEFT JOIN reservations r"
+                " ON r.product_id = s.product_id AND r.expires_at > ?"
+                " GROUP BY s.product_id",
+                (now,)
+            ).fetchall()
+            reserved = conn.execute(
+                "SELECT user_id, product_id, SUM(quantity) FROM reservations"
+                " WHERE expires_at > ? GROUP BY user_id, product_id",
+                (now,)
+            ).fetchall()
+        self._available = MappingProxyType(dict(rows))
+        self._reserved = MappingProxyType({
+            (user_id, product_id): quantity for user_id, product_id, quantity in reserved
+        })
+
+    def available(self, product_id: int, user_id: int = None):
+        """
+        Сколько товара можно купить (из кэша); None - без ограничений.
+
+        С user_id к свободному остатку добавляется резерв самого
+        пользователя: его не должны занимать только чужие резервы.
+        """
+        available = self._available.get(product_id)
+        if available is None or user_id is None:
+            return available
+        return available + self._reserved.get((user_id, product_id), 0)
+
+    def start(self) -> None:
+        """Запускает периодическое обновление кэша"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            try:
+                await asyncio.to_thread(self.refresh)
+            except Exception as e:
+                logger.error(f"Не удалось обновить кэш остатков: {e}")
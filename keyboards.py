@@ -0,0 +1,84 @@
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+# Константы для callback данных
+PREV_BUTTON = "prev"
+NEXT_BUTTON = "next"
+ADD_TO_CART_BUTTON = "add_to_cart"
+CLEAR_CART_BUTTON = "clear_cart"
+START_ORDER_BUTTON = "start_order"
+
+def create_product_keyboard(product_id: int) -> InlineKeyboardMarkup:
+    """Создает клавиатуру для товара"""
+    keyboard = [
+        [
+            InlineKeyboardButton("⬅️", callback_data=PREV_BUTTON),
+            InlineKeyboardButton("В корзину 🛒", callback_data=f"{ADD_TO_CART_BUTTON}:{product_id}"),
+            InlineKeyboardButton("➡️", callback_data=NEXT_BUTTON),
+        ]
+    ]
+    return InlineKeyboardMarkup(keyboard)
+
+# Кнопки управления позициями в корзине (callback_data вида "cart_inc:<id>")
+CART_INC_BUTTON = "cart_inc"
+CART_DEC_BUTTON = "cart_dec"
+CART_DEL_BUTTON = "cart_del"
+
+def create_cart_keyboard(lines) -> InlineKeyboardMarkup:
+    """Создает клавиатуру корзины: ➖/➕/❌ для каждой позиции"""
+    keyboard = []
+    for number, (product, quantity, line_total) in enumerate(lines, 1):
+        product_id = product['id']
+        keyboard.append([
+            InlineKeyboardButton(f"➖ {number}", callback_data=f"{CART_DEC_BUTTON}:{product_id}"),
+            InlineKeyboardButton(f"➕ {number}", callback_data=f"{CART_INC_BUTTON}:{product_id}"),
+            InlineKeyboardButton(f"❌ {number}", callback_data=f"{CART_DEL_BUTTON}:{product_id}"),
+        ])
+    keyboard.append([
+        InlineKeyboardButton("🗑️ Очистить корзину", callback_data=CLEAR_CART_BUTTON),
+        InlineKeyboardButton("Оформить заказ 📝", callback_data=START_ORDER_BUTTON),
+    ])
+    return InlineKeyboardMarkup(keyboard)
+
+# Кнопки результатов поиска ("search_item:<id>", "search_page:<номер>")
+SEARCH_ITEM_BUTTON = "search_item"
+SEARCH_PAGE_BUTTON = "search_page"
+
+def create_search_keyboard(products, page: int, pages: int) -> InlineKeyboardMarkup:
+    """Создает клавиатуру страницы результатов поиска"""
+    keyboard = [
+        [InlineKeyboardButton(
+            f"{product['name']} - {product['price']} руб.",
+            callback_data=f"{SEARCH_ITEM_BUTTON}:{product['id']}"
+        )]
+        for product in products
+    ]
+    if pages > 1:
+        keyboard.append([
+            InlineKeyboardButton("⬅️", callback_data=f"{SEARCH_PAGE_BUTTON}:{(page - 1) % pages}"),
+            InlineKeyboardButton(f"{page + 1} / {pages}", callback_data=f"{SEARCH_PAGE_BUTTON}:{page}"),
+            InlineKeyboardButton("➡️", callback_data=f"{SEARCH_PAGE_BUTTON}:{(page + 1) % pages}"),
+        ])
+    return InlineKeyboardMarkup(keyboard)
+
+# Листание каталога плиткой ("grid_page:<номер>")
+GRID_PAGE_BUTTON = "grid_page"
+
+def create_grid_keyboard(products, page: int, pages: int) -> InlineKeyboardMarkup:
+    """Создает клавиатуру страницы-плитки: кнопка с номером добавляет товар в корзину"""
+    buttons = [
+        InlineKeyboardButton(f"🛒 {number}", callback_data=f"{ADD_TO_CART_BUTTON}:{product['id']}")
+        for number, product in enumerate(products, 1)
+    ]
+    keyboard = [buttons[i:i + 5] for i in range(0, len(buttons), 5)]
+    if pages > 1:
+        keyboard.append([
+            InlineKeyboardButton("⬅️", callback_data=f"{GRID_PAGE_BUTTON}:{(page - 1) % pages}"),
+            InlineKeyboardButton("➡️", callback_data=f"{GRID_PAGE_BUTTON}:{(page + 1) % pages}"),
+        ])
+    return InlineKeyboardMarkup(keyboard)
+
+def create_promo_keyboard(product_id: int) -> InlineKeyboardMarkup:
+    """Создает клавиатуру товара в рассылке: только кнопка корзины"""
+    return InlineKeyboardMarkup([[
+        InlineKeyboardButton("В корзину 🛒", callback_data=f"{ADD_TO_CART_BUTTON}:{product_id}")
+    ]])
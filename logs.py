@@ -0,0 +1,173 @@
+"""
+Журнал бота: запись в отдельном потоке, JSON и скрытие личных данных.
+
+Обработчики только кладут запись в очередь (QueueHandler), а
+форматирование и запись в stdout выполняет фоновый поток
+(QueueListener), поэтому под нагрузкой журнал не задерживает ответы.
+Если очередь переполнена, запись отбрасывается, а не ждет.
+
+Поля записи из extra (logger.info(..., extra={"order_id": 5})) попадают
+в JSON отдельными ключами. Значения полей с личными данными
+(LOG_REDACT_FIELDS) и номера телефонов в тексте сообщения заменяются
+на REDACTED. Частые события можно прореживать: LOG_SAMPLE_RATES задает
+долю записей ниже WARNING, которая попадает в журнал, по полю event или
+по имени логгера.
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import re
+import sys
+import time
+
+REDACTED = "<скрыто>"
+
+# Телефоны: +7 999 123-45-67, 8 (999) 123-45-67, 89991234567
+PHONE_PATTERN = re.compile(
+    r"\+\d[\d\s\-()]{8,}\d"
+    r"|\b[78][\s\-(]*\d{3}[\s\-)]*\d{3}[\s\-]*\d{2}[\s\-]*\d{2}\b"
+)
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# Атрибуты, которые есть у любой записи (все остальные пришли из extra)
+_STANDARD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+
+class AsyncQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler, который не форматирует запись и не ждет места в очереди"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        # Сколько записей отброшено из-за переполненной очереди
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Аргументы подставляются сразу: к моменту записи они могут измениться.
+        # Трассировка исключения и JSON собираются уже в потоке записи
+        record = logging.makeLogRecord(vars(record))
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class SamplingFilter(logging.Filter):
+    """Пропускает только долю частых записей ниже WARNING"""
+
+    def __init__(self, rates: dict):
+        super().__init__()
+        self.rates = dict(rates)
+
+    def _rate(self, record):
+        event = getattr(record, 'event', None)
+        if event in self.rates:
+            return self.rates[event]
+        # Ближайший настроенный логгер: "httpx" действует и на "httpx._client"
+        name = record.name
+        while name:
+            if name in self.rates:
+                return self.rates[name]
+            name = name.rpartition('.')[0]
+        return None
+
+    def filter(self, record) -> bool:
+        if record.levelno >= logging.WARNING or not self.rates:
+            return True
+        rate = self._rate(record)
+        return rate is None or random.random() < rate
+
+
+class RedactingFilter(logging.Filter):
+    """Скрывает личные данные в полях записи и телефоны в тексте"""
+
+    def __init__(self, fields):
+        super().__init__()
+        self.fields = set(fields)
+
+    def filter(self, record) -> bool:
+        for field in self.fields:
+            if getattr(record, field, None) is not None:
+                setattr(record, field, REDACTED)
+        if isinstance(record.msg, str):
+            record.msg = PHONE_PATTERN.sub(REDACTED, record.msg)
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна запись - одна строка JSON"""
+
+    def format(self, record) -> str:
+        entry = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(record.created))
+                    + f".{int(record.msecs):03d}",
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _STANDARD_ATTRIBUTES and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+_listener = None
+_handler = None
+
+
+def setup_logging(level="INFO", log_format: str = "json", levels: dict = None,
+                  sample_rates: dict = None, redact_fields=(), queue_size: int = 10000,
+                  stream=None) -> None:
+    """
+    Направляет журнал через очередь в фоновый поток.
+
+    levels - уровни отдельных логгеров ({"httpx": "WARNING"}),
+    log_format - "json" или "text" (прежний формат строк).
+    """
+    global _listener, _handler
+    stop_logging()
+
+    output = logging.StreamHandler(stream or sys.stdout)
+    output.setFormatter(JsonFormatter() if log_format == "json" else logging.Formatter(TEXT_FORMAT))
+    output.addFilter(RedactingFilter(redact_fields))
+
+    _handler = AsyncQueueHandler(queue.Queue(maxsize=queue_size))
+    if sample_rates:
+        _handler.addFilter(SamplingFilter(sample_rates))
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(_handler)
+    root.setLevel(level)
+    for name, logger_level in (levels or {}).items():
+        logging.getLogger(name).setLevel(logger_level)
+
+    _listener = logging.handlers.QueueListener(_handler.queue, output, respect_handler_level=True)
+    _listener.start()
+
+
+def stop_logging() -> None:
+    """Дописывает записи из очереди и останавливает поток записи"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def dropped_count() -> int:
+    """Сколько записей отброшено из-за переполненной очереди"""
+    return _handler.dropped if _handler else 0
+
+
+atexit.register(stop_logging)
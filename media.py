@@ -0,0 +1,109 @@
+import asyncio
+import logging
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class MediaProvider:
+    """
+    Фото товаров для отправки: file_id из кэша или содержимое файла.
+
+    Все обращения к диску (проверка file_id по времени изменения файла,
+    чтение, хэш при запоминании file_id) выполняются в отдельном пуле
+    потоков, поэтому медленный или сетевой диск не останавливает цикл
+    событий, а запросы к базам в пуле asyncio не ждут диска.
+
+    Прочитанные файлы держатся в LRU-кэше в пределах max_bytes: пока
+    Telegram не вернул file_id (например, сразу после запуска или
+    обновления фото), одно и то же фото не читается с диска повторно.
+    Когда file_id получен, содержимое файла удаляется из кэша.
+    """
+
+    def __init__(self, photo_cache, max_bytes: int = 32 * 1024 * 1024, workers: int = 4):
+        self.photo_cache = photo_cache
+        self.max_bytes = max_bytes
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="media")
+        self._lock = threading.Lock()
+        # путь -> (размер, время изменения, содержимое)
+        self._files = OrderedDict()
+        self.size = 0
+        # Статистика кэша файлов для мониторинга
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    async def _run(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, function, *args)
+
+    async def load(self, key: str, path: str):
+        """Возвращает file_id, содержимое файла или None, если файла нет"""
+        return await self._run(self._load, key, path)
+
+    async def remember(self, key: str, path: str, message) -> None:
+        """Запоминает file_id из сообщения, которое вернул Telegram"""
+        await self._run(self._remember, key, path, message)
+
+    async def forget(self, key: str) -> None:
+        """Сбрасывает file_id, который Telegram не принял"""
+        await self._run(self.photo_cache.invalidate, key)
+
+    def _load(self, key: str, path: str):
+        file_id = self.photo_cache.get(key, path)
+        if file_id:
+            return file_id
+        return self._read(path)
+
+    def _read(self, path: str):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            self._discard(path)
+            return None
+
+        with self._lock:
+            entry = self._files.get(path)
+            if entry is not None and entry[0] == stat.st_size and entry[1] == stat.st_mtime_ns:
+                self._files.move_to_end(path)
+                self.hits += 1
+                return entry[2]
+            self.misses += 1
+
+        try:
+            with open(path, 'rb') as photo_file:
+                data = photo_file.read()
+        except OSError as e:
+            logger.error(f"Не удалось прочитать фото {path}: {e}")
+            return None
+
+        # Слишком большой файл вытеснил бы из кэша все остальные
+        if len(data) <= self.max_bytes // 4:
+            with self._lock:
+                previous = self._files.pop(path, None)
+                if previous is not None:
+                    self.size -= len(previous[2])
+                self._files[path] = (stat.st_size, stat.st_mtime_ns, data)
+                self.size += len(data)
+                while self.size > self.max_bytes:
+                    _, (_, _, evicted) = self._files.popitem(last=False)
+                    self.size -= len(evicted)
+                    self.evictions += 1
+        return data
+
+    def _remember(self, key: str, path: str, message) -> None:
+        self.photo_cache.remember(key, path, message)
+        if getattr(message, 'photo', None):
+            # Дальше фото отправляется по file_id
+            self._discard(path)
+
+    def _discard(self, path: str) -> None:
+        with self._lock:
+            entry = self._files.pop(path, None)
+            if entry is not None:
+                self.size -= len(entry[2])
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=False)
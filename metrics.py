@@ -0,0 +1,201 @@
+import bisect
+import functools
+import threading
+import time
+
+from telegram.ext import ConversationHandler
+
+# Границы корзин гистограмм задержек, в секундах
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _format_labels(names, values) -> str:
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+class Counter:
+    """Счетчик с метками (только растет)"""
+
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount: float = 1) -> None:
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def value(self, *label_values) -> float:
+        return self._values.get(label_values, 0)
+
+    def samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        for label_values, value in items:
+            yield self.name, _format_labels(self.labels, label_values), value
+
+
+class Histogram:
+    """Гистограмма с метками в формате Prometheus"""
+
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        # метки -> [счетчики по корзинам..., сумма, количество]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *label_values) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(label_values)
+            if state is None:
+                state = self._values[label_values] = [0] * (len(self.buckets) + 2)
+            if index < len(self.buckets):
+                state[index] += 1
+            state[-2] += value
+            state[-1] += 1
+
+    def samples(self):
+        with self._lock:
+            items = [(labels, list(state)) for labels, state in self._values.items()]
+        names = self.labels + ("le",)
+        for label_values, state in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, state):
+                cumulative += count
+                yield f"{self.name}_bucket", _format_labels(names, label_values + (bound,)), cumulative
+            yield f"{self.name}_bucket", _format_labels(names, label_values + ("+Inf",)), state[-1]
+            yield f"{self.name}_sum", _format_labels(self.labels, label_values), state[-2]
+            yield f"{self.name}_count", _format_labels(self.labels, label_values), state[-1]
+
+
+class CallbackMetric:
+    """Метрика, значения которой вычисляются при каждом запросе /metrics"""
+
+    def __init__(self, name: str, documentation: str, function, metric_type: str = "gauge", labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.type = metric_type
+        self.labels = tuple(labels)
+        # function() -> {кортеж значений меток: значение}
+        self.function = function
+
+    def samples(self):
+        for label_values, value in self.function().items():
+            yield self.name, _format_labels(self.labels, label_values), value
+
+
+class Registry:
+    """Набор метрик и их текстовое представление для Prometheus"""
+
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{labels} {value}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+HANDLER_LATENCY = REGISTRY.register(Histogram(
+    "bot_handler_latency_seconds", "Время работы обработчика", ["handler"]
+))
+HANDLER_ERRORS = REGISTRY.register(Counter(
+    "bot_handler_errors_total", "Исключения в обработчиках", ["handler", "exception"]
+))
+API_LATENCY = REGISTRY.register(Histogram(
+    "bot_api_request_seconds", "Время запроса к Bot API", ["method"]
+))
+API_ERRORS = REGISTRY.register(Counter(
+    "bot_api_errors_total", "Ошибки запросов к Bot API", ["method", "exception"]
+))
+API_RATE_LIMIT_WAIT = REGISTRY.register(Histogram(
+    "bot_api_rate_limit_wait_seconds", "Ожидание в ограничителе запросов", ["method"]
+))
+
+
+def register_callback(name: str, documentation: str, function, metric_type: str = "gauge", labels=()):
+    """Регистрирует метрику, вычисляемую при запросе"""
+    return REGISTRY.register(CallbackMetric(name, documentation, function, metric_type, labels))
+
+
+def instrument(callback, name: str = None):
+    """Оборачивает обработчик: замеряет время и считает исключения"""
+    handler_name = name or callback.__name__
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception as e:
+            HANDLER_ERRORS.inc(handler_name, type(e).__name__)
+            raise
+        finally:
+            HANDLER_LATENCY.observe(time.perf_counter() - started, handler_name)
+
+    wrapper.instrumented = True
+    return wrapper
+
+
+def _instrument_handler(handler) -> None:
+    if isinstance(handler, ConversationHandler):
+        nested = list(handler.entry_points) + list(handler.fallbacks)
+        for state_handlers in handler.states.values():
+            nested.extend(state_handlers)
+        for nested_handler in nested:
+            _instrument_handler(nested_handler)
+        return
+    if not getattr(handler.callback, 'instrumented', False):
+        handler.callback = instrument(handler.callback)
+
+
+def instrument_application(application) -> None:
+    """Оборачивает все зарегистрированные обработчики приложения"""
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            _instrument_handler(handler)
+
+
+async def metrics_view(request: "web.Request") -> "web.Response":
+    """Страница /metrics"""
+    # aiohttp импортируется только при запуске сервера - в режиме polling
+    # без /metrics он не нужен, а его импорт заметно замедляет запуск
+    from aiohttp import web
+    return web.Response(text=REGISTRY.render(), content_type="text/plain", charset="utf-8")
+
+
+async def start_metrics_server(host: str, port: int) -> "web.AppRunner":
+    """Отдельный сервер /metrics (для режима polling)"""
+    from aiohttp import web
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_view)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
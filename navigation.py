@@ -0,0 +1,53 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Debouncer:
+    """
+    Откладывает обновление сообщения до конца серии быстрых нажатий.
+
+    Каждый вызов schedule с тем же ключом (сообщением) отменяет
+    предыдущий: и тот, что еще ждет, и тот, что уже отправляет запрос.
+    Новое обновление начинается только после того, как отмененное
+    завершилось, поэтому ответы Bot API не приходят вперемешку и в
+    сообщении остается последний выбранный товар.
+    """
+
+    def __init__(self, delay: float):
+        self.delay = delay
+        # ключ -> задача, которая обновит сообщение
+        self._pending = {}
+        # Статистика для мониторинга
+        self.scheduled = 0
+        self.coalesced = 0
+
+    def schedule(self, key, callback, *args) -> None:
+        """Через delay секунд вызывает callback(*args), если не придет новый вызов с этим ключом"""
+        previous = self._pending.get(key)
+        if previous is not None:
+            previous.cancel()
+            self.coalesced += 1
+        self.scheduled += 1
+        self._pending[key] = asyncio.create_task(self._run(key, previous, callback, args))
+
+    async def _run(self, key, previous, callback, args) -> None:
+        try:
+            await asyncio.sleep(self.delay)
+            if previous is not None:
+                # Дожидаемся, пока отмененный запрос действительно прервется
+                await asyncio.gather(previous, return_exceptions=True)
+            await callback(*args)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Ошибка при обновлении сообщения: {e}")
+        finally:
+            if self._pending.get(key) is asyncio.current_task():
+                del self._pending[key]
+
+    async def flush(self) -> None:
+        """Дожидается отложенных обновлений (при остановке бота)"""
+        while self._pending:
+            await asyncio.gather(*self._pending.values(), return_exceptions=True)
@@ -0,0 +1,197 @@
+import time
+
+from outbox import Outbox
+
+# Статусы заказа
+STATUS_NEW = "new"
+STATUS_NOTIFIED = "notified"
+# Уведомление администратору так и не доставлено
+STATUS_NOTIFY_FAILED = "notify_failed"
+
+
+class OrderLedger:
+    """
+    Журнал заказов в SQLite (в той же базе, что и очередь сообщений).
+
+    Журнал только дописывается: заказ и его позиции после записи не меняются,
+    а смена статуса добавляет новую запись в order_events.
+    Если передан inventory, товары списываются со склада в той же транзакции.
+
+    Для статистики (/admin) в той же транзакции обновляются сводные
+    таблицы: заказы и выручка по дням и продажи по товарам. Поэтому
+    статистика не пересчитывает историю заказов и совпадает у всех
+    копий бота с общей базой.
+    """
+
+    def __init__(self, outbox: Outbox, inventory=None):
+        self.outbox = outbox
+        self.inventory = inventory
+        with outbox.transaction() as conn:
+            conn.executescript(
+                "CREATE TABLE IF NOT EXISTS orders ("
+                " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+                " created_at REAL NOT NULL,"
+                " user_id INTEGER,"
+                " customer_name TEXT NOT NULL,"
+                " customer_phone TEXT NOT NULL,"
+                " total_price INTEGER NOT NULL"
+                ");"
+                "CREATE TABLE IF NOT EXISTS order_items ("
+                " order_id INTEGER NOT NULL REFERENCES orders (id),"
+                " product_id INTEGER NOT NULL,"
+                " name TEXT NOT NULL,"
+                " price INTEGER NOT NULL,"
+                " quantity INTEGER NOT NULL,"
+                " line_total INTEGER NOT NULL"
+                ");"
+                "CREATE TABLE IF NOT EXISTS order_events ("
+                " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+                " order_id INTEGER NOT NULL REFERENCES orders (id),"
+                " status TEXT NOT NULL,"
+                " created_at REAL NOT NULL"
+                ");"
+                "CREATE INDEX IF NOT EXISTS order_items_order ON order_items (order_id);"
+                "CREATE INDEX IF NOT EXISTS order_events_order ON order_events (order_id);"
+                "CREATE TABLE IF NOT EXISTS sales_daily ("
+                " day TEXT PRIMARY KEY,"
+                " orders INTEGER NOT NULL,"
+                " items INTEGER NOT NULL,"
+                " revenue INTEGER NOT NULL"
+                ");"
+                "CREATE TABLE IF NOT EXISTS product_sales ("
+                " product_id INTEGER PRIMARY KEY,"
+                " name TEXT NOT NULL,"
+                " quantity INTEGER NOT NULL,"
+                " revenue INTEGER NOT NULL"
+                ");"
+                "CREATE INDEX IF NOT EXISTS product_sales_quantity ON product_sales (quantity);"
+            )
+        with outbox.transaction(immediate=True) as conn:
+            self._backfill(conn)
+
+    @staticmethod
+    def _backfill(conn) -> None:
+        """Заполняет сводные таблицы по заказам, записанным до их появления"""
+        if conn.execute("SELECT 1 FROM sales_daily LIMIT 1").fetchone():
+            return
+        conn.execute(
+            "INSERT INTO sales_daily (day, orders, items, revenue)"
+            " SELECT date(o.created_at, 'unixepoch', 'localtime'), COUNT(*),"
+            " SUM((SELECT SUM(quantity) FROM order_items WHERE order_id = o.id)), SUM(o.total_price)"
+            " FROM orders o GROUP BY 1"
+        )
+        conn.execute(
+            "INSERT INTO product_sales (product_id, name, quantity, revenue)"
+            " SELECT product_id, name, SUM(quantity), SUM(line_total)"
+            " FROM order_items GROUP BY product_id"
+        )
+
+    @staticmethod
+    def _day(timestamp: float) -> str:
+        return time.strftime("%Y-%m-%d", time.localtime(timestamp))
+
+    def _update_aggregates(self, conn, now: float, lines, total_price: int) -> None:
+        conn.execute(
+            "INSERT INTO sales_daily (day, orders, items, revenue) VALUES (?, 1, ?, ?)"
+            " ON CONFLICT (day) DO UPDATE SET orders = orders + 1,"
+            " items = items + excluded.items, revenue = revenue + excluded.revenue",
+            (self._day(now), sum(quantity for _, quantity, _ in lines), total_price)
+        )
+        conn.executemany(
+            "INSERT INTO product_sales (product_id, name, quantity, revenue) VALUES (?, ?, ?, ?)"
+            " ON CONFLICT (product_id) DO UPDATE SET name = excluded.name,"
+            " quantity = quantity + excluded.quantity, revenue = revenue + excluded.revenue",
+            [(product['id'], product['name'], quantity, line_total) for product, quantity, line_total in lines]
+        )
+
+    def record(self, user_id, customer_name, customer_phone, lines, total_price,
+               notify_chat_id=None, format_notification=None, digest_delay=None) -> int:
+        """
+        Записывает заказ и возвращает его номер.
+
+        lines - позиции из Cart.summarize(). Если указан notify_chat_id,
+        уведомление format_notification(order_id) ставится в очередь
+        в той же транзакции, что и сам заказ; с digest_delay оно уходит
+        в сводке не позже чем через digest_delay секунд. Если товаров не
+        хватает, выбрасывает inventory.OutOfStock и ничего не записывает.
+        """
+        now = time.time()
+        with self.outbox.transaction(immediate=self.inventory is not None) as conn:
+            if self.inventory is not None:
+                self.inventory.commit_in(conn, user_id, lines)
+            order_id = conn.execute(
+                "INSERT INTO orders (created_at, user_id, customer_name, customer_phone, total_price)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (now, user_id, customer_name, customer_phone, total_price)
+            ).lastrowid
+            conn.executemany(
+                "INSERT INTO order_items (order_id, product_id, name, price, quantity, line_total)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (order_id, product['id'], product['name'], product['price'], quantity, line_total)
+                    for product, quantity, line_total in lines
+                ]
+            )
+            self._add_event(conn, order_id, STATUS_NEW, now)
+            self._update_aggregates(conn, now, lines, total_price)
+            if notify_chat_id:
+                Outbox.enqueue_in(
+                    conn, notify_chat_id, format_notification(order_id), order_id,
+                    delay=digest_delay or 0, digest=digest_delay is not None
+                )
+        if self.inventory is not None:
+            self.inventory.refresh()
+        return order_id
+
+    @staticmethod
+    def _add_event(conn, order_id: int, status: str, now: float = None) -> None:
+        conn.execute(
+            "INSERT INTO order_events (order_id, status, created_at) VALUES (?, ?, ?)",
+            (order_id, status, now or time.time())
+        )
+
+    def set_status(self, order_id: int, status: str) -> None:
+        """Добавляет в журнал новый статус заказа"""
+        with self.outbox.transaction() as conn:
+            self._add_event(conn, order_id, status)
+
+    def mark_notified(self, order_id: int) -> None:
+        """Отмечает, что администратор получил уведомление о заказе"""
+        self.set_status(order_id, STATUS_NOTIFIED)
+
+    def mark_notify_failed(self, order_id: int) -> None:
+        """Отмечает, что уведомление о заказе доставить не удалось"""
+        self.set_status(order_id, STATUS_NOTIFY_FAILED)
+
+    def sales(self, days: int = 7) -> dict:
+        """
+        Сводка продаж: {"today": (заказы, товары, выручка), "week": ..., "total": ...}.
+
+        "week" - последние days дней, включая сегодня.
+        """
+        now = time.time()
+        today = self._day(now)
+        since = self._day(now - (days - 1) * 86400)
+        with self.outbox.transaction() as conn:
+            rows = {
+                period: conn.execute(
+                    "SELECT COALESCE(SUM(orders), 0), COALESCE(SUM(items), 0), COALESCE(SUM(revenue), 0)"
+                    f" FROM sales_daily{condition}",
+                    params
+                ).fetchone()
+                for period, condition, params in (
+                    ("today", " WHERE day = ?", (today,)),
+                    ("week", " WHERE day >= ?", (since,)),
+                    ("total", "", ()),
+                )
+            }
+        return rows
+
+    def top_products(self, limit: int = 5) -> list:
+        """Самые продаваемые товары: [(id, название, штук, выручка)]"""
+        with self.outbox.transaction() as conn:
+            return conn.execute(
+                "SELECT product_id, name, quantity, revenue FROM product_sales"
+                " ORDER BY quantity DESC, revenue DESC LIMIT ?",
+                (limit,)
+            ).fetchall()
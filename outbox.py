@@ -0,0 +1,447 @@
+import asyncio
+import contextlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+from telegram.error import BadRequest, ChatMigrated, Forbidden, RetryAfter
+
+from ratelimit import retry_after_seconds
+
+logger = logging.getLogger(__name__)
+
+# Ошибки, после которых повтор не поможет (бот заблокирован, удален из
+# группы, неверный chat_id): сообщение сразу считается недоставленным
+PERMANENT_ERRORS = (BadRequest, ChatMigrated, Forbidden)
+
+
+class Outbox:
+    """
+    Надежная очередь исходящих сообщений в SQLite.
+
+    Сообщение считается принятым, как только enqueue() записал его на диск;
+    доставкой занимается OutboxWorker, который повторяет отправку. Если
+    Telegram отклонил сообщение окончательно или попытки закончились,
+    сообщение отмечается недоставленным (failed_at) и больше не отправляется.
+    Через transaction() другие таблицы той же базы (например, журнал заказов)
+    можно изменить в одной транзакции с постановкой сообщения в очередь.
+
+    Сообщения с digest=1 не отправляются по одному: когда подходит время
+    первого из них, OutboxWorker собирает все ожидающие сообщения-сводки
+    того же чата и отправляет их вместе.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(
+            "CREATE TABLE IF NOT EXISTS outbox ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " chat_id INTEGER NOT NULL,"
+            " text TEXT NOT NULL,"
+            " created_at REAL NOT NULL,"
+            " attempts INTEGER NOT NULL DEFAULT 0,"
+            " next_attempt_at REAL NOT NULL,"
+            " sent_at REAL,"
+            " last_error TEXT,"
+            " order_id INTEGER,"
+            " digest INTEGER NOT NULL DEFAULT 0,"
+            " leased_until REAL,"
+            " leased_by TEXT,"
+            " failed_at REAL"
+            ");"
+            "CREATE INDEX IF NOT EXISTS outbox_pending"
+            " ON outbox (next_attempt_at) WHERE sent_at IS NULL;"
+        )
+        # Базы, созданные раньше, не имеют новых колонок
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(outbox)")]
+        if 'order_id' not in columns:
+            self._conn.execute("ALTER TABLE outbox ADD COLUMN order_id INTEGER")
+        if 'digest' not in columns:
+            self._conn.execute("ALTER TABLE outbox ADD COLUMN digest INTEGER NOT NULL DEFAULT 0")
+        if 'leased_until' not in columns:
+            self._conn.execute("ALTER TABLE outbox ADD COLUMN leased_until REAL")
+        if 'leased_by' not in columns:
+            self._conn.execute("ALTER TABLE outbox ADD COLUMN leased_by TEXT")
+        if 'failed_at' not in columns:
+            self._conn.execute("ALTER TABLE outbox ADD COLUMN failed_at REAL")
+        self._conn.commit()
+        # (ждут отправки, недоставлены) - снимок для метрик, см. refresh_counts()
+        self.counts = (0, 0)
+        self.refresh_counts()
+
+    @contextlib.contextmanager
+    def transaction(self, immediate: bool = False):
+        """
+        Транзакция в базе очереди: коммит при выходе, откат при ошибке.
+
+        immediate=True сразу берет блокировку записи, чтобы прочитанные в
+        транзакции данные не изменил другой процесс, работающий с той же базой.
+        """
+        with self._lock, self._conn:
+            if immediate:
+                self._conn.execute("BEGIN IMMEDIATE")
+            yield self._conn
+
+    @staticmethod
+    def enqueue_in(conn, chat_id: int, text: str, order_id: int = None,
+                   delay: float = 0, digest: bool = False) -> int:
+        """
+        Ставит сообщение в очередь внутри открытой транзакции.
+
+        delay - через сколько секунд отправить, digest - отправить вместе
+        с другими сводками этого чата (см. OutboxWorker).
+        """
+        now = time.time()
+        cursor = conn.execute(
+            "INSERT INTO outbox (chat_id, text, created_at, next_attempt_at, order_id, digest)"
+            " VALUES (?, ?, ?, ?, ?, ?)",
+            (chat_id, text, now, now + delay, order_id, int(digest))
+        )
+        return cursor.lastrowid
+
+    def enqueue(self, chat_id: int, text: str, order_id: int = None) -> int:
+        """Ставит сообщение в очередь, возвращает его id"""
+        with self.transaction() as conn:
+            return self.enqueue_in(conn, chat_id, text, order_id)
+
+    def due(self, limit: int = 20, lease: float = 60, owner: str = None) -> list:
+        """
+        Сообщения, которые пора отправить: [(id, chat_id, text, attempts, order_id, digest)].
+
+        Если пора отправить сводку, к ней добавляются все ожидающие сводки
+        того же чата, даже если их время еще не пришло. Выбранные сообщения
+        закрепляются за owner на lease секунд, поэтому другие процессы
+        с той же базой их не возьмут; если процесс упадет, не отправив их,
+        после lease они снова станут доступны. Отправка может занять
+        больше lease, поэтому перед каждой отправкой закрепление продлевается
+        через renew().
+        """
+        now = time.time()
+        with self.transaction(immediate=True) as conn:
+            rows = conn.execute(
+                "SELECT id, chat_id, text, attempts, order_id, digest FROM outbox"
+                " WHERE sent_at IS NULL AND failed_at IS NULL AND next_attempt_at <= ?1"
+                " AND (leased_until IS NULL OR leased_until <= ?1)"
+                " ORDER BY id LIMIT ?2",
+                (now, limit)
+            ).fetchall()
+            selected = {row[0] for row in rows}
+            for chat_id in {row[1] for row in rows if row[5]}:
+                for row in conn.execute(
+                    "SELECT id, chat_id, text, attempts, order_id, digest FROM outbox"
+                    " WHERE sent_at IS NULL AND failed_at IS NULL AND digest = 1 AND chat_id = ?1"
+                    " AND (leased_until IS NULL OR leased_until <= ?2)"
+                    " ORDER BY id",
+                    (chat_id, now)
+                ):
+                    if row[0] not in selected:
+                        selected.add(row[0])
+                        rows.append(row)
+            conn.executemany(
+                "UPDATE outbox SET leased_until = ?, leased_by = ? WHERE id = ?",
+                [(now + lease, owner, row[0]) for row in rows]
+            )
+        return rows
+
+    def renew(self, message_ids, owner: str, lease: float = 60) -> set:
+        """
+        Продлевает закрепление сообщений за owner и возвращает id тех, что
+        по-прежнему закреплены за ним и не отправлены. Сообщение, которое
+        после истечения lease взял другой процесс, отправлять уже нельзя.
+        """
+        message_ids = list(message_ids)
+        if not message_ids:
+            return set()
+        placeholders = ",".join("?" * len(message_ids))
+        condition = (
+            f"id IN ({placeholders}) AND leased_by = ? AND leased_until IS NOT NULL"
+            " AND sent_at IS NULL AND failed_at IS NULL"
+        )
+        with self.transaction(immediate=True) as conn:
+            conn.execute(
+                f"UPDATE outbox SET leased_until = ? WHERE {condition}",
+                (time.time() + lease, *message_ids, owner)
+            )
+            return {row[0] for row in conn.execute(
+                f"SELECT id FROM outbox WHERE {condition}", (*message_ids, owner)
+            )}
+
+    def mark_sent(self, message_id: int) -> None:
+        """Отмечает сообщение доставленным"""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE outbox SET sent_at = ?, attempts = attempts + 1, leased_until = NULL WHERE id = ?",
+                (time.time(), message_id)
+            )
+
+    def mark_failed(self, message_id: int, error: str, retry_in: float) -> None:
+        """Откладывает повторную отправку"""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE outbox SET attempts = attempts + 1, last_error = ?, next_attempt_at = ?,"
+                " leased_until = NULL WHERE id = ?",
+                (error, time.time() + retry_in, message_id)
+            )
+
+    def mark_dead(self, message_id: int, error: str) -> None:
+        """Отмечает сообщение недоставленным: больше его не отправляем"""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE outbox SET attempts = attempts + 1, last_error = ?, failed_at = ?,"
+                " leased_until = NULL WHERE id = ?",
+                (error, time.time(), message_id)
+            )
+
+    def pending_count(self) -> int:
+        """Сколько сообщений еще ждет отправки"""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM outbox WHERE sent_at IS NULL AND failed_at IS NULL"
+            ).fetchone()[0]
+
+    def failed_count(self) -> int:
+        """Сколько сообщений так и не удалось доставить"""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM outbox WHERE failed_at IS NOT NULL"
+            ).fetchone()[0]
+
+    def refresh_counts(self) -> None:
+        """
+        Пересчитывает снимок counts.
+
+        Метрики читают снимок, а не базу: страница /metrics отдается из
+        цикла событий и не должна ждать блокировку или занятую базу.
+        """
+        with self._lock:
+            pending, failed = self._conn.execute(
+                "SELECT COALESCE(SUM(sent_at IS NULL AND failed_at IS NULL), 0),"
+                " COALESCE(SUM(failed_at IS NOT NULL), 0) FROM outbox"
+            ).fetchone()
+        self.counts = (pending, failed)
+
+    def failed(self, limit: int = 5) -> list:
+        """Последние недоставленные сообщения: [(id, chat_id, order_id, ошибка)]"""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT id, chat_id, order_id, last_error FROM outbox WHERE failed_at IS NOT NULL"
+                " ORDER BY failed_at DESC LIMIT ?",
+                (limit,)
+            ).fetchall()
+
+    def pending_digest_count(self, chat_id: int) -> int:
+        """Сколько сообщений ждет отправки в сводке для чата"""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM outbox WHERE sent_at IS NULL AND failed_at IS NULL"
+                " AND digest = 1 AND chat_id = ?",
+                (chat_id,)
+            ).fetchone()[0]
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+# Ограничение Telegram на длину одного сообщения
+MAX_MESSAGE_LENGTH = 4096
+
+
+def split_digest(texts, header: str = "🧾 Сводка новых заказов") -> list:
+    """
+    Собирает сообщения-сводки в как можно меньше сообщений Telegram.
+
+    Возвращает [(текст, индексы исходных сообщений)]; каждое исходное
+    сообщение целиком попадает в одну часть.
+    """
+    # Место под заголовок с числом заказов
+    limit = MAX_MESSAGE_LENGTH - len(header) - 16
+    parts = []
+    current, indexes, length = [], [], 0
+    for index, text in enumerate(texts):
+        text = text[:limit]
+        if current and length + 2 + len(text) > limit:
+            parts.append((current, indexes))
+            current, indexes, length = [], [], 0
+        length += len(text) + (2 if current else 0)
+        current.append(text)
+        indexes.append(index)
+    if current:
+        parts.append((current, indexes))
+    return [
+        (f"{header} ({len(part)}):\n\n" + "\n\n".join(part), part_indexes)
+        for part, part_indexes in parts
+    ]
+
+
+class OutboxWorker:
+    """
+    Фоновая доставка сообщений из Outbox с повторами.
+
+    После ошибки из PERMANENT_ERRORS или max_attempts неудачных попыток
+    сообщение отмечается недоставленным, а для заказа вызывается on_failed.
+
+    Взятые сообщения закреплены за этим процессом на lease секунд. Пока
+    пачка отправляется (через ограничитель запросов, с паузами RetryAfter),
+    закрепление продлевается каждые lease / 3 секунд и еще раз перед
+    каждой отправкой; сообщение, которое тем временем взял другой процесс,
+    пропускается.
+    """
+
+    def __init__(self, outbox: Outbox, poll_interval: float = 5, max_backoff: float = 300,
+                 max_attempts: int = 20, lease: float = 60, on_delivered=None, on_failed=None):
+        self.outbox = outbox
+        self.lease = lease
+        # Метка процесса в закреплении сообщений
+        self.owner = uuid.uuid4().hex
+        # Вызываются в отдельном потоке с order_id доставленного или недоставленного сообщения
+        self.on_delivered = on_delivered
+        self.on_failed = on_failed
+        self.poll_interval = poll_interval
+        self.max_backoff = max_backoff
+        self.max_attempts = max_attempts
+        self._bot = None
+        self._task = None
+        self._wakeup = asyncio.Event()
+        self._counted_at = 0.0
+
+    def start(self, bot) -> None:
+        """Запускает доставку"""
+        self._bot = bot
+        self._task = asyncio.create_task(self._run(), name="outbox-worker")
+
+    async def stop(self) -> None:
+        """Останавливает доставку (недоставленное останется в очереди)"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def notify(self) -> None:
+        """Сообщает, что в очереди появилось новое сообщение"""
+        self._wakeup.set()
+
+    async def _run(self) -> None:
+        while True:
+            self._wakeup.clear()
+            try:
+                # Снимок для метрик обновляется не чаще раза в poll_interval
+                if time.monotonic() - self._counted_at >= self.poll_interval:
+                    await asyncio.to_thread(self.outbox.refresh_counts)
+                    self._counted_at = time.monotonic()
+                rows = await asyncio.to_thread(self.outbox.due, lease=self.lease, owner=self.owner)
+                if rows:
+                    heartbeat = asyncio.create_task(self._keep_leases([row[0] for row in rows]))
+                    try:
+                        await self._deliver_rows(rows)
+                    finally:
+                        heartbeat.cancel()
+                    continue
+            except Exception as e:
+                # Например, база занята другим процессом: сообщения останутся в
+                # очереди и после истечения закрепления будут отправлены снова
+                logger.error(f"Ошибка при отправке сообщений из очереди: {e}")
+
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _deliver_rows(self, rows) -> None:
+        digests = {}
+        for message_id, chat_id, text, attempts, order_id, digest in rows:
+            if digest:
+                digests.setdefault(chat_id, []).append((message_id, text, attempts, order_id))
+            else:
+                await self._deliver(message_id, chat_id, text, attempts, order_id)
+        for chat_id, messages in digests.items():
+            await self._deliver_digest(chat_id, messages)
+
+    async def _keep_leases(self, message_ids) -> None:
+        """Продлевает закрепление пачки, пока она отправляется"""
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            try:
+                await asyncio.to_thread(self.outbox.renew, message_ids, self.owner, self.lease)
+            except Exception as e:
+                logger.error(f"Не удалось продлить закрепление сообщений: {e}")
+
+    async def _still_ours(self, message_ids) -> set:
+        """Продлевает закрепление перед отправкой; возвращает id, которые можно отправлять"""
+        try:
+            return await asyncio.to_thread(self.outbox.renew, message_ids, self.owner, self.lease)
+        except Exception as e:
+            logger.error(f"Не удалось продлить закрепление сообщений: {e}")
+            return set()
+
+    async def _send(self, chat_id: int, text: str, messages) -> None:
+        """Отправляет текст и отмечает исходные сообщения [(id, attempts, order_id)]"""
+        try:
+            await self._bot.send_message(chat_id=chat_id, text=text)
+        except Exception as e:
+            for message_id, attempts, order_id in messages:
+                if isinstance(e, PERMANENT_ERRORS) or attempts + 1 >= self.max_attempts:
+                    logger.error(
+                        f"❌ Сообщение {message_id} не доставлено (попытка {attempts + 1}), "
+                        f"отправка прекращена: {e}"
+                    )
+                    await asyncio.to_thread(self.outbox.mark_dead, message_id, str(e))
+                    await self._notify(self.on_failed, order_id)
+                    continue
+                if isinstance(e, RetryAfter):
+                    retry_in = retry_after_seconds(e)
+                else:
+                    retry_in = min(self.max_backoff, 2 ** attempts)
+                logger.error(f"❌ Сообщение {message_id} не доставлено (попытка {attempts + 1}): {e}")
+                await asyncio.to_thread(self.outbox.mark_failed, message_id, str(e), retry_in)
+            return
+
+        for message_id, _, order_id in messages:
+            await asyncio.to_thread(self.outbox.mark_sent, message_id)
+            await self._notify(self.on_delivered, order_id)
+
+    @staticmethod
+    async def _notify(callback, order_id) -> None:
+        """Сообщает журналу заказов о результате доставки уведомления"""
+        if order_id is None or callback is None:
+            return
+        try:
+            await asyncio.to_thread(callback, order_id)
+        except Exception as e:
+            logger.error(f"Ошибка при обработке доставки заказа {order_id}: {e}")
+
+    async def _deliver(self, message_id: int, chat_id: int, text: str, attempts: int,
+                       order_id: int = None) -> None:
+        if not await self._still_ours([message_id]):
+            logger.warning(f"Сообщение {message_id} уже отправляет другой процесс")
+            return
+        await self._send(chat_id, text, [(message_id, attempts, order_id)])
+
+    async def _deliver_digest(self, chat_id: int, messages) -> None:
+        """Отправляет сводки чата [(id, текст, attempts, order_id)] одним или несколькими сообщениями"""
+        for _, indexes in split_digest([text for _, text, _, _ in messages]):
+            part = [messages[i] for i in indexes]
+            held = await self._still_ours([message_id for message_id, _, _, _ in part])
+            if len(held) < len(part):
+                logger.warning(f"Сводки {len(part) - len(held)} шт. уже отправляет другой процесс")
+                part = [message for message in part if message[0] in held]
+                if not part:
+                    continue
+            # Меньшая часть сводки всегда умещается в одно сообщение
+            text = split_digest([text for _, text, _, _ in part])[0][0]
+            await self._send(chat_id, text, [
+                (message_id, attempts, order_id) for message_id, _, attempts, order_id in part
+            ])
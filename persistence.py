@@ -0,0 +1,263 @@
+import asyncio
+import json
+import logging
+import pickle
+import time
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+from concurrency import PerUserUpdateProcessor
+from storage import StorageBackend
+
+logger = logging.getLogger(__name__)
+
+USER_DATA = "user_data"
+CHAT_DATA = "chat_data"
+BOT_DATA = "bot_data"
+CONVERSATIONS = "conversations"
+
+
+def _dumps(value) -> bytes:
+    return pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+class SessionManager:
+    """
+    Держит в памяти только user_data и chat_data активных пользователей.
+
+    Данные, к которым не обращались idle_ttl секунд, записываются
+    в хранилище (пустые - удаляются) и убираются из памяти приложения;
+    при следующем обновлении от пользователя они загружаются снова
+    (StoragePersistence.refresh_user_data). Так память растет с числом
+    активных пользователей, а не всех, кто писал боту с момента запуска.
+    """
+
+    def __init__(self, storage: StorageBackend, idle_ttl: float = 1800, sweep_interval: float = 60):
+        self.storage = storage
+        self.idle_ttl = idle_ttl
+        self.sweep_interval = sweep_interval
+        # раздел -> {id: время последнего обращения}
+        self._last_seen = {USER_DATA: {}, CHAT_DATA: {}}
+        self.evicted = 0
+        # раздел -> размер сессий в памяти (pickle) на момент последней выгрузки
+        self._sizes = {USER_DATA: 0, CHAT_DATA: 0}
+        self._task = None
+
+    def is_resident(self, namespace: str, key: int) -> bool:
+        return key in self._last_seen[namespace]
+
+    def touch(self, namespace: str, key: int) -> None:
+        self._last_seen[namespace][key] = time.monotonic()
+
+    async def load_into(self, namespace: str, key: int, data: dict) -> None:
+        """Подгружает выгруженные данные в словарь приложения"""
+        if self.is_resident(namespace, key):
+            self.touch(namespace, key)
+            return
+        value = await asyncio.to_thread(self.storage.load, namespace, str(key))
+        self.touch(namespace, key)
+        if value is not None:
+            for name, item in pickle.loads(value).items():
+                data.setdefault(name, item)
+
+    @staticmethod
+    def _application_data(application, namespace: str) -> dict:
+        # У Application нет публичного способа убрать данные из памяти,
+        # не удаляя их из persistence (drop_user_data удаляет и там)
+        return application._user_data if namespace == USER_DATA else application._chat_data
+
+    def evict_idle(self, application) -> int:
+        """Выгружает простаивающие сессии, возвращает их число"""
+        deadline = time.monotonic() - self.idle_ttl
+        evicted = 0
+        for namespace, last_seen in self._last_seen.items():
+            data = self._application_data(application, namespace)
+            for key in [key for key, seen in last_seen.items() if seen < deadline]:
+                del last_seen[key]
+                value = data.pop(key, None)
+                if value:
+                    self.storage.save(namespace, str(key), _dumps(value))
+                else:
+                    self.storage.delete(namespace, str(key))
+                evicted += 1
+            # Пустые словари, созданные приложением для выгруженных id
+            # (например, при периодическом сохранении), тоже убираем
+            for key in [key for key in data if key not in last_seen]:
+                if not data[key]:
+                    del data[key]
+            # Размер считается здесь, раз в sweep_interval, а не при каждом запросе /metrics
+            self._sizes[namespace] = sum(len(_dumps(value)) for value in list(data.values()))
+        self.evicted += evicted
+        return evicted
+
+    def drop_all(self, application) -> None:
+        """Убирает все сессии из памяти, не сохраняя их"""
+        for namespace, last_seen in self._last_seen.items():
+            self._application_data(application, namespace).clear()
+            last_seen.clear()
+
+    def stats(self, application) -> dict:
+        """
+        Число сессий в памяти и их размер в байтах (в сериализованном виде,
+        на момент последней выгрузки)
+        """
+        return {
+            namespace: (len(self._application_data(application, namespace)), self._sizes[namespace])
+            for namespace in self._last_seen
+        }
+
+    def start(self, application) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(application))
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self, application) -> None:
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            try:
+                evicted = self.evict_idle(application)
+            except Exception as e:
+                logger.error(f"Ошибка при выгрузке сессий: {e}")
+                continue
+            if evicted:
+                logger.info(f"💤 Выгружено простаивающих сессий: {evicted}")
+
+
+class StoragePersistence(BasePersistence):
+    """
+    Persistence для python-telegram-bot поверх StorageBackend.
+
+    Сохраняет user_data, chat_data, bot_data и состояния ConversationHandler.
+    Значения сериализуются pickle, как в стандартной PicklePersistence.
+    С SessionManager user_data и chat_data не загружаются при запуске,
+    а подгружаются при первом обновлении от пользователя или чата.
+    """
+
+    def __init__(self, storage: StorageBackend, update_interval: float = 60, sessions: SessionManager = None):
+        super().__init__(
+            store_data=PersistenceInput(callback_data=False),
+            update_interval=update_interval
+        )
+        self.storage = storage
+        self.sessions = sessions
+
+    async def _load_all(self, namespace: str) -> dict:
+        rows = await asyncio.to_thread(self.storage.load_all, namespace)
+        return {key: pickle.loads(value) for key, value in rows.items()}
+
+    async def get_user_data(self) -> dict:
+        if self.sessions:
+            return {}
+        return {int(key): value for key, value in (await self._load_all(USER_DATA)).items()}
+
+    async def get_chat_data(self) -> dict:
+        if self.sessions:
+            return {}
+        return {int(key): value for key, value in (await self._load_all(CHAT_DATA)).items()}
+
+    async def get_bot_data(self) -> dict:
+        return (await self._load_all(BOT_DATA)).get("bot_data", {})
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str) -> dict:
+        rows = await self._load_all(f"{CONVERSATIONS}:{name}")
+        return {tuple(json.loads(key)): state for key, state in rows.items()}
+
+    async def update_conversation(self, name: str, key, new_state) -> None:
+        namespace = f"{CONVERSATIONS}:{name}"
+        storage_key = json.dumps(list(key))
+        if new_state is None:
+            self.storage.delete(namespace, storage_key)
+        else:
+            self.storage.save(namespace, storage_key, _dumps(new_state))
+
+    async def update_user_data(self, user_id: int, data) -> None:
+        # Выгруженную сессию уже сохранил SessionManager; здесь была бы
+        # пустая копия, созданная приложением
+        if self.sessions and not self.sessions.is_resident(USER_DATA, user_id):
+            return
+        self.storage.save(USER_DATA, str(user_id), _dumps(data))
+
+    async def update_chat_data(self, chat_id: int, data) -> None:
+        if self.sessions and not self.sessions.is_resident(CHAT_DATA, chat_id):
+            return
+        self.storage.save(CHAT_DATA, str(chat_id), _dumps(data))
+
+    async def update_bot_data(self, data) -> None:
+        self.storage.save(BOT_DATA, "bot_data", _dumps(data))
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        self.storage.delete(CHAT_DATA, str(chat_id))
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self.storage.delete(USER_DATA, str(user_id))
+
+    async def refresh_user_data(self, user_id: int, user_data) -> None:
+        if self.sessions:
+            await self.sessions.load_into(USER_DATA, user_id, user_data)
+
+    async def refresh_chat_data(self, chat_id: int, chat_data) -> None:
+        if self.sessions:
+            await self.sessions.load_into(CHAT_DATA, chat_id, chat_data)
+
+    async def refresh_bot_data(self, bot_data) -> None:
+        pass
+
+    async def flush(self) -> None:
+        await asyncio.to_thread(self.storage.flush)
+
+    @staticmethod
+    async def _drain(application) -> None:
+        """Ждет обработки уже принятых обновлений"""
+        await application.update_queue.join()
+        if isinstance(application.update_processor, PerUserUpdateProcessor):
+            await application.update_processor.wait_idle()
+
+    async def reload(self, application, save: bool = True, drain_timeout: float = 5) -> None:
+        """
+        Перечитывает сессии и состояния диалогов из хранилища.
+
+        Нужен, когда пользователей процесса обслуживал или начинает
+        обслуживать другой процесс (cluster.py): данные в памяти устарели
+        бы. С save несохраненные изменения сначала записываются, без save
+        отбрасываются - их уже заменили данные другого процесса.
+        """
+        try:
+            await asyncio.wait_for(self._drain(application), drain_timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Не дождались обработки обновлений перед перечитыванием сессий")
+        if save:
+            await application.update_persistence()
+            await self.flush()
+
+        if self.sessions:
+            # Подгрузятся из хранилища при следующем обновлении от пользователя
+            self.sessions.drop_all(application)
+        else:
+            for namespace, stored in ((USER_DATA, await self.get_user_data()),
+                                      (CHAT_DATA, await self.get_chat_data())):
+                data = SessionManager._application_data(application, namespace)
+                data.clear()
+                data.update(stored)
+
+        # Состояния ConversationHandler читаются только при запуске; публичного
+        # способа перечитать их нет, поэтому словари обновляются на месте
+        for name, conversations in application._conversation_handler_conversations.items():
+            stored = await self.get_conversations(name)
+            conversations.pop_accessed_keys()
+            conversations.data.clear()
+            conversations.update_no_track(stored)
+        logger.info("🔄 Сессии и состояния диалогов перечитаны из хранилища")
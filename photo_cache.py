@@ -0,0 +1,134 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+def file_hash(path: str) -> str:
+    """Считает SHA-256 содержимого файла"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class PhotoCache:
+    """
+    Кэш file_id фотографий, которые Telegram уже получил от бота.
+
+    Запись привязана к ключу фото (id товара и вариант) и хэшу содержимого
+    файла: если файл на диске изменился, запись удаляется и фото
+    загружается заново.
+    Чтобы не пересчитывать хэш при каждом показе, вместе с записью
+    хранятся размер и время изменения файла.
+
+    get, remember и invalidate обращаются к диску и вызываются из пула
+    потоков (см. media.MediaProvider), поэтому защищены блокировкой.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._entries = {}
+        self._lock = threading.RLock()
+        # Статистика обращений для мониторинга
+        self.hits = 0
+        self.misses = 0
+        # Растет при каждом изменении записей (для кэшей, построенных по file_id)
+        self.version = 0
+        self._load()
+
+    def _load(self) -> None:
+        """Загружает кэш с диска"""
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self._entries = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.error(f"Не удалось прочитать кэш фото {self.path}: {e}")
+            self._entries = {}
+
+    def _save(self) -> None:
+        """Атомарно сохраняет кэш на диск"""
+        # Свой временный файл у каждого процесса (режим cluster)
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self._entries, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.error(f"Не удалось сохранить кэш фото {self.path}: {e}")
+
+    def get(self, key: str, path: str):
+        """Возвращает file_id фото или None, если фото нужно загрузить"""
+        with self._lock:
+            file_id = self._lookup(key, path)
+            if file_id is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return file_id
+
+    def peek(self, key: str):
+        """file_id без проверки файла на диске (там, где нельзя ждать диск)"""
+        entry = self._entries.get(key)
+        return entry['file_id'] if entry else None
+
+    def _lookup(self, key: str, path: str):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        try:
+            stat = os.stat(path)
+        except OSError:
+            self.invalidate(key)
+            return None
+
+        if entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime_ns:
+            return entry['file_id']
+
+        # Метаданные файла изменились - сверяем содержимое
+        if file_hash(path) != entry['hash']:
+            logger.info(f"Фото {key} изменилось, file_id сброшен")
+            self.invalidate(key)
+            return None
+
+        entry['size'] = stat.st_size
+        entry['mtime'] = stat.st_mtime_ns
+        self._save()
+        return entry['file_id']
+
+    def remember(self, key: str, path: str, message) -> None:
+        """Запоминает file_id из сообщения, которое вернул Telegram"""
+        photo_sizes = getattr(message, 'photo', None)
+        if not photo_sizes:
+            return
+
+        try:
+            stat = os.stat(path)
+            digest = file_hash(path)
+        except OSError as e:
+            logger.error(f"Не удалось прочитать фото {path}: {e}")
+            return
+
+        with self._lock:
+            self._entries[key] = {
+                'file_id': photo_sizes[-1].file_id,
+                'hash': digest,
+                'size': stat.st_size,
+                'mtime': stat.st_mtime_ns,
+            }
+            self.version += 1
+            self._save()
+
+    def invalidate(self, key: str) -> None:
+        """Удаляет запись о фото"""
+        with self._lock:
+            if self._entries.pop(key, None) is not None:
+                self.version += 1
+                self._save()
@@ -10,6 +10,7 @@ PRODUCTS = [
         "name": "Свеча 'Ванильная мечта'",
         "description": "Нежная ваниль с нотками сливочного крема. Горение до 40 часов. Изготовлена из натурального соевого воска с ароматическими маслами высшего качества.",
         "price": 1200,
+        "category": "Сладкие",
         "photo": os.path.join(BASE_DIR, "photos", "candle1.jpg")
     },
     {
@@ -17,6 +18,7 @@ PRODUCTS = [
         "name": "Свеча 'Лесной мох'",
         "description": "Свежий аромат мха, хвои и древесных нот. Горение до 45 часов. Идеально подходит для медитации и релаксации.",
         "price": 1500,
+        "category": "Древесные",
         "photo": os.path.join(BASE_DIR, "photos", "candle2.jpg")
     },
     {
@@ -24,6 +26,7 @@ PRODUCTS = [
         "name": "Свеча 'Морская свежесть'",
         "description": "Океанические ноты с аккордами цитрусов и морского бриза. Горение до 35 часов. Создает атмосферу морского побережья.",
         "price": 1400,
+        "category": "Свежие",
         "photo": os.path.join(BASE_DIR, "photos", "candle3.jpg")
     },
     {
@@ -31,6 +34,7 @@ PRODUCTS = [
         "name": "Свеча 'Корица и яблоко'",
         "description": "Теплый аромат печеных яблок с корицей и ванилью. Идеально для осени. Горение до 50 часов. Натуральные эфирные масла.",
         "price": 1300,
+        "category": "Пряные",
         "photo": os.path.join(BASE_DIR, "photos", "candle4.jpg")
     },
     {
@@ -38,6 +42,7 @@ PRODUCTS = [
         "name": "Свеча 'Лавандовый рай'",
         "description": "Успокаивающий аромат лаванды с легкими цветочными нотами. Горение до 42 часов. Помогает снять стресс и улучшить сон.",
         "price": 1250,
+        "category": "Цветочные",
         "photo": os.path.join(BASE_DIR, "photos", "candle5.jpg")
     },
     {
@@ -45,6 +50,7 @@ PRODUCTS = [
         "name": "Свеча 'Кофейное наслаждение'",
         "description": "Бодрящий аромат свежесваренного кофе с карамельными нотами. Горение до 38 часов. Идеально для утра и рабочего настроения.",
         "price": 1350,
+        "category": "Сладкие",
         "photo": os.path.join(BASE_DIR, "photos", "candle6.jpg")
     }
 ]
@@ -0,0 +1,201 @@
+import asyncio
+import datetime
+import logging
+import random
+import time
+
+import httpx
+from telegram.error import BadRequest, NetworkError, RetryAfter
+from telegram.ext import BaseRateLimiter
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Запросы, повтор которых ничего не дублирует (в отличие от send*)
+IDEMPOTENT_PREFIXES = ("get", "set", "edit", "answer", "delete")
+# Ошибки httpx, при которых запрос точно не ушел в Telegram
+NOT_SENT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+
+def retry_after_seconds(error: RetryAfter) -> float:
+    """Время ожидания из RetryAfter в секундах"""
+    delay = error.retry_after
+    if isinstance(delay, datetime.timedelta):
+        return delay.total_seconds()
+    return float(delay)
+
+
+def can_retry(endpoint: str, error: NetworkError) -> bool:
+    """
+    Можно ли повторить запрос после сетевой ошибки.
+
+    Если ответ не пришел (например, TimedOut при чтении), Telegram мог уже
+    выполнить запрос, и повтор sendMessage отправил бы сообщение дважды.
+    Поэтому такие запросы повторяются, только если соединение не было
+    установлено.
+    """
+    return endpoint.startswith(IDEMPOTENT_PREFIXES) or isinstance(error.__cause__, NOT_SENT_ERRORS)
+
+
+class TokenBucket:
+    """Корзина токенов: rate запросов в секунду, не больше capacity подряд"""
+
+    __slots__ = ('rate', 'capacity', '_tokens', '_updated', '_paused_until')
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def delay(self, reserve: float = 0.0) -> float:
+        """
+        Сколько ждать до следующего токена (0 - можно сразу).
+
+        reserve - сколько токенов должно остаться в корзине после этого
+        запроса (для фоновых запросов, которые не должны занимать весь лимит).
+        """
+        now = time.monotonic()
+        if now < self._paused_until:
+            return self._paused_until - now
+        self._refill(now)
+        needed = 1 + min(reserve, self.capacity - 1)
+        if self._tokens >= needed:
+            return 0.0
+        return (needed - self._tokens) / self.rate
+
+    def take(self) -> None:
+        """Забирает токен (вызывать после delay() == 0)"""
+        self._tokens -= 1
+
+    def pause(self, seconds: float) -> None:
+        """Запрещает запросы на указанное время (после RetryAfter)"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    @property
+    def idle(self) -> bool:
+        """Корзина полна и не на паузе - ее можно забыть"""
+        now = time.monotonic()
+        self._refill(now)
+        return self._tokens >= self.capacity and now >= self._paused_until
+
+
+class TokenBucketRateLimiter(BaseRateLimiter):
+    """
+    Ограничитель исходящих запросов к Bot API.
+
+    Перед каждым запросом с chat_id берет токен из общей корзины и из корзины
+    чата (у групп лимит ниже, чем у личных чатов). При RetryAfter ставит на
+    паузу корзину чата (у запросов без чата - общую корзину), чтобы flood
+    control в одном чате не задерживал ответы в остальных, и повторяет
+    запрос; временные сетевые ошибки
+    повторяются с экспоненциальной задержкой и случайным разбросом, если
+    повтор не может задублировать сообщение (см. can_retry).
+
+    Запросы с rate_limit_args={"low_priority": True} (например, рассылки)
+    ждут, пока в общей корзине останется low_priority_reserve от лимита:
+    эта часть всегда остается ответам покупателям.
+    """
+
+    # Сколько корзин чатов держать, прежде чем чистить неактивные
+    MAX_IDLE_BUCKETS = 10000
+
+    def __init__(
+        self,
+        overall_rate: float = 30,
+        private_chat_rate: float = 1,
+        group_chat_rate: float = 20 / 60,
+        chat_burst: float = 3,
+        max_retries: int = 3,
+        base_backoff: float = 0.5,
+        low_priority_reserve: float = 0.5,
+    ):
+        self.overall = TokenBucket(overall_rate, overall_rate)
+        self.private_chat_rate = private_chat_rate
+        self.group_chat_rate = group_chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.base_backoff = base_backoff
+        self.low_priority_reserve = low_priority_reserve
+        self._chats = {}
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        self._chats.clear()
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= self.MAX_IDLE_BUCKETS:
+                self._chats = {key: b for key, b in self._chats.items() if not b.idle}
+            is_group = isinstance(chat_id, str) or chat_id < 0
+            rate = self.group_chat_rate if is_group else self.private_chat_rate
+            bucket = self._chats[chat_id] = TokenBucket(rate, self.chat_burst)
+        return bucket
+
+    async def _acquire(self, chat_bucket, reserve: float = 0.0) -> None:
+        """Ждет, пока появятся токены в корзине чата и в общей корзине"""
+        while True:
+            delay = max(self.overall.delay(reserve), chat_bucket.delay() if chat_bucket else 0.0)
+            if delay <= 0:
+                self.overall.take()
+                if chat_bucket:
+                    chat_bucket.take()
+                return
+            await asyncio.sleep(delay)
+
+    @staticmethod
+    async def _timed_call(callback, args, kwargs, endpoint):
+        """Выполняет запрос, записывая время и ошибки в метрики"""
+        started = time.perf_counter()
+        try:
+            return await callback(*args, **kwargs)
+        except Exception as e:
+            metrics.API_ERRORS.inc(endpoint, type(e).__name__)
+            raise
+        finally:
+            metrics.API_LATENCY.observe(time.perf_counter() - started, endpoint)
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get('chat_id')
+        # Запросы без чата (answerCallbackQuery, getUpdates и т.п.) не ограничиваем
+        chat_bucket = self._chat_bucket(chat_id) if chat_id is not None else None
+        low_priority = isinstance(rate_limit_args, dict) and rate_limit_args.get("low_priority")
+        reserve = self.overall.capacity * self.low_priority_reserve if low_priority else 0.0
+
+        attempt = 0
+        while True:
+            if chat_bucket:
+                waiting_since = time.perf_counter()
+                await self._acquire(chat_bucket, reserve)
+                metrics.API_RATE_LIMIT_WAIT.observe(time.perf_counter() - waiting_since, endpoint)
+            try:
+                return await self._timed_call(callback, args, kwargs, endpoint)
+            except RetryAfter as e:
+                delay = retry_after_seconds(e)
+                if attempt >= self.max_retries:
+                    raise
+                logger.warning(f"Flood control при {endpoint}: ждем {delay} с")
+                if chat_bucket:
+                    chat_bucket.pause(delay)
+                else:
+                    self.overall.pause(delay)
+                await asyncio.sleep(delay)
+            except BadRequest:
+                # Ошибка в самом запросе - повтор не поможет
+                raise
+            except NetworkError as e:
+                if attempt >= self.max_retries or not can_retry(endpoint, e):
+                    raise
+                delay = self.base_backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+                logger.warning(f"Сетевая ошибка при {endpoint}: {e}. Повтор через {delay:.1f} с")
+                await asyncio.sleep(delay)
+            attempt += 1
@@ -0,0 +1,182 @@
+import bisect
+import functools
+import re
+
+# Слова, которые не участвуют в поиске
+STOP_WORDS = frozenset({"и", "в", "во", "на", "с", "со", "для", "из", "до", "от", "по", "к", "а", "или"})
+
+# Окончания, которые отрезает стеммер (сначала длинные)
+ENDINGS = tuple(sorted({
+    "иями", "ями", "ами", "ого", "его", "ому", "ему", "ыми", "ими",
+    "ой", "ей", "ий", "ый", "ая", "яя", "ое", "ее", "ые", "ие", "ую", "юю",
+    "ов", "ев", "ом", "ем", "ах", "ях", "ам", "ям", "ью", "ия", "ть",
+    "а", "я", "о", "е", "ы", "и", "у", "ю", "ь", "й",
+}, key=len, reverse=True))
+
+# Короче этого основа не становится
+MIN_STEM = 3
+
+WORD_RE = re.compile(r"\w+")
+PRICE_RANGE_RE = re.compile(r"^(\d+)-(\d+)$")
+
+
+def normalize(text: str) -> str:
+    """Нижний регистр и ё -> е"""
+    return text.lower().replace("ё", "е")
+
+
+@functools.lru_cache(maxsize=65536)
+def stem(word: str) -> str:
+    """Отрезает у слова типичное русское окончание"""
+    for ending in ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= MIN_STEM:
+            return word[:-len(ending)]
+    return word
+
+
+def terms(text: str):
+    """Основы слов текста без стоп-слов"""
+    return [stem(word) for word in WORD_RE.findall(normalize(text)) if word not in STOP_WORDS]
+
+
+def parse_query(text: str):
+    """
+    Разбирает строку поиска.
+
+    Возвращает (слова, категория, мин. цена, макс. цена). Фильтры:
+    #категория, "от 1000", "до 1500" или диапазон "1000-1500".
+    """
+    words = []
+    category = min_price = max_price = None
+    tokens = normalize(text).split()
+    i = 0
+    while i < len(tokens):
+        token = tokens[i]
+        next_token = tokens[i + 1] if i + 1 < len(tokens) else ""
+        price_range = PRICE_RANGE_RE.match(token)
+        if token.startswith("#") and len(token) > 1:
+            category = token[1:]
+        elif token in ("от", "до") and next_token.isdigit():
+            if token == "от":
+                min_price = int(next_token)
+            else:
+                max_price = int(next_token)
+            i += 1
+        elif price_range:
+            min_price, max_price = int(price_range.group(1)), int(price_range.group(2))
+        else:
+            words.append(token)
+        i += 1
+    return " ".join(words), category, min_price, max_price
+
+
+class SearchIndex:
+    """
+    Обратный индекс по названию и описанию товаров.
+
+    Хранит основы слов (см. stem) и для каждой - множество id товаров.
+    Слова запроса ищутся по префиксу основы, товар должен подходить под все
+    слова. Индекс не меняется после создания: при обновлении каталога
+    updated() возвращает новый индекс, пересчитывая только изменившиеся
+    товары, поэтому старый снимок каталога продолжает искать по-старому.
+    """
+
+    def __init__(self, products=()):
+        # основа -> frozenset id товаров
+        self._postings = {}
+        # отсортированные основы для поиска по префиксу
+        self._terms = []
+        # id товара -> (название, описание, основы)
+        self._documents = {}
+        # нормализованная категория -> frozenset id товаров
+        self._categories = {}
+        if products:
+            self._apply(products)
+
+    def _apply(self, products) -> None:
+        """Добавляет, меняет и удаляет товары (products - полный новый список)"""
+        seen = set()
+        added = {}
+        removed = {}
+        categories = {}
+
+        for product in products:
+            product_id = product['id']
+            seen.add(product_id)
+            category = normalize(product.get('category') or "")
+            if category:
+                categories.setdefault(category, set()).add(product_id)
+
+            document = self._documents.get(product_id)
+            if document and document[0] == product['name'] and document[1] == product['description']:
+                continue
+            new_terms = frozenset(terms(f"{product['name']} {product['description']}"))
+            old_terms = document[2] if document else frozenset()
+            for term in new_terms - old_terms:
+                added.setdefault(term, set()).add(product_id)
+            for term in old_terms - new_terms:
+                removed.setdefault(term, set()).add(product_id)
+            self._documents[product_id] = (product['name'], product['description'], new_terms)
+
+        for product_id in [pid for pid in self._documents if pid not in seen]:
+            for term in self._documents.pop(product_id)[2]:
+                removed.setdefault(term, set()).add(product_id)
+
+        new_terms = []
+        for term in added.keys() | removed.keys():
+            ids = (self._postings.get(term, frozenset()) | added.get(term, set())) - removed.get(term, set())
+            if ids:
+                if term not in self._postings:
+                    new_terms.append(term)
+                self._postings[term] = frozenset(ids)
+            elif term in self._postings:
+                del self._postings[term]
+                del self._terms[bisect.bisect_left(self._terms, term)]
+        for term in new_terms:
+            bisect.insort(self._terms, term)
+
+        self._categories = {name: frozenset(ids) for name, ids in categories.items()}
+
+    def updated(self, products) -> "SearchIndex":
+        """Новый индекс для нового списка товаров; текущий не меняется"""
+        index = SearchIndex()
+        index._postings = dict(self._postings)
+        index._terms = list(self._terms)
+        index._documents = dict(self._documents)
+        index._apply(products)
+        return index
+
+    @property
+    def categories(self):
+        """Нормализованные названия категорий"""
+        return sorted(self._categories)
+
+    def _prefix_match(self, prefix: str):
+        """id товаров, у которых есть основа, начинающаяся с prefix"""
+        ids = set()
+        for position in range(bisect.bisect_left(self._terms, prefix), len(self._terms)):
+            term = self._terms[position]
+            if not term.startswith(prefix):
+                break
+            ids |= self._postings[term]
+        return ids
+
+    def match(self, text: str, category: str = None):
+        """
+        id товаров, подходящих под все слова text и категорию.
+
+        None означает "без ограничений" (пустой запрос без категории).
+        """
+        result = None
+        if category:
+            category = normalize(category)
+            result = set()
+            for name, ids in self._categories.items():
+                if name.startswith(category):
+                    result |= ids
+        for term in terms(text):
+            ids = self._prefix_match(term)
+            result = ids if result is None else result & ids
+            if not result:
+                return set()
+        return result
@@ -0,0 +1,151 @@
+import os
+
+import config
+
+# Необязательные настройки бота. Любую из них можно переопределить в config.py,
+# иначе используются значения по умолчанию ниже.
+
+# Определяем базовую директорию
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Папка для локальных данных (хранилище, журналы и т.п.)
+DATA_DIR = getattr(config, 'DATA_DIR', os.path.join(BASE_DIR, "data"))
+
+# Файл, в котором хранятся file_id уже загруженных фото
+PHOTO_CACHE_PATH = getattr(config, 'PHOTO_CACHE_PATH', os.path.join(BASE_DIR, "photo_cache.json"))
+
+# Хранилище корзин и состояний диалогов: "sqlite" или "memory"
+STORAGE_BACKEND = getattr(config, 'STORAGE_BACKEND', "sqlite")
+STORAGE_PATH = getattr(config, 'STORAGE_PATH', os.path.join(DATA_DIR, "storage.sqlite3"))
+# Как часто (в секундах) накопленные изменения сбрасываются в SQLite
+STORAGE_FLUSH_INTERVAL = getattr(config, 'STORAGE_FLUSH_INTERVAL', 2.0)
+# Как часто (в секундах) Application передает изменения user_data в хранилище
+PERSISTENCE_UPDATE_INTERVAL = getattr(config, 'PERSISTENCE_UPDATE_INTERVAL', 5)
+# Через сколько секунд без обновлений сессия пользователя (корзина,
+# позиция в каталоге) выгружается из памяти в хранилище (None - никогда)
+SESSION_IDLE_TTL = getattr(config, 'SESSION_IDLE_TTL', 30 * 60)
+# Как часто искать простаивающие сессии, в секундах
+SESSION_SWEEP_INTERVAL = getattr(config, 'SESSION_SWEEP_INTERVAL', 60)
+
+# Режим получения обновлений: "polling" или "webhook"
+BOT_MODE = getattr(config, 'BOT_MODE', "polling")
+# Публичный адрес, который сообщается Telegram (например, https://example.com/webhook)
+WEBHOOK_URL = getattr(config, 'WEBHOOK_URL', None)
+# Путь, на котором локальный сервер принимает обновления
+WEBHOOK_PATH = getattr(config, 'WEBHOOK_PATH', "/webhook")
+# Секрет из заголовка X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_SECRET = getattr(config, 'WEBHOOK_SECRET', None)
+WEBHOOK_HOST = getattr(config, 'WEBHOOK_HOST', "0.0.0.0")
+WEBHOOK_PORT = getattr(config, 'WEBHOOK_PORT', 8080)
+# Регистрировать ли webhook в Telegram при запуске (за балансировщиком достаточно одной реплики)
+WEBHOOK_REGISTER = getattr(config, 'WEBHOOK_REGISTER', True)
+
+# Сколько обновлений разных пользователей обрабатывать одновременно
+# (1 - строго по одному, как раньше). Обновления одного пользователя
+# всегда выполняются по порядку.
+CONCURRENT_UPDATES = getattr(config, 'CONCURRENT_UPDATES', 32)
+
+# Лимиты исходящих запросов к Bot API (запросов в секунду)
+API_OVERALL_RATE = getattr(config, 'API_OVERALL_RATE', 30)
+API_PRIVATE_CHAT_RATE = getattr(config, 'API_PRIVATE_CHAT_RATE', 1)
+API_GROUP_CHAT_RATE = getattr(config, 'API_GROUP_CHAT_RATE', 20 / 60)
+# Сколько раз повторять запрос после RetryAfter или сетевой ошибки
+API_MAX_RETRIES = getattr(config, 'API_MAX_RETRIES', 3)
+# Доля общего лимита, которую фоновые запросы (рассылки) оставляют ответам покупателям
+API_LOW_PRIORITY_RESERVE = getattr(config, 'API_LOW_PRIORITY_RESERVE', 0.5)
+
+# Рассылки (/broadcast): сообщений в секунду и сколько получателей брать за раз
+BROADCAST_RATE = getattr(config, 'BROADCAST_RATE', 10)
+BROADCAST_BATCH_SIZE = getattr(config, 'BROADCAST_BATCH_SIZE', 50)
+
+# База заказов и очереди уведомлений администратору
+ORDERS_DB_PATH = getattr(config, 'ORDERS_DB_PATH', os.path.join(DATA_DIR, "orders.sqlite3"))
+# Журнал событий воронки покупок для отчета python analytics.py (None - не вести)
+EVENTS_DB_PATH = getattr(config, 'EVENTS_DB_PATH', os.path.join(DATA_DIR, "events.sqlite3"))
+# Как часто (в секундах) накопленные события записываются в базу
+EVENTS_FLUSH_INTERVAL = getattr(config, 'EVENTS_FLUSH_INTERVAL', 5.0)
+# Собирать уведомления о заказах в сводку: первый заказ ждет не дольше
+# стольких секунд, остальные уходят вместе с ним (0 - каждый заказ сразу)
+ADMIN_DIGEST_WINDOW = getattr(config, 'ADMIN_DIGEST_WINDOW', 0)
+# Заказы на эту сумму и больше отправляются сразу, без сводки (None - все в сводке)
+ADMIN_URGENT_ORDER_TOTAL = getattr(config, 'ADMIN_URGENT_ORDER_TOTAL', 5000)
+# После стольких неудачных попыток уведомление считается недоставленным
+# (около часа при паузах между попытками до 5 минут)
+OUTBOX_MAX_ATTEMPTS = getattr(config, 'OUTBOX_MAX_ATTEMPTS', 20)
+
+# Кэш прочитанных файлов фото (байт) и число потоков для работы с диском
+MEDIA_CACHE_BYTES = getattr(config, 'MEDIA_CACHE_BYTES', 32 * 1024 * 1024)
+MEDIA_IO_WORKERS = getattr(config, 'MEDIA_IO_WORKERS', 4)
+
+# Уменьшенные варианты фото товаров (см. images.py)
+IMAGE_CACHE_DIR = getattr(config, 'IMAGE_CACHE_DIR', os.path.join(DATA_DIR, "photos"))
+# Формат вариантов: "JPEG" или "WEBP"
+IMAGE_FORMAT = getattr(config, 'IMAGE_FORMAT', "JPEG")
+# Число процессов для сборки (None - по числу ядер)
+IMAGE_WORKERS = getattr(config, 'IMAGE_WORKERS', None)
+# Собирать недостающие варианты в фоне при запуске бота
+BUILD_IMAGES_ON_STARTUP = getattr(config, 'BUILD_IMAGES_ON_STARTUP', True)
+
+# Страница /metrics в формате Prometheus. В режиме webhook она доступна
+# на сервере webhook, в режиме polling - на отдельном порту (None - выключено)
+METRICS_HOST = getattr(config, 'METRICS_HOST', "127.0.0.1")
+METRICS_PORT = getattr(config, 'METRICS_PORT', 9100)
+
+# Журнал: формат "json" (одна запись - одна строка) или "text", общий
+# уровень и уровни отдельных логгеров
+LOG_FORMAT = getattr(config, 'LOG_FORMAT', "json")
+LOG_LEVEL = getattr(config, 'LOG_LEVEL', "INFO")
+LOG_LEVELS = getattr(config, 'LOG_LEVELS', {})
+# Какая доля частых записей ниже WARNING попадает в журнал: по полю event
+# ("message" - сообщения покупателей вне диалога) или по имени логгера
+# ("httpx" - каждый запрос к Bot API)
+LOG_SAMPLE_RATES = getattr(config, 'LOG_SAMPLE_RATES', {"message": 0.1, "httpx": 0.05})
+# Поля записей с личными данными, значения которых не попадают в журнал
+LOG_REDACT_FIELDS = getattr(config, 'LOG_REDACT_FIELDS', ("text", "customer_name", "customer_phone"))
+# Сколько записей может ждать в очереди потока записи (лишние отбрасываются)
+LOG_QUEUE_SIZE = getattr(config, 'LOG_QUEUE_SIZE', 10000)
+
+# Внешний файл каталога (JSON, CSV или SQLite с таблицей products).
+# None - товары берутся из products.py
+CATALOG_PATH = getattr(config, 'CATALOG_PATH', None)
+# Как часто проверять, не изменился ли файл каталога, в секундах
+CATALOG_RELOAD_INTERVAL = getattr(config, 'CATALOG_RELOAD_INTERVAL', 2.0)
+
+# Сколько товаров показывать на странице результатов /search
+SEARCH_PAGE_SIZE = getattr(config, 'SEARCH_PAGE_SIZE', 8)
+
+# Inline-режим (@бот запрос): товаров на странице (не больше 50),
+# сколько секунд Telegram может кэшировать ответ и сколько разных
+# запросов держать в кэше бота
+INLINE_PAGE_SIZE = getattr(config, 'INLINE_PAGE_SIZE', 20)
+INLINE_CACHE_TIME = getattr(config, 'INLINE_CACHE_TIME', 300)
+INLINE_CACHE_SIZE = getattr(config, 'INLINE_CACHE_SIZE', 1024)
+
+# Сколько товаров в одной странице плитки /grid (от 2 до 10 - ограничение альбома)
+GRID_PAGE_SIZE = getattr(config, 'GRID_PAGE_SIZE', 6)
+
+# Листание каталога ⬅️/➡️: карточка обновляется через столько секунд после
+# последнего нажатия, промежуточные товары не отправляются (0 - после каждого нажатия)
+CATALOG_NAV_DEBOUNCE = getattr(config, 'CATALOG_NAV_DEBOUNCE', 0.3)
+
+# Сколько секунд держать резерв товаров, пока покупатель оформляет заказ
+RESERVATION_TTL = getattr(config, 'RESERVATION_TTL', 15 * 60)
+# Как часто перечитывать остатки из базы (продажи других копий бота), в секундах
+INVENTORY_REFRESH_INTERVAL = getattr(config, 'INVENTORY_REFRESH_INTERVAL', 10)
+
+# Несколько процессов бота за одним webhook (python cluster.py): сколько
+# процессов запускать, на каком адресе и с какого порта они слушают
+# (порты идут подряд)
+CLUSTER_WORKERS = getattr(config, 'CLUSTER_WORKERS', os.cpu_count() or 2)
+CLUSTER_HOST = getattr(config, 'CLUSTER_HOST', "127.0.0.1")
+CLUSTER_WORKER_PORT = getattr(config, 'CLUSTER_WORKER_PORT', 8100)
+# Адреса уже запущенных процессов (например, в отдельных контейнерах):
+# ["http://bot-1:8080/webhook", ...]. Если задано, процессы не создаются
+CLUSTER_WORKER_URLS = getattr(config, 'CLUSTER_WORKER_URLS', None)
+# Секрет между маршрутизатором и процессами (None - случайный при запуске)
+CLUSTER_SECRET = getattr(config, 'CLUSTER_SECRET', None)
+# Как часто проверять /healthz процессов, в секундах
+CLUSTER_HEALTH_INTERVAL = getattr(config, 'CLUSTER_HEALTH_INTERVAL', 2.0)
+
+# Другой сервер Bot API (например, fake_bot_api.py для локальной проверки)
+BOT_API_URL = getattr(config, 'BOT_API_URL', None)
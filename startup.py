@@ -0,0 +1,46 @@
+"""
+Замеры запуска бота.
+
+Модуль импортируется первым в bot.py, поэтому отсчет идет с начала
+импорта библиотек. Этапы отмечаются вызовами mark(), а после первого
+обработанного обновления в лог пишется отчет: сколько заняли импорт,
+создание баз и кэшей, сборка Application, инициализация и сколько
+прошло до ответа на первое обновление.
+"""
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class StartupTimer:
+    """Длительность этапов запуска"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self._last = self.started
+        # (этап, длительность, время с начала запуска), в секундах
+        self.phases = []
+        self.reported = False
+
+    def mark(self, phase: str) -> None:
+        """Завершает этап: его длительность - время с предыдущей отметки"""
+        now = time.perf_counter()
+        self.phases.append((phase, now - self._last, now - self.started))
+        self._last = now
+
+    def report(self) -> str:
+        lines = ["⏱️ Запуск бота:"]
+        for phase, duration, total in self.phases:
+            lines.append(f"  {phase:<32}{duration * 1000:>8.0f} мс  (с начала {total * 1000:.0f} мс)")
+        return "\n".join(lines)
+
+    async def on_update(self, update, context) -> None:
+        """Обработчик последней группы: отмечает первое обработанное обновление"""
+        if not self.reported:
+            self.reported = True
+            self.mark("первое обновление")
+            logger.info(self.report())
+
+
+timer = StartupTimer()
@@ -0,0 +1,214 @@
+import logging
+import os
+import sqlite3
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class StorageBackend:
+    """
+    Базовое хранилище: пары (раздел, ключ) -> байты.
+
+    Разделы - это, например, "user_data" или "conversations:order".
+    Сериализацией значений занимается вызывающий код.
+    """
+
+    def load(self, namespace: str, key: str):
+        """Возвращает значение или None"""
+        raise NotImplementedError
+
+    def load_all(self, namespace: str) -> dict:
+        """Возвращает все значения раздела"""
+        raise NotImplementedError
+
+    def keys(self, namespace: str) -> list:
+        """Возвращает ключи раздела (без чтения значений, если хранилище это умеет)"""
+        return list(self.load_all(namespace))
+
+    def save(self, namespace: str, key: str, value: bytes) -> None:
+        """Сохраняет значение"""
+        raise NotImplementedError
+
+    def delete(self, namespace: str, key: str) -> None:
+        """Удаляет значение"""
+        raise NotImplementedError
+
+    def flush(self) -> None:
+        """Сбрасывает накопленные изменения"""
+
+    def close(self) -> None:
+        """Закрывает хранилище"""
+        self.flush()
+
+
+class MemoryStorage(StorageBackend):
+    """Хранилище в памяти процесса (для тестов и локального запуска)"""
+
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def load(self, namespace, key):
+        with self._lock:
+            return self._data.get(namespace, {}).get(key)
+
+    def load_all(self, namespace):
+        with self._lock:
+            return dict(self._data.get(namespace, {}))
+
+    def save(self, namespace, key, value):
+        with self._lock:
+            self._data.setdefault(namespace, {})[key] = value
+
+    def delete(self, namespace, key):
+        with self._lock:
+            self._data.get(namespace, {}).pop(key, None)
+
+
+class SQLiteStorage(StorageBackend):
+    """
+    SQLite-хранилище с отложенной записью.
+
+    save() и delete() только запоминают изменение в памяти; фоновый поток
+    раз в flush_interval секунд записывает все накопленное одной транзакцией.
+    Повторные записи одного ключа между сбросами схлопываются в одну.
+    """
+
+    def __init__(self, path: str, flush_interval: float = 2.0):
+        self.path = path
+        self.flush_interval = flush_interval
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS kv ("
+            " namespace TEXT NOT NULL,"
+            " key TEXT NOT NULL,"
+            " value BLOB NOT NULL,"
+            " PRIMARY KEY (namespace, key)"
+            ") WITHOUT ROWID"
+        )
+
+        # (раздел, ключ) -> байты или None (удаление)
+        self._pending = {}
+        # Изменения, которые сейчас записываются (видны load до коммита)
+        self._flushing = {}
+        self._pending_lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._flush_loop, name="sqlite-storage", daemon=True)
+        self._thread.start()
+
+    def load(self, namespace, key):
+        with self._pending_lock:
+            for changes in (self._pending, self._flushing):
+                if (namespace, key) in changes:
+                    return changes[(namespace, key)]
+        with self._db_lock:
+            row = self._conn.execute(
+                "SELECT value FROM kv WHERE namespace = ? AND key = ?", (namespace, key)
+            ).fetchone()
+        return row[0] if row else None
+
+    def load_all(self, namespace):
+        # Несохраненные изменения берутся до чтения базы: если сброс
+        # закончится между этими шагами, они уже будут в базе
+        with self._pending_lock:
+            changes = {**self._flushing, **self._pending}
+        with self._db_lock:
+            rows = self._conn.execute(
+                "SELECT key, value FROM kv WHERE namespace = ?", (namespace,)
+            ).fetchall()
+        result = {key: value for key, value in rows}
+        for (pending_namespace, key), value in changes.items():
+            if pending_namespace != namespace:
+                continue
+            if value is None:
+                result.pop(key, None)
+            else:
+                result[key] = value
+        return result
+
+    def keys(self, namespace):
+        with self._pending_lock:
+            changes = {**self._flushing, **self._pending}
+        with self._db_lock:
+            rows = self._conn.execute("SELECT key FROM kv WHERE namespace = ?", (namespace,)).fetchall()
+        result = {key for key, in rows}
+        for (pending_namespace, key), value in changes.items():
+            if pending_namespace != namespace:
+                continue
+            if value is None:
+                result.discard(key)
+            else:
+                result.add(key)
+        return list(result)
+
+    def save(self, namespace, key, value):
+        with self._pending_lock:
+            self._pending[(namespace, key)] = value
+
+    def delete(self, namespace, key):
+        with self._pending_lock:
+            self._pending[(namespace, key)] = None
+
+    def flush(self) -> None:
+        # Сбросы выполняются по одному (фоновый поток и явный flush)
+        with self._db_lock:
+            with self._pending_lock:
+                pending, self._pending = self._pending, {}
+                self._flushing = pending
+            if not pending:
+                return
+
+            upserts = [(ns, key, value) for (ns, key), value in pending.items() if value is not None]
+            deletes = [(ns, key) for (ns, key), value in pending.items() if value is None]
+            try:
+                self._conn.execute("BEGIN")
+                if upserts:
+                    self._conn.executemany(
+                        "INSERT INTO kv (namespace, key, value) VALUES (?, ?, ?) "
+                        "ON CONFLICT (namespace, key) DO UPDATE SET value = excluded.value",
+                        upserts
+                    )
+                if deletes:
+                    self._conn.executemany(
+                        "DELETE FROM kv WHERE namespace = ? AND key = ?", deletes
+                    )
+                self._conn.execute("COMMIT")
+            except sqlite3.Error as e:
+                self._conn.execute("ROLLBACK")
+                logger.error(f"Ошибка записи в хранилище {self.path}: {e}")
+                # Возвращаем изменения, не затирая более свежие
+                with self._pending_lock:
+                    for item, value in pending.items():
+                        self._pending.setdefault(item, value)
+            finally:
+                with self._pending_lock:
+                    self._flushing = {}
+
+    def _flush_loop(self) -> None:
+        """Фоновый сброс изменений"""
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def close(self) -> None:
+        self._stop.set()
+        self._thread.join()
+        self.flush()
+        with self._db_lock:
+            self._conn.close()
+
+
+def create_storage(backend: str, path: str = None, flush_interval: float = 2.0) -> StorageBackend:
+    """Создает хранилище по имени из настроек"""
+    if backend == "memory":
+        return MemoryStorage()
+    if backend == "sqlite":
+        return SQLiteStorage(path, flush_interval=flush_interval)
+    raise ValueError(f"Неизвестное хранилище: {backend}")
@@ -0,0 +1,131 @@
+import asyncio
+import hmac
+import logging
+import signal
+
+from aiohttp import web
+from telegram import Update
+from telegram.ext import Application
+
+from concurrency import update_stats
+from metrics import metrics_view
+
+logger = logging.getLogger(__name__)
+
+# Заголовок, в котором Telegram передает секрет webhook
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+# Маршрутизатор cluster.py просит процесс перечитать сессии, когда меняется кольцо
+RELOAD_PATH = "/cluster/reload"
+
+# Ключ, под которым Application хранится в aiohttp-приложении
+APPLICATION_KEY = web.AppKey("application", Application)
+
+
+def create_web_app(application: Application, path: str, secret_token: str = None) -> web.Application:
+    """
+    Создает aiohttp-приложение, принимающее обновления от Telegram.
+
+    Каждый запрос только разбирает JSON и кладет Update в очередь Application,
+    поэтому сервер отвечает Telegram сразу и принимает запросы параллельно.
+    """
+
+    async def handle_update(request: web.Request) -> web.Response:
+        if secret_token is not None:
+            received = request.headers.get(SECRET_HEADER, "")
+            if not hmac.compare_digest(received, secret_token):
+                logger.warning(f"Запрос к webhook с неверным секретом от {request.remote}")
+                return web.Response(status=403)
+
+        try:
+            data = await request.json()
+            update = Update.de_json(data, application.bot)
+        except Exception as e:
+            logger.error(f"Некорректное обновление в webhook: {e}")
+            return web.Response(status=400)
+
+        await application.update_queue.put(update)
+        return web.Response()
+
+    async def reload_sessions(request: web.Request) -> web.Response:
+        if secret_token is not None:
+            received = request.headers.get(SECRET_HEADER, "")
+            if not hmac.compare_digest(received, secret_token):
+                logger.warning(f"Запрос на перечитывание сессий с неверным секретом от {request.remote}")
+                return web.Response(status=403)
+
+        try:
+            save = bool((await request.json()).get("save", True))
+        except Exception as e:
+            logger.error(f"Некорректный запрос на перечитывание сессий: {e}")
+            return web.Response(status=400)
+
+        await application.persistence.reload(application, save=save)
+        return web.Response()
+
+    async def healthz(request: web.Request) -> web.Response:
+        status = 200 if application.running else 503
+        return web.json_response(
+            {"running": application.running, **update_stats(application)},
+            status=status
+        )
+
+    web_app = web.Application()
+    web_app[APPLICATION_KEY] = application
+    web_app.router.add_post(path, handle_update)
+    web_app.router.add_post(RELOAD_PATH, reload_sessions)
+    web_app.router.add_get("/healthz", healthz)
+    web_app.router.add_get("/metrics", metrics_view)
+    return web_app
+
+
+async def run_webhook(
+    application: Application,
+    host: str,
+    port: int,
+    path: str,
+    url: str = None,
+    secret_token: str = None,
+    web_app: web.Application = None,
+) -> None:
+    """Запускает бота в режиме webhook до получения SIGINT/SIGTERM"""
+    if web_app is None:
+        web_app = create_web_app(application, path, secret_token)
+    runner = web.AppRunner(web_app)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:
+            # Windows не поддерживает обработчики сигналов в цикле событий
+            pass
+
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    try:
+        await application.start()
+        if url:
+            await application.bot.set_webhook(
+                url=url,
+                secret_token=secret_token,
+                allowed_updates=Update.ALL_TYPES
+            )
+            logger.info(f"Webhook зарегистрирован: {url}")
+        await site.start()
+        logger.info(f"Сервер webhook слушает {host}:{port}{path}")
+
+        await stop_event.wait()
+    finally:
+        await runner.cleanup()
+        if application.running:
+            await application.stop()
+            if application.post_stop:
+                await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)